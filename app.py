@@ -1,15 +1,41 @@
 from io import StringIO, BytesIO
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, current_app, send_file
+from flask import (Flask, Request, render_template, request, redirect, url_for, flash, jsonify, session, current_app,
+                   send_file, send_from_directory, stream_with_context)
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from functools import wraps
+from itertools import chain
 from models.database import init_db, get_db_connection
-from models.book import load_csv_to_db, search_books, add_book, edit_book as update_book, delete_book
-from models.user import register_user, login_user, is_admin
-from models.statistics_helpers import get_user_books, generate_charts, get_location_coords, generate_fun_facts
+from models.book import (load_csv_to_db, search_books, search_totals, add_book, edit_book as update_book, delete_book,
+                         bulk_delete_books, bulk_update_books)
+from models.catalog import normalize_isbn, get_cached_cover, enrich_edition
+from models.snapshot import export_snapshot, stream_snapshot, import_snapshot
+from models.duplicates import find_duplicates, merge_duplicates
+from models.recommendations import get_similar_books
+from models.autocomplete import autocomplete, AUTOCOMPLETE_FIELDS, AUTOCOMPLETE_LIMIT, MAX_AUTOCOMPLETE_LIMIT
+from models.writer import run_write
+from models.shards import (init_shards, user_connection, run_user_write, fan_out, user_ids_with_books, shard_status,
+                           move_user, rebalance, SHARDS)
+from models.global_stats import global_statistics, rebuild_global_stats, refresh_global_stats, GLOBAL_STATS_LIMIT
+from models.batch_import import batch_import, find_csv_files, read_user_map
+from models.changes import stream_changes, check_since, CHANGES_PAGE_SIZE, MAX_CHANGES_PAGE_SIZE
+from models.book_record import Book, book_from_cursor, books_to_json, dumps
+from models.cache import all_cache_stats, stats_cache, get_collection_revision
+from models.user import register_user, login_user, is_admin, list_users, delete_user_cascade
+from models.maintenance import (schedule_orphan_cleanup, run_orphan_cleanup, run_task, database_status, note_request,
+                                start_scheduler, MAINTENANCE_TASKS)
+from models.session_store import SqliteSessionInterface, revoke_user_sessions
+from models.avatars import (store_avatar, remove_unused_avatar, is_avatar_id, avatar_filename, AVATAR_DIR,
+                            AVATAR_FILE_PATTERN, MAX_AVATAR_BYTES)
+from models.statistics_helpers import (get_user_books, get_location_coords, generate_fun_facts, generate_chart_group,
+                                       CHART_BUILDERS, CHART_GROUPS, collection_timeseries, TIMESERIES_PERIODS,
+                                       location_points, bbox_cells, cluster_locations, MAX_MAP_ZOOM)
 import time
+import json
 import os
 import pandas as pd
 import logging
+import click
 
 
 
@@ -17,11 +43,64 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+def load_secret_key():
+    """Eén vaste sleutel voor alle workers en herstarts: SECRET_KEY of een eenmalig aangemaakt bestand."""
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+    path = os.environ.get('SECRET_KEY_FILE', '.secret_key')
+    try:
+        # O_EXCL: als meerdere processen tegelijk starten, wint er precies één
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(32).hex())
+    except FileExistsError:
+        pass
+    for _ in range(50):
+        with open(path) as f:
+            key = f.read().strip()
+        if key:
+            return key
+        time.sleep(0.01)  # een ander proces schrijft de sleutel nog
+    raise RuntimeError(f"Leeg sleutelbestand: {path}")
+
+# Grootste toegestane request body (CSV-import, snapshots); ook voor chunked uploads zonder Content-Length
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 64 * 1024 * 1024))
+# Ruimte voor de bio en multipart-headers bovenop de maximale fotogrootte
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+class UploadLimitRequest(Request):
+    """Request met een kleinere bodylimiet voor het profielformulier (alleen een foto en een bio)."""
+
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'edit_profile':
+            return MAX_AVATAR_BYTES + UPLOAD_FORM_OVERHEAD
+        return super().max_content_length
+
 app = Flask(__name__)
-app.secret_key = os.urandom(24).hex()
-app.config['SESSION_TYPE'] = 'filesystem'
+app.request_class = UploadLimitRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+app.secret_key = load_secret_key()
+# Sessies staan server-side in SQLite; de cookie bevat alleen het sessie-id
+app.session_interface = SqliteSessionInterface()
 CORS(app)
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    # Werkzeug weigert de body (ook zonder Content-Length) zodra die de limiet van dit verzoek overschrijdt
+    if request.endpoint == 'edit_profile':
+        flash(f"Profielfoto is te groot (maximaal {MAX_AVATAR_BYTES // (1024 * 1024)} MB).", "error")
+        return redirect(url_for('edit_profile'))
+    flash(f"Bestand is te groot (maximaal {MAX_UPLOAD_BYTES // (1024 * 1024)} MB).", "error")
+    return redirect(request.referrer or url_for('index'))
+
+@app.before_request
+def track_activity():
+    # Onderhoud (vacuüm) wacht tot het stil is; de planner start bij het eerste verzoek van elke worker
+    note_request()
+    if not app.testing and os.environ.get('MAINTENANCE_SCHEDULER', '1') != '0':
+        start_scheduler()
+
 # Decorators
 def login_required(f):
     @wraps(f)
@@ -57,11 +136,42 @@ def inject_roles():
 
 # Initialize database
 init_db()
+init_shards()
+
+# Dashboard: aantal boeken per opgehaalde pagina
+DASHBOARD_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Gebruikersbeheer: gebruikers per pagina
+USERS_PAGE_SIZE = 25
+
+# Avatars hebben inhoudshash-namen en veranderen nooit: één jaar cachen
+AVATAR_MAX_AGE = 365 * 24 * 3600
+
+def warm_caches():
+    """Templates compileren en de eerste dashboardpagina per gebruiker in de zoekcache zetten."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    user_ids = user_ids_with_books()
+    for user_id in user_ids:
+        search_books({}, user_id=user_id, limit=DASHBOARD_PAGE_SIZE)
+        search_totals({}, user_id=user_id)
+    logger.info(f"Warmed caches for {len(user_ids)} users")
+
+def book_row_dict(book):
+    """Zet een boekenrij om naar een dict voor de dashboardtabel."""
+    return book.to_dict(is_admin=is_admin())
+
+def json_bytes_response(body, status=200):
+    """JSON-antwoord uit voorgeserialiseerde bytes (zie models.book_record.dumps)."""
+    return app.response_class(body, status=status, mimetype='application/json')
 
 def clean_geocache():
-    with get_db_connection() as conn:
-        c = conn.cursor()
-        c.execute('''DELETE FROM geocache WHERE location NOT IN (SELECT DISTINCT land FROM books WHERE land IS NOT NULL AND land != '')''')
+    # Landen staan verspreid over de shards; de geocache staat enkel in de hoofddatabase
+    found = fan_out(lambda conn: [row[0] for row in conn.execute(
+        "SELECT DISTINCT land FROM books WHERE land IS NOT NULL AND land != ''")])
+    lands = json.dumps(sorted({land for shard_lands in found.values() for land in shard_lands}))
+    run_write(lambda c: c.execute('DELETE FROM geocache WHERE location NOT IN (SELECT value FROM json_each(?))', (lands,)))
 
 def get_user_settings(user_id):
     conn = get_db_connection()
@@ -72,67 +182,89 @@ def get_user_settings(user_id):
     return {'color': result[0] if result else '#e31c73', 'dark_mode': result[1] if result else True}
 
 def update_user_settings(user_id, color, dark_mode):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('UPDATE users SET color = ?, dark_mode = ? WHERE id = ?', (color, dark_mode, user_id))
-    conn.commit()
-    conn.close()
+    run_write(lambda c: c.execute('UPDATE users SET color = ?, dark_mode = ? WHERE id = ?', (color, dark_mode, user_id)))
 
 @app.route('/manage_users', methods=['GET', 'POST'])
 @super_admin_required
 def manage_users():
-    conn = get_db_connection()
-    c = conn.cursor()
-
     if request.method == 'POST':
         action = request.form.get('action')
-        user_id = request.form.get('user_id')
+        user_id = request.form.get('user_id', type=int)
 
         if action == 'delete':
-            c.execute('DELETE FROM users WHERE id = ?', (user_id,))
-            flash('Gebruiker verwijderd.', 'success')
+            remove_user(user_id)
         elif action == 'toggle_role':
-            c.execute('SELECT role FROM users WHERE id = ?', (user_id,))
-            current_role = c.fetchone()[0]
-            # Toggle role
-            if current_role == 'admin':
-                new_role = 'super'
+            def toggle_role(c):
+                c.execute('SELECT role FROM users WHERE id = ?', (user_id,))
+                # Toggle role: admin -> super, super -> admin
+                new_role = 'super' if c.fetchone()[0] == 'admin' else 'admin'
+                c.execute('UPDATE users SET role = ? WHERE id = ?', (new_role, user_id))
+                # Ingelogde sessies dragen de oude rol; de gebruiker moet opnieuw inloggen
+                revoke_user_sessions(user_id, c)
+                return new_role
+            if run_write(toggle_role) == 'super':
                 flash('Adminstatus verwijderd; gebruiker is nu supergebruiker.', 'success')
-            else:  # super -> admin
-                new_role = 'admin'
+            else:
                 flash('Gebruiker is nu admin.', 'success')
-            c.execute('UPDATE users SET role = ? WHERE id = ?', (new_role, user_id))
-
-        conn.commit()
-
-    c.execute('SELECT id, username, role FROM users')
-    users = c.fetchall()
-    conn.close()
-    return render_template('manage_users.html', users=users, settings=get_user_settings(session.get('user_id')))
+        return redirect(url_for('manage_users', q=request.args.get('q', ''), page=request.args.get('page', 1)))
+
+    search = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    users, total = list_users(search, page, USERS_PAGE_SIZE)
+    pages = max((total + USERS_PAGE_SIZE - 1) // USERS_PAGE_SIZE, 1)
+    return render_template('manage_users.html', users=users, total=total, page=page, pages=pages, search=search,
+                           settings=get_user_settings(session.get('user_id')))
+
+def remove_user(user_id):
+    """Verwijder een gebruiker met alles wat bij hem hoort en ruim daarna wezen op de achtergrond op."""
+    success, message, profile_pic = delete_user_cascade(user_id)
+    flash(message, 'success' if success else 'error')
+    if success:
+        remove_unused_avatar(profile_pic)
+        clean_geocache()
+        schedule_orphan_cleanup()
+    return success
 
 
 @app.route('/admin/users/delete/<int:user_id>', methods=['POST'])
 @super_admin_required
 def delete_user(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
-    flash("Gebruiker verwijderd!")
+    remove_user(user_id)
     return redirect(url_for('manage_users'))
 
 @app.route('/admin/users/promote/<int:user_id>', methods=['POST'])
 @super_admin_required
 def promote_user(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("UPDATE users SET role = 'admin' WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    def promote(c):
+        c.execute("UPDATE users SET role = 'admin' WHERE id = ?", (user_id,))
+        revoke_user_sessions(user_id, c)
+    run_write(promote)
     flash("Gebruiker is nu admin!")
     return redirect(url_for('manage_users'))
 
+@app.route('/admin/cache_stats')
+@super_admin_required
+def cache_stats():
+    """Hit-rate en grootte van de caches in dit proces."""
+    return jsonify(all_cache_stats())
+
+@app.route('/admin/maintenance')
+@super_admin_required
+def maintenance():
+    """Status van het databasebestand en de geplande onderhoudstaken."""
+    return render_template('maintenance.html', status=database_status(),
+                           settings=get_user_settings(session.get('user_id')))
+
+@app.route('/admin/maintenance/run/<task>', methods=['POST'])
+@super_admin_required
+def run_maintenance_task(task):
+    if task not in MAINTENANCE_TASKS:
+        flash('Onbekende onderhoudstaak.', 'error')
+        return redirect(url_for('maintenance'))
+    success, detail = run_task(task)
+    flash(f"{task}: {detail}", 'success' if success else 'error')
+    return redirect(url_for('maintenance'))
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -175,7 +307,7 @@ def over_mij():
         flash("Log in om je profiel te bekijken.", "error")
         return redirect(url_for("login"))
     settings = get_user_settings(user_id)
-    conn = get_db_connection()
+    conn = user_connection(user_id)
     df = pd.read_sql_query("SELECT * FROM books WHERE user_id = ?", conn, params=(user_id,))
     conn.close()
 
@@ -210,6 +342,7 @@ def edit_profile():
     settings = get_user_settings(user_id)
     conn = get_db_connection()
     user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.close()
 
     if request.method == "POST":
         updates = []
@@ -221,34 +354,55 @@ def edit_profile():
             updates.append("bio = ?")
             params.append(bio)
 
-        # 📸 Foto uploaden
+        # 📸 Foto uploaden: verkleind tot vaste avatarformaten, opgeslagen onder de inhoudshash
+        new_avatar = None
         if "profile_pic" in request.files:
             file = request.files["profile_pic"]
             if file and file.filename.strip() != "":
-                filename = secure_filename(file.filename)
-                upload_folder = os.path.join(current_app.root_path, "static", "images")
-                os.makedirs(upload_folder, exist_ok=True)
-                filepath = os.path.join(upload_folder, filename)
-                file.save(filepath)
-
+                success, result = store_avatar(file.stream)
+                if not success:
+                    flash(result, "error")
+                    return redirect(url_for("edit_profile"))
+                new_avatar = result
                 updates.append("profile_pic = ?")
-                params.append(filename)
+                params.append(result)
 
         # 🚀 Update uitvoeren als er iets gewijzigd is
         if updates:
-            sql = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
-            params.append(user_id)
-            conn.execute(sql, tuple(params))
-            conn.commit()
+            def update_profile(c):
+                # De oude foto binnen de transactie lezen: die wordt na de commit opgeruimd als niemand ze nog gebruikt
+                c.execute("SELECT profile_pic FROM users WHERE id = ?", (user_id,))
+                row = c.fetchone()
+                c.execute(f"UPDATE users SET {', '.join(updates)} WHERE id = ?", tuple(params) + (user_id,))
+                return row["profile_pic"] if row else None
+
+            old_avatar = run_write(update_profile)
+            if new_avatar and old_avatar and old_avatar != new_avatar:
+                remove_unused_avatar(old_avatar)
             flash("Profiel bijgewerkt!", "success")
 
-        conn.close()
         return redirect(url_for("over_mij"))
 
-    conn.close()
-    return render_template("edit_profile.html", user=user, settings=settings)
+    return render_template("edit_profile.html", user=user, settings=settings,
+                           max_avatar_mb=MAX_AVATAR_BYTES // (1024 * 1024))
 
 
+@app.route('/avatars/<name>')
+def avatar(name):
+    # Bestandsnamen zijn inhoudshashes: een nieuwe foto krijgt een nieuwe URL, dus mag alles lang gecachet worden
+    if not AVATAR_FILE_PATTERN.match(name):
+        return '', 404
+    response = send_from_directory(AVATAR_DIR, name, max_age=AVATAR_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={AVATAR_MAX_AGE}, immutable'
+    return response
+
+@app.template_global()
+def avatar_url(profile_pic, size=128):
+    """URL van een profielfoto in het gevraagde formaat; oude foto's komen nog uit static/images."""
+    if is_avatar_id(profile_pic):
+        return url_for('avatar', name=avatar_filename(profile_pic, size))
+    return url_for('static', filename='images/' + (profile_pic or 'default.jpg'))
+
 @app.route('/dashboard', methods=['GET', 'POST'])
 @login_required
 def dashboard():
@@ -259,7 +413,7 @@ def dashboard():
     
     logger.debug(f"Index route - User ID: {user_id}, Role: {session.get('role')}")
     settings = get_user_settings(user_id)
-    conn = get_db_connection()
+    conn = user_connection(user_id)
     filters = {}
     edit_book_data = {}
     books = []
@@ -299,64 +453,52 @@ def dashboard():
                    ['titel', 'auteur_voornaam', 'auteur_achternaam', 'genre', 'uitgeverij', 'isbn', 
                     'serie', 'staat', 'taal', 'gesigneerd', 'gelezen', 'bindwijze', 'edition', 'land',
                     'min_prijs', 'max_prijs', 'min_paginas', 'max_paginas'] if request.form.get(col, '').strip()}
-        books = search_books(filters, user_id=user_id)
-        logger.debug(f"Books retrieved for user {user_id}: {len(books)} books")
 
     else:
         book_id = request.args.get('edit_book_id')
         if book_id and is_admin():
             c = conn.cursor()
             c.execute('SELECT * FROM books WHERE id = ? AND user_id = ?', (book_id, user_id))
-            book = c.fetchone()
+            book = book_from_cursor(c)
             if book:
-                edit_book_data = {
-                    'book_id': book['id'],
-                    'titel': book['titel'],
-                    'auteur_voornaam': book['auteur_voornaam'],
-                    'auteur_achternaam': book['auteur_achternaam'],
-                    'genre': book['genre'],
-                    'min_prijs': book['prijs'],
-                    'min_paginas': book['paginas'],
-                    'bindwijze': book['bindwijze'],
-                    'edition': book['edition'],
-                    'isbn': book['isbn'],
-                    'reeks_nr': book['reeks_nr'],
-                    'uitgeverij': book['uitgeverij'],
-                    'serie': book['serie'],
-                    'staat': book['staat'],
-                    'taal': book['taal'],
-                    'gesigneerd': book['gesigneerd'],
-                    'gelezen': book['gelezen'],
-                    'land': book['land'],
-                    'added_date': book['added_date']
-                }
+                # Het formulier gebruikt min_prijs/min_paginas voor prijs en pagina's
+                edit_book_data = book.to_dict(book_id=book.id, min_prijs=book.prijs, min_paginas=book.paginas)
                 logger.debug(f"Edit book data loaded: {edit_book_data}")
             else:
                 flash("Boek niet gevonden!", "error")
                 logger.debug(f"Book ID {book_id} not found for user {user_id}")
         
-        books = search_books({}, user_id=user_id)
-        logger.debug(f"Books retrieved for user {user_id}: {len(books)} books")
-
     conn.close()
-    df = pd.DataFrame(books, columns=['user_id','id', 'titel', 'auteur_voornaam', 'auteur_achternaam', 'genre', 'prijs', 
-                                     'paginas', 'bindwijze', 'edition', 'isbn', 'reeks_nr', 'uitgeverij', 'serie', 
-                                     'staat', 'taal', 'gesigneerd', 'gelezen', 'added_date', 'land'])
-    logger.debug(f"DataFrame dtypes: {df.dtypes}")
-    if not df.empty:
-        df['prijs'] = pd.to_numeric(df['prijs'], errors='coerce').fillna(0).astype(float)
-        df['paginas'] = pd.to_numeric(df['paginas'], errors='coerce').fillna(0).astype(float).astype(int)
-        logger.debug(f"Sample paginas values: {df['paginas'].head().tolist()}")
-    total_price = df['prijs'].sum() if not df.empty else 0
-    total_pages = df['paginas'].sum() if not df.empty else 0
+
+    # Alleen de eerste pagina server-side renderen; de rest laadt de tabel bij het scrollen
+    books = search_books(filters, user_id=user_id, limit=DASHBOARD_PAGE_SIZE)
+    totals = search_totals(filters, user_id=user_id)
+    logger.debug(f"Books retrieved for user {user_id}: {len(books)} of {totals['total']} books")
     
     return render_template('dashboard.html', 
                        books=books, 
-                       total_price=total_price, 
-                       total_pages=total_pages,
+                       first_page=[book_row_dict(book) for book in books],
+                       page_size=DASHBOARD_PAGE_SIZE,
+                       total_books=totals['total'],
+                       total_price=totals['total_price'], 
+                       total_pages=totals['total_pages'],
                        filters=filters, 
                        settings=settings, 
-                       edit_book_data=edit_book_data)
+                       edit_book_data=edit_book_data,
+                       autocomplete_fields=AUTOCOMPLETE_FIELDS)
+
+@app.route('/autocomplete/<field>')
+@login_required
+def autocomplete_field(field):
+    """Type-ahead: de meest gebruikte waarden van een veld in de eigen collectie die met prefix beginnen."""
+    if field not in AUTOCOMPLETE_FIELDS:
+        return jsonify({'error': f"Geen autocomplete voor veld {field}"}), 404
+    limit = request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int)
+    if not 1 <= limit <= MAX_AUTOCOMPLETE_LIMIT:
+        return jsonify({'error': f'limit moet tussen 1 en {MAX_AUTOCOMPLETE_LIMIT} liggen'}), 400
+    prefix = request.args.get('prefix', '')
+    return jsonify({'field': field, 'prefix': prefix,
+                    'values': autocomplete(session.get('user_id'), field, prefix, limit)})
 
 @app.route('/search', methods=['POST'])
 def search():
@@ -365,13 +507,51 @@ def search():
     filters = request.get_json() or {}
     books = search_books(filters, user_id=user_id)
     logger.debug(f"Search route - Retrieved {len(books)} books for user {user_id}")
-    return jsonify([{
-        'id': book[0], 'titel': book[1], 'auteur_voornaam': book[2], 'auteur_achternaam': book[3],
-        'genre': book[4], 'prijs': book[5], 'paginas': book[6], 'bindwijze': book[7],
-        'edition': book[8], 'isbn': book[9], 'reeks_nr': book[10], 'uitgeverij': book[11],
-        'serie': book[12], 'staat': book[13], 'taal': book[14], 'gesigneerd': book[15],
-        'gelezen': book[16], 'added_date': book[17], 'land': book[18], 'is_admin': is_admin_val
-    } for book in books])
+    return json_bytes_response(books_to_json(books, is_admin=is_admin_val))
+
+@app.route('/search/page', methods=['POST'])
+def search_page():
+    """Eén pagina zoekresultaten voor de virtuele dashboardtabel, met totalen bij de eerste pagina."""
+    user_id = session.get('user_id', 0)
+    payload = request.get_json() or {}
+    try:
+        offset = max(int(payload.pop('offset', 0) or 0), 0)
+        limit = min(max(int(payload.pop('limit', DASHBOARD_PAGE_SIZE) or DASHBOARD_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Ongeldige offset of limit'}), 400
+    filters = {key: str(value) for key, value in payload.items()}
+    books = search_books(filters, user_id=user_id, limit=limit, offset=offset)
+    result = {'offset': offset, 'books': [book_row_dict(book) for book in books]}
+    if offset == 0:
+        result.update(search_totals(filters, user_id=user_id))
+    return json_bytes_response(dumps(result))
+
+@app.route('/books/<int:book_id>/similar')
+@login_required
+def similar_books(book_id):
+    """Vergelijkbare boeken uit de eigen collectie, uit de voorberekende index."""
+    books = get_similar_books(session.get('user_id'), book_id)
+    if books is None:
+        return jsonify({'error': 'Boek niet gevonden'}), 404
+    return jsonify({'book_id': book_id, 'similar': books})
+
+@app.route('/books/changes')
+@login_required
+def book_changes():
+    """Wijzigingen in de eigen collectie sinds een revisie (delta-synchronisatie), per pagina gestreamd."""
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', CHANGES_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'since en limit moeten gehele getallen zijn'}), 400
+    if since < 0 or not 1 <= limit <= MAX_CHANGES_PAGE_SIZE:
+        return jsonify({'error': f'since moet >= 0 zijn en limit tussen 1 en {MAX_CHANGES_PAGE_SIZE}'}), 400
+    ok, message = check_since(session.get('user_id'), since)
+    if not ok:
+        # 410: de client moet opnieuw volledig synchroniseren (since=0)
+        return jsonify({'error': message, 'full_resync': True}), 410
+    return app.response_class(stream_with_context(stream_changes(session.get('user_id'), since, limit)),
+                              mimetype='application/json')
 
 @app.route('/fetch_cover', methods=['POST'])
 def fetch_cover():
@@ -380,8 +560,21 @@ def fetch_cover():
     isbn = request.form.get('isbn', '').strip()
     if not title and not isbn:
         return jsonify({'cover_url': '', 'message': 'Vul een titel of ISBN in!', 'category': 'error'})
+
+    # Eerst de gedeelde catalogus (van de eigen shard): een kaft wordt maar één keer per shard opgehaald
+    user_id = session.get('user_id')
+    conn = user_connection(user_id)
+    cached = get_cached_cover(conn.cursor(), isbn)
+    conn.close()
+    if cached:
+        return jsonify({
+            'cover_url': cached['cover_url'],
+            'land': cached['cover_land'] or 'Onbekend',
+            'message': 'Boekkaft opgehaald!' if cached['cover_url'] else 'Geen boekkaft gevonden.',
+            'category': 'success' if cached['cover_url'] else 'info'
+        })
     
-    query = f"isbn:{isbn.replace('-', '')}" if isbn else f"intitle:{title.replace(' ', '+')}"
+    query = f"isbn:{normalize_isbn(isbn)}" if isbn else f"intitle:{title.replace(' ', '+')}"
     try:
         response = requests.get(f"https://www.googleapis.com/books/v1/volumes?q={query}", timeout=5)
         if response.status_code == 200:
@@ -392,6 +585,8 @@ def fetch_cover():
                 country = data["items"][0].get("saleInfo", {}).get("country", "")
                 country_map = {'NL': 'Nederland', 'BE': 'België', 'DE': 'Duitsland', 'FR': 'Frankrijk', 'ES': 'Spanje', 'IT': 'Italië'}
                 country_name = country_map.get(country, country or 'Onbekend')
+                if isbn:
+                    run_user_write(user_id, lambda c: enrich_edition(c, isbn, cover_url, country_name, book))
                 return jsonify({
                     'cover_url': cover_url,
                     'land': country_name,
@@ -417,6 +612,64 @@ def delete_book_route(book_id):
     flash(message, 'success' if success else 'error')
     return redirect(url_for('dashboard'))
 
+def _bulk_selection_from_request(payload):
+    """Haal de selectie (lijst id's of zoekfilter) uit een bulk-verzoek."""
+    book_ids = payload.get('ids')
+    filters = payload.get('filters')
+    if filters is not None:
+        filters = {key: str(value) for key, value in filters.items()}
+    return book_ids, filters
+
+@app.route('/books/bulk_delete', methods=['POST'])
+@admin_required
+def bulk_delete_route():
+    payload = request.get_json() or {}
+    book_ids, filters = _bulk_selection_from_request(payload)
+    success, message, affected = bulk_delete_books(session.get('user_id'), book_ids=book_ids, filters=filters)
+    if success and affected:
+        clean_geocache()
+    return jsonify({'success': success, 'message': message, 'affected': affected}), 200 if success else 400
+
+@app.route('/books/bulk_update', methods=['POST'])
+@admin_required
+def bulk_update_route():
+    payload = request.get_json() or {}
+    book_ids, filters = _bulk_selection_from_request(payload)
+    success, message, affected = bulk_update_books(session.get('user_id'), payload.get('updates') or {},
+                                                   book_ids=book_ids, filters=filters)
+    if success and affected and 'land' in (payload.get('updates') or {}):
+        clean_geocache()
+    return jsonify({'success': success, 'message': message, 'affected': affected}), 200 if success else 400
+
+@app.route('/duplicates')
+@login_required
+def duplicates():
+    """Clusters van waarschijnlijk dubbele boeken in de eigen collectie."""
+    user_id = session.get('user_id')
+    return render_template('duplicates.html', clusters=find_duplicates(user_id), settings=get_user_settings(user_id))
+
+@app.route('/duplicates/merge', methods=['POST'])
+@admin_required
+def merge_duplicates_route():
+    keep_id = request.form.get('keep_id')
+    duplicate_ids = request.form.getlist('book_ids')
+    success, message = merge_duplicates(session.get('user_id'), keep_id, duplicate_ids)
+    flash(message, 'success' if success else 'error')
+    return redirect(url_for('duplicates'))
+
+@app.route('/duplicates/delete', methods=['POST'])
+@admin_required
+def delete_duplicates_route():
+    book_ids = [book_id for book_id in request.form.getlist('book_ids') if book_id.isdigit()]
+    if not book_ids:
+        flash('Selecteer minstens één boek om te verwijderen.', 'error')
+        return redirect(url_for('duplicates'))
+    success, message, affected = bulk_delete_books(session.get('user_id'), book_ids=book_ids)
+    if success and affected:
+        clean_geocache()
+    flash(message, 'success' if success else 'error')
+    return redirect(url_for('duplicates'))
+
 @app.route('/upload_csv', methods=['POST'])
 @admin_required
 def upload_csv():
@@ -439,12 +692,13 @@ def upload_csv():
         return redirect(url_for('dashboard'))
     
     overwrite = 'overwrite' in request.form
-    success, message = load_csv_to_db(file, overwrite=overwrite, user_id=user_id)
+    success, message = load_csv_to_db(file, overwrite=overwrite, user_id=user_id,
+                                      flag_duplicates='flag_duplicates' in request.form)
     logger.debug(f"CSV upload result: success={success}, message={message}")
     flash(message, "success" if success else "error")
     
     # Verify imported books
-    conn = get_db_connection()
+    conn = user_connection(user_id)
     c = conn.cursor()
     c.execute('SELECT COUNT(*) FROM books WHERE user_id = ?', (user_id,))
     book_count = c.fetchone()[0]
@@ -461,8 +715,8 @@ def download_csv():
     logger.debug(f"CSV download initiated by user {user_id}")
     
     try:
-        conn = get_db_connection()
-        df = pd.read_sql_query('SELECT titel, auteur_voornaam, auteur_achternaam, genre, prijs, paginas, bindwijze, edition, isbn, reeks_nr, uitgeverij, serie, staat, taal, gesigneerd, gelezen, added_date, land FROM books WHERE user_id = ?', conn, params=(user_id,))
+        conn = user_connection(user_id)
+        df = pd.read_sql_query(f"SELECT {', '.join(Book.EXPORT_FIELDS)} FROM books WHERE user_id = ?", conn, params=(user_id,))
         conn.close()
         
         if df.empty:
@@ -486,6 +740,156 @@ def download_csv():
         flash(f"Fout bij exporteren naar CSV: {str(e)}", "error")
         return redirect(url_for('settings'))
 
+@app.route('/admin/snapshot/export', methods=['GET'])
+@admin_required
+def export_snapshot_route():
+    # Volledige database alleen voor superadmins, anders de eigen collectie
+    whole_db = request.args.get('scope') == 'all' and session.get('role') == 'admin'
+    user_id = None if whole_db else session.get('user_id')
+    logger.debug(f"Snapshot export initiated by user {session.get('user_id')}, whole_db={whole_db}")
+    try:
+        stream = stream_snapshot(user_id=user_id)
+        # Eerste stuk al hier: een fout (bv. geen pyarrow) wordt dan nog een melding i.p.v. een afgebroken download
+        first = next(stream)
+        name = 'alle_boeken' if whole_db else f"boekenlijst_van_{session.get('username')}"
+        response = app.response_class(stream_with_context(chain([first], stream)),
+                                      mimetype='application/vnd.apache.parquet')
+        response.headers.set('Content-Disposition', 'attachment', filename=f"{name}.parquet")
+        return response
+    except Exception as e:
+        logger.error(f"Error during snapshot export: {str(e)}")
+        flash(f"Fout bij exporteren snapshot: {str(e)}", "error")
+        return redirect(url_for('settings'))
+
+@app.route('/admin/snapshot/import', methods=['POST'])
+@admin_required
+def import_snapshot_route():
+    file = request.files.get('snapshot_file')
+    if not file or file.filename == '':
+        flash("Geen bestand geselecteerd!", "error")
+        return redirect(url_for('settings'))
+    if not file.filename.endswith('.parquet'):
+        flash("Alleen Parquet-bestanden zijn toegestaan!", "error")
+        return redirect(url_for('settings'))
+
+    whole_db = request.form.get('scope') == 'all' and session.get('role') == 'admin'
+    user_id = None if whole_db else session.get('user_id')
+    overwrite = 'overwrite' in request.form
+    success, message = import_snapshot(file.stream, user_id=user_id, overwrite=overwrite)
+    logger.debug(f"Snapshot import result: success={success}, message={message}")
+    flash(message, "success" if success else "error")
+    return redirect(url_for('dashboard'))
+
+@app.cli.command('snapshot-export')
+@click.argument('path')
+@click.option('--user-id', type=int, default=None, help='Alleen de boeken van deze gebruiker exporteren.')
+def snapshot_export_command(path, user_id):
+    """Exporteer boeken naar een Parquet-snapshot."""
+    with open(path, 'wb') as f:
+        total = export_snapshot(f, user_id=user_id)
+    click.echo(f"{total} boeken geëxporteerd naar {path}")
+
+@app.cli.command('snapshot-import')
+@click.argument('path')
+@click.option('--user-id', type=int, default=None, help='Alle boeken bij deze gebruiker importeren.')
+@click.option('--overwrite', is_flag=True, help='Bestaande boeken eerst verwijderen.')
+def snapshot_import_command(path, user_id, overwrite):
+    """Herstel boeken uit een Parquet-snapshot."""
+    success, message = import_snapshot(path, user_id=user_id, overwrite=overwrite)
+    click.echo(message)
+    if not success:
+        raise SystemExit(1)
+
+@app.cli.command('purge-orphans')
+def purge_orphans_command():
+    """Verwijder boeken, likes en sessies van verwijderde gebruikers en geef de ruimte terug."""
+    removed = run_orphan_cleanup()
+    for table, count in removed.items():
+        click.echo(f"{table}: {count}")
+
+@app.cli.command('maintenance')
+@click.argument('task', type=click.Choice(list(MAINTENANCE_TASKS)))
+def maintenance_command(task):
+    """Voer een onderhoudstaak direct uit (optimize, vacuum of backup)."""
+    success, detail = run_task(task)
+    click.echo(detail)
+    if not success:
+        raise SystemExit(1)
+
+@app.cli.group('shards')
+def shards_cli():
+    """Beheer de boekshards (BOOK_SHARDS)."""
+
+@shards_cli.command('status')
+def shards_status_command():
+    """Toon per shard het aantal gebruikers, boeken en de bestandsgrootte."""
+    for shard in shard_status():
+        click.echo(f"{shard['name']}: {shard['users']} gebruikers, {shard['books']} boeken, "
+                   f"{shard['size'] / 1048576:.1f} MB ({shard['path']})")
+
+@shards_cli.command('move')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=click.Choice(list(SHARDS)))
+def shards_move_command(user_id, shard):
+    """Verhuis de boeken van een gebruiker naar een andere shard."""
+    success, message = move_user(user_id, shard)
+    click.echo(message)
+    if not success:
+        raise SystemExit(1)
+
+@shards_cli.command('rebalance')
+@click.option('--dry-run', is_flag=True, help='Toon enkel het verhuisplan.')
+def shards_rebalance_command(dry_run):
+    """Verdeel de boeken gelijkmatiger over de shards door gebruikers te verhuizen."""
+    results = rebalance(dry_run=dry_run)
+    for user_id, source, target, books, success, message in results:
+        click.echo(f"{user_id}: {source} -> {target} ({books} boeken): {message}")
+    if not results:
+        click.echo("De shards zijn in evenwicht.")
+    if not all(result[4] for result in results):
+        raise SystemExit(1)
+
+@app.cli.command('global-stats')
+@click.option('--rebuild', is_flag=True, help='Alle aggregaten opnieuw opbouwen (herstel) in plaats van bijwerken.')
+def global_stats_command(rebuild):
+    """Werk de globale statistieken bij vanuit het wijzigingslog."""
+    count = rebuild_global_stats() if rebuild else refresh_global_stats()
+    click.echo(f"{count} boeken verwerkt")
+
+@app.cli.command('import-csv')
+@click.argument('sources', nargs=-1, required=True)
+@click.option('--user', 'default_user', default=None, help='Gebruiker (ID of naam) voor bestanden zonder koppeling.')
+@click.option('--user-map', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Bestand met per regel 'bestand,gebruiker'.")
+@click.option('--workers', type=int, default=None, help='Aantal parseerprocessen (standaard het aantal CPU-kernen).')
+@click.option('--overwrite', is_flag=True, help='Bestaande boeken van elke gebruiker eerst verwijderen.')
+def import_csv_command(sources, default_user, user_map, workers, overwrite):
+    """Importeer CSV-bestanden uit mappen of globpatronen, parallel geparst."""
+    paths = find_csv_files(sources)
+    if not paths:
+        click.echo("Geen CSV-bestanden gevonden.")
+        raise SystemExit(1)
+    try:
+        mapping = read_user_map(user_map) if user_map else {}
+    except ValueError as e:
+        click.echo(str(e))
+        raise SystemExit(1)
+    entries, totals = batch_import(paths, user_map=mapping, default_user=default_user, workers=workers,
+                                   overwrite=overwrite)
+    for entry in entries:
+        name = os.path.basename(entry['path'])
+        if entry['error']:
+            click.echo(f"FOUT {name}: {entry['error']}")
+        else:
+            click.echo(f"{name}: {entry['inserted']} van {entry['rows']} boeken toegevoegd voor gebruiker "
+                       f"{entry['user_id']} (geparst in {entry['parse_seconds']:.2f} s)")
+    seconds = max(totals['seconds'], 1e-6)
+    click.echo(f"{totals['inserted']} boeken uit {totals['files']} bestanden in {totals['seconds']:.2f} s "
+               f"({totals['rows'] / seconds:.0f} rijen/s, {totals['files'] / seconds:.1f} bestanden/s), "
+               f"{totals['errors']} met fouten")
+    if totals['errors']:
+        raise SystemExit(1)
+
 @app.route('/statistics')
 def statistics():
     user_id = session.get('user_id')
@@ -493,21 +897,141 @@ def statistics():
         flash('Log in om boeken te bekijken.', 'error')
         return redirect(url_for('login'))
 
+    # Alleen het skelet; grafieken, kaart en fun facts laden parallel via de JSON-endpoints
     settings = get_user_settings(user_id)
-    df = get_user_books(user_id)
-
-    charts = generate_charts(df)
-    location_coords = get_location_coords(df)
-    fun_facts = generate_fun_facts(df, location_coords)
-
     return render_template(
         'statistics.html',
-        charts=charts,
-        settings=settings,
-        fun_facts=fun_facts,
-        location_coords=location_coords
+        chart_names=list(CHART_BUILDERS),
+        chart_groups=CHART_GROUPS,
+        timeseries_periods=list(TIMESERIES_PERIODS),
+        settings=settings
     )
 
+def _statistics_frame(user_id, rev):
+    """DataFrame met de boeken van de gebruiker, gedeeld door alle statistiek-endpoints."""
+    key = ('frame', user_id, rev)
+    df = stats_cache.get(key)
+    if df is None:
+        df = get_user_books(user_id)
+        stats_cache.put(key, df, int(df.memory_usage(deep=True).sum()))
+    return df
+
+def statistics_json(name, build, mimetype=None):
+    """JSON-antwoord voor één statistiek, gecachet op collectierevisie (server + ETag).
+
+    build(user_id, rev) geeft (data, cacheable) terug.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'Log in om boeken te bekijken.'}), 401
+    conn = user_connection(user_id)
+    rev = get_collection_revision(conn.cursor(), user_id)
+    conn.close()
+
+    etag = f"{name}-{user_id}-{rev}"
+    if request.if_none_match.contains(etag):
+        return '', 304
+    key = (name, user_id, rev)
+    data = stats_cache.get(key)
+    if data is None:
+        data, cacheable = build(user_id, rev)
+        if cacheable:
+            stats_cache.put(key, data, len(str(data)))
+    else:
+        cacheable = True
+
+    response = jsonify(data)
+    if mimetype:
+        response.mimetype = mimetype
+    if cacheable:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    else:
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/statistics/charts/<group>')
+def statistics_charts(group):
+    if group not in CHART_GROUPS:
+        return jsonify({'error': f'Onbekende grafiekgroep: {group}'}), 404
+    return statistics_json(f'charts-{group}',
+                           lambda user_id, rev: (generate_chart_group(_statistics_frame(user_id, rev), group), True))
+
+def _location_points(user_id, rev, geocode_missing=True):
+    """Plaatsen met coördinaten, aantallen en titels; geeft (points, complete) terug.
+
+    Pas gecachet als elke plaats coördinaten heeft; tot dan kan een volgende poging de rest vinden.
+    """
+    key = ('location_points', user_id, rev)
+    points = stats_cache.get(key)
+    if points is not None:
+        return points, True
+    df = _statistics_frame(user_id, rev)
+    coords = get_location_coords(df, geocode_missing=geocode_missing)
+    points = location_points(df, coords)
+    wanted = {loc.strip() for loc in df['land'].dropna() if loc.strip()} if 'land' in df.columns else set()
+    complete = wanted <= set(coords)
+    if complete:
+        stats_cache.put(key, points, len(str(points)))
+    return points, complete
+
+@app.route('/statistics/locations')
+def statistics_locations():
+    def build(user_id, rev):
+        points, complete = _location_points(user_id, rev)
+        return {'locations': [{key: point[key] for key in ('name', 'count', 'lat', 'lon')} for point in points]}, complete
+    return statistics_json('locations', build)
+
+@app.route('/statistics/map')
+def statistics_map():
+    """GeoJSON van de aankoopplaatsen, op de server geclusterd voor een zoomniveau en (optioneel) een bbox."""
+    try:
+        zoom = int(request.args.get('zoom', 4))
+        bbox = request.args.get('bbox')
+        bbox = [float(value) for value in bbox.split(',')] if bbox else None
+    except ValueError:
+        return jsonify({'error': 'zoom moet een geheel getal zijn en bbox vier getallen (west,zuid,oost,noord)'}), 400
+    if not 0 <= zoom <= MAX_MAP_ZOOM or (bbox is not None and (len(bbox) != 4 or bbox[1] > bbox[3])):
+        return jsonify({'error': f'zoom moet tussen 0 en {MAX_MAP_ZOOM} liggen en bbox west,zuid,oost,noord zijn'}), 400
+
+    # De cache-sleutel gebruikt de rastercellen, zodat kleine verschuivingen van de kaart hetzelfde antwoord geven
+    cells = bbox_cells(bbox, zoom) if bbox else None
+    def build(user_id, rev):
+        # Enkel de eerste (volledige) kaart wacht op de geocoder; verschuiven en zoomen nooit
+        points, complete = _location_points(user_id, rev, geocode_missing=cells is None)
+        return cluster_locations(points, zoom, cells), complete
+    name = f"map-{zoom}-" + ('all' if cells is None else '-'.join(str(cell) for cell in cells))
+    return statistics_json(name, build, mimetype='application/geo+json')
+
+@app.route('/statistics/fun_facts')
+def statistics_fun_facts():
+    # Alleen reeds gegeocodeerde plaatsen: fun facts wachten nooit op de geocoder
+    def build(user_id, rev):
+        df = _statistics_frame(user_id, rev)
+        return generate_fun_facts(df, get_location_coords(df, geocode_missing=False)), True
+    return statistics_json('fun_facts', build)
+
+@app.route('/statistics/timeseries/<period>')
+def statistics_timeseries(period):
+    if period not in TIMESERIES_PERIODS:
+        return jsonify({'error': f'Onbekende periode: {period}'}), 404
+    return statistics_json(f'timeseries-{period}', lambda user_id, rev: (collection_timeseries(user_id, period), True))
+
+@app.route('/statistics/global')
+@login_required
+def global_statistics_page():
+    """Cijfers over alle collecties samen (meest voorkomende titels, populaire genres en auteurs)."""
+    return render_template('global_statistics.html', stats=global_statistics(),
+                           settings=get_user_settings(session.get('user_id')))
+
+@app.route('/statistics/global/data')
+@login_required
+def global_statistics_data():
+    limit = request.args.get('limit', GLOBAL_STATS_LIMIT, type=int)
+    if not 1 <= limit <= 100:
+        return jsonify({'error': 'limit moet tussen 1 en 100 liggen'}), 400
+    return jsonify(global_statistics(limit))
+
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
@@ -0,0 +1,88 @@
+from .shards import user_connection
+from .cache import search_cache, get_collection_revision
+from .text import normalize_text
+from bisect import bisect_left
+import heapq
+import logging
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Velden met type-ahead in het boekformulier
+AUTOCOMPLETE_FIELDS = ['auteur_achternaam', 'serie', 'uitgeverij', 'genre', 'taal', 'land']
+# Standaard en maximaal aantal suggesties per verzoek
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+
+
+class PrefixIndex:
+    """Gesorteerde, genormaliseerde waarden van één veld met hun frequentie; prefix-zoeken via bisect.
+
+    Spellingvarianten ('Fantasy', 'fantasy ') vallen samen onder één sleutel en worden getoond in hun
+    meest gebruikte schrijfwijze, zodat suggesties de collectie consistent houden.
+    """
+
+    def __init__(self, rows):
+        groups = {}
+        for value, count in rows:
+            key = normalize_text(value)
+            if not key:
+                continue
+            group = groups.setdefault(key, {'count': 0, 'best': (0, value)})
+            group['count'] += count
+            group['best'] = max(group['best'], (count, value))
+        self.keys = sorted(groups)
+        self.values = [groups[key]['best'][1].strip() for key in self.keys]
+        self.counts = [groups[key]['count'] for key in self.keys]
+        # Zonder prefix: de vaakst gebruikte waarden, één keer gesorteerd
+        self.top = sorted(range(len(self.keys)), key=lambda i: (-self.counts[i], self.keys[i]))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def size(self):
+        """Geschatte grootte in bytes, voor de cache."""
+        return 64 + sum(96 + 2 * len(key) + len(value) for key, value in zip(self.keys, self.values))
+
+    def lookup(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        """Top-limit waarden (meest gebruikt eerst) waarvan de genormaliseerde vorm met prefix begint."""
+        prefix = normalize_text(prefix)
+        if not prefix:
+            matches = self.top[:limit]
+        else:
+            start = bisect_left(self.keys, prefix)
+            # Alle sleutels met dit prefix liggen aaneengesloten vóór prefix + het hoogste teken
+            end = bisect_left(self.keys, prefix + '\uffff', start)
+            matches = heapq.nsmallest(limit, range(start, end), key=lambda i: (-self.counts[i], self.keys[i]))
+        return [{'value': self.values[i], 'count': self.counts[i]} for i in matches]
+
+
+def _build_index(c, user_id, field):
+    c.execute(f'''SELECT {field} AS value, COUNT(*) AS count FROM books
+                  WHERE user_id = ? AND {field} IS NOT NULL AND {field} != ''
+                  GROUP BY {field}''', (user_id,))
+    return PrefixIndex((row['value'], row['count']) for row in c.fetchall())
+
+
+def get_prefix_index(user_id, field):
+    """Prefix-index van een veld voor een gebruiker, lazy opgebouwd en gecachet op collectierevisie."""
+    if field not in AUTOCOMPLETE_FIELDS:
+        raise ValueError(f"Geen autocomplete voor veld {field}")
+    conn = user_connection(user_id)
+    c = conn.cursor()
+    try:
+        key = ('autocomplete', user_id, field, get_collection_revision(c, user_id))
+        index = search_cache.get(key)
+        if index is None:
+            index = _build_index(c, user_id, field)
+            search_cache.put(key, index, index.size())
+            logger.debug(f"Built autocomplete index for user {user_id}, field {field}: {len(index)} values")
+        return index
+    finally:
+        conn.close()
+
+
+def autocomplete(user_id, field, prefix='', limit=AUTOCOMPLETE_LIMIT):
+    """Suggesties voor een veld: [{'value': .., 'count': ..}], meest gebruikte eerst."""
+    return get_prefix_index(user_id, field).lookup(prefix, limit)
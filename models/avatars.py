@@ -0,0 +1,120 @@
+from .database import get_db_connection
+from io import BytesIO
+import hashlib
+import logging
+import os
+import re
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Vaste avatarformaten (vierkant, in pixels); over_mij toont 128px, 256 voor hoge-resolutieschermen
+AVATAR_SIZES = (64, 128, 256)
+AVATAR_FORMAT = 'webp'
+AVATAR_QUALITY = 80
+
+# Uploads groter dan dit worden afgebroken tijdens het inlezen
+MAX_AVATAR_BYTES = int(os.environ.get('MAX_AVATAR_BYTES', 5 * 1024 * 1024))
+# Bescherming tegen "decompression bombs": kleine bestanden met enorme afmetingen
+MAX_AVATAR_PIXELS = 40_000_000
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+AVATAR_DIR = os.environ.get('AVATAR_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                       'static', 'avatars'))
+
+# Een avatar-id is de (ingekorte) sha256 van de geüploade bytes
+AVATAR_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+AVATAR_FILE_PATTERN = re.compile(r'^[0-9a-f]{32}-\d+\.' + AVATAR_FORMAT + '$')
+
+
+def _pillow():
+    """Pillow is alleen nodig voor profielfoto's; geef een duidelijke fout als het ontbreekt."""
+    try:
+        from PIL import Image, ImageOps
+        return Image, ImageOps
+    except ImportError:
+        raise RuntimeError("Profielfoto's vereisen Pillow (pip install Pillow).")
+
+
+def is_avatar_id(profile_pic):
+    return bool(profile_pic) and bool(AVATAR_ID_PATTERN.match(profile_pic))
+
+
+def avatar_filename(avatar_id, size):
+    return f"{avatar_id}-{size}.{AVATAR_FORMAT}"
+
+
+def read_upload(stream, limit=MAX_AVATAR_BYTES):
+    """Lees een upload in blokken in en stop zodra de limiet overschreden wordt."""
+    buffer = BytesIO()
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return buffer.getvalue()
+        if buffer.tell() + len(chunk) > limit:
+            return None
+        buffer.write(chunk)
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def store_avatar(stream):
+    """Verwerk een geüploade foto tot vierkante WebP-avatars in alle formaten.
+
+    Geeft (True, avatar_id) of (False, foutmelding) terug. Dezelfde foto (zelfde bytes) wordt
+    maar één keer verwerkt en opgeslagen, ook als meerdere gebruikers ze uploaden.
+    """
+    data = read_upload(stream)
+    if data is None:
+        return False, f"Profielfoto is te groot (maximaal {MAX_AVATAR_BYTES // (1024 * 1024)} MB)."
+    if not data:
+        return False, "Leeg bestand geüpload."
+
+    avatar_id = hashlib.sha256(data).hexdigest()[:32]
+    paths = {size: os.path.join(AVATAR_DIR, avatar_filename(avatar_id, size)) for size in AVATAR_SIZES}
+    if all(os.path.exists(path) for path in paths.values()):
+        logger.debug(f"Avatar {avatar_id} already stored")
+        return True, avatar_id
+
+    Image, ImageOps = _pillow()
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if image.width * image.height > MAX_AVATAR_PIXELS:
+                return False, "Profielfoto heeft te grote afmetingen."
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            os.makedirs(AVATAR_DIR, exist_ok=True)
+            for size, path in paths.items():
+                avatar = ImageOps.fit(image, (size, size), method=Image.LANCZOS)
+                output = BytesIO()
+                avatar.save(output, AVATAR_FORMAT, quality=AVATAR_QUALITY, method=6)
+                _write_atomic(path, output.getvalue())
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.error(f"Invalid avatar upload: {e}")
+        return False, "Ongeldige afbeelding. Upload een JPG, PNG, GIF of WebP."
+
+    logger.info(f"Stored avatar {avatar_id} ({len(data)} bytes uploaded)")
+    return True, avatar_id
+
+
+def remove_unused_avatar(avatar_id):
+    """Verwijder de bestanden van een avatar die door geen enkele gebruiker meer gebruikt wordt."""
+    if not is_avatar_id(avatar_id):
+        return
+    conn = get_db_connection()
+    in_use = conn.execute('SELECT 1 FROM users WHERE profile_pic = ? LIMIT 1', (avatar_id,)).fetchone()
+    conn.close()
+    if in_use:
+        return
+    for size in AVATAR_SIZES:
+        try:
+            os.remove(os.path.join(AVATAR_DIR, avatar_filename(avatar_id, size)))
+        except FileNotFoundError:
+            pass
+    logger.info(f"Removed unused avatar {avatar_id}")
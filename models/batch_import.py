@@ -0,0 +1,185 @@
+from .database import get_db_connection
+from .shards import run_user_write
+from .book import parse_csv_records, import_records
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+import time
+import glob
+import re
+import os
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Geparste rijen per gebruiker die samen in één schrijftransactie gaan
+IMPORT_BATCH_ROWS = 20000
+
+
+def find_csv_files(sources):
+    """Alle CSV-bestanden uit mappen, globpatronen en bestandsnamen (gesorteerd, zonder dubbels)."""
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths.extend(glob.glob(os.path.join(source, '*.csv')))
+        else:
+            # Een naam zonder treffers blijft staan, zodat hij als fout in het rapport komt
+            paths.extend(glob.glob(source) or [source])
+    return sorted(set(os.path.abspath(path) for path in paths))
+
+
+def read_user_map(path):
+    """Koppeling bestand -> gebruiker uit een tekstbestand met per regel 'bestand,gebruiker'.
+
+    Scheidingsteken komma, puntkomma of tab; regels met # zijn commentaar. Het bestand mag met of zonder
+    map en .csv opgegeven worden, de gebruiker als ID of gebruikersnaam.
+    """
+    mapping = {}
+    with open(path, encoding='utf-8-sig') as handle:
+        for number, line in enumerate(handle, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = [part.strip() for part in re.split(r'[,;\t]', line)]
+            if len(parts) != 2 or not all(parts):
+                raise ValueError(f"Regel {number} van {path} is geen 'bestand,gebruiker': {line}")
+            mapping[parts[0]] = parts[1]
+    return mapping
+
+
+def _mapped_user(user_map, path):
+    name = os.path.basename(path)
+    for key in (path, name, os.path.splitext(name)[0]):
+        if key in user_map:
+            return user_map[key]
+    return None
+
+
+def _resolve_users(values):
+    """{ID of gebruikersnaam: gebruikers-ID} voor de gebruikers die bestaan."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    resolved = {}
+    try:
+        for value in values:
+            if str(value).isdigit():
+                c.execute('SELECT id FROM users WHERE id = ?', (int(value),))
+            else:
+                c.execute('SELECT id FROM users WHERE username = ?', (value,))
+            row = c.fetchone()
+            if row:
+                resolved[value] = row[0]
+    finally:
+        conn.close()
+    return resolved
+
+
+def _parse_file(path, user_id):
+    """Werkproces: lees en normaliseer één bestand. Geeft (pad, records, fout, seconden) terug."""
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            records = parse_csv_records(f.read(), user_id)
+        return path, records, None, time.perf_counter() - start
+    except Exception as e:
+        return path, None, str(e), time.perf_counter() - start
+
+
+def _write_batch(c, user_id, files, overwrite):
+    """Schrijfopdracht voor een reeks geparste bestanden van één gebruiker; elk bestand krijgt een savepoint."""
+    results = {}
+    for index, (path, records) in enumerate(files):
+        c.execute('SAVEPOINT import_file')
+        try:
+            _, count, _ = import_records(c, user_id, records, overwrite=overwrite and index == 0)
+            c.execute('RELEASE import_file')
+            results[path] = (count, None)
+        except Exception as e:
+            c.execute('ROLLBACK TO import_file')
+            c.execute('RELEASE import_file')
+            results[path] = (0, str(e))
+    return results
+
+
+def batch_import(paths, user_map=None, default_user=None, workers=None, overwrite=False,
+                 batch_rows=IMPORT_BATCH_ROWS):
+    """Importeer veel CSV-bestanden tegelijk: parsen in een procespool, schrijven in grote transacties.
+
+    Parsen (pandas) gebeurt parallel in werkprocessen met dezelfde kolomkoppeling en opschoning als een upload;
+    het hoofdproces verzamelt de records per gebruiker en schrijft ze per batch_rows rijen in één transactie
+    via de schrijfwachtrij van de juiste shard, terwijl de pool verder parst. Met overwrite worden de bestaande
+    boeken van een gebruiker één keer vervangen, bij zijn eerste bestand.
+
+    Geeft (rapport, totalen) terug: per bestand een dict met path, user_id, rows, inserted, error en
+    parse_seconds, en de totalen files, rows, inserted, errors en seconds.
+    """
+    start = time.perf_counter()
+    user_map = user_map or {}
+    report = {path: {'path': path, 'user_id': None, 'rows': 0, 'inserted': 0, 'error': None, 'parse_seconds': 0.0}
+              for path in paths}
+
+    wanted = {path: _mapped_user(user_map, path) or default_user for path in paths}
+    users = _resolve_users({value for value in wanted.values() if value is not None})
+    jobs = []
+    for path in paths:
+        if wanted[path] is None:
+            report[path]['error'] = "Geen gebruiker opgegeven voor dit bestand"
+        elif wanted[path] not in users:
+            report[path]['error'] = f"Gebruiker {wanted[path]} bestaat niet"
+        else:
+            report[path]['user_id'] = users[wanted[path]]
+            jobs.append((path, users[wanted[path]]))
+
+    pending = {}
+    replaced = set()
+
+    def flush(user_id):
+        files = pending.pop(user_id, [])
+        if not files:
+            return
+        first = overwrite and user_id not in replaced
+        replaced.add(user_id)
+        try:
+            # Geen time-out: een grote batch mag langer duren dan een gewone schrijfopdracht
+            results = run_user_write(user_id, lambda c: _write_batch(c, user_id, files, first), timeout=None)
+        except Exception as e:
+            results = {path: (0, str(e)) for path, _ in files}
+        for path, (count, error) in results.items():
+            report[path]['inserted'] = count
+            report[path]['error'] = error
+        logger.info(f"Imported batch of {len(files)} files for user {user_id}")
+
+    def collect(result):
+        path, records, error, seconds = result
+        entry = report[path]
+        entry['parse_seconds'] = seconds
+        if error:
+            entry['error'] = error
+            return
+        entry['rows'] = len(records)
+        files = pending.setdefault(entry['user_id'], [])
+        files.append((path, records))
+        if sum(len(file_records) for _, file_records in files) >= batch_rows:
+            flush(entry['user_id'])
+
+    if workers == 1 or len(jobs) <= 1:
+        for path, user_id in jobs:
+            collect(_parse_file(path, user_id))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_parse_file, path, user_id) for path, user_id in jobs]
+            for future in as_completed(futures):
+                collect(future.result())
+    for user_id in list(pending):
+        flush(user_id)
+
+    entries = [report[path] for path in paths]
+    totals = {
+        'files': len(entries),
+        'rows': sum(entry['rows'] for entry in entries),
+        'inserted': sum(entry['inserted'] for entry in entries),
+        'errors': sum(1 for entry in entries if entry['error']),
+        'seconds': time.perf_counter() - start,
+    }
+    logger.info(f"Batch import of {totals['files']} files: {totals['inserted']} books in {totals['seconds']:.2f} s")
+    return entries, totals
@@ -1,8 +1,16 @@
-from .database import get_db_connection
+from .shards import user_connection, run_user_write, run_book_write
+from .catalog import (BOOKS_SELECT, add_holding, update_holding, drop_edition_if_unused, purge_unused_editions,
+                      normalize_isbn, to_isbn13, find_user_holding, bump_revision, normalize_timestamp,
+                      encode_values, storage_column, LOOKUP_FIELDS, HOLDING_FIELDS)
+from .cache import search_cache, normalize_filters, estimate_rows_size, get_collection_revision
+from .duplicates import count_new_duplicates
+from .recommendations import mark_similar_books, invalidate_similar_books
+from .book_record import Book, books_from_cursor
 from datetime import datetime
 import pandas as pd
 from io import StringIO
 import logging
+import json
 
 # Configureer logging
 logging.basicConfig(level=logging.DEBUG)
@@ -10,8 +18,14 @@ logger = logging.getLogger(__name__)
 
 DB_PATH = "books.db"  # Pas aan als je bestand anders heet
 
-def validate_form(form):
-    """Validate form data for text and numeric fields."""
+# Persoonlijke velden die in bulk aangepast mogen worden (gedeelde catalogusvelden niet)
+BULK_EDITABLE_FIELDS = ['genre', 'staat', 'gesigneerd', 'gelezen', 'land', 'prijs']
+
+def validate_form(form, current_isbn=None):
+    """Validate form data for text and numeric fields.
+
+    current_isbn is the stored ISBN when editing: an existing ISBN with a bad check digit may stay as it is.
+    """
     errors = []
     
     # Required text field
@@ -25,6 +39,11 @@ def validate_form(form):
         value = form.get(field, '').strip()
         if value and not isinstance(value, str):
             errors.append(f"{field.replace('_', ' ').title()} moet een tekst zijn!")
+
+    # ISBN moet een geldig ISBN-10 of ISBN-13 zijn (controlecijfer)
+    isbn = form.get('isbn', '').strip()
+    if isbn and not to_isbn13(isbn) and normalize_isbn(isbn) != normalize_isbn(current_isbn):
+        errors.append("ISBN is ongeldig (controlecijfer klopt niet)!")
     
     # Numeric fields
     try:
@@ -56,7 +75,148 @@ def validate_form(form):
     
     return errors
 
-def load_csv_to_db(csv_source, overwrite=False, user_id=None):
+def _duplicates_note(c, user_id, new_ids):
+    flagged = count_new_duplicates(c, user_id, new_ids)
+    return f" ({flagged} mogelijk dubbel, zie Dubbele boeken)" if flagged else ""
+
+# CSV-kolomnamen (zoals in de exports) naar de velden van een boek
+CSV_COLUMN_MAPPING = {
+    'Titel': 'titel', 'titel': 'titel',
+    'Auteur voornaam': 'auteur_voornaam', 'Auteur_voornaam': 'auteur_voornaam', 'auteur voornaam': 'auteur_voornaam',
+    'Auteur achternaam': 'auteur_achternaam', 'Auteur_achternaam': 'auteur_achternaam', 'auteur achternaam': 'auteur_achternaam',
+    'Genre': 'genre', 'genre': 'genre',
+    'Prijs': 'prijs', 'prijs': 'prijs',
+    "Pagina's": 'paginas', "pagina's": 'paginas', 'paginas': 'paginas',
+    'Bindwijze': 'bindwijze', 'bindwijze': 'bindwijze',
+    'Edition': 'edition', 'edition': 'edition',
+    'ISBN': 'isbn', 'isbn': 'isbn',
+    'Reeks nr': 'reeks_nr', 'Reeks_nr': 'reeks_nr', 'reeks nr': 'reeks_nr', 'reeks_nr': 'reeks_nr',
+    'Uitgeverij': 'uitgeverij', 'uitgeverij': 'uitgeverij',
+    'Serie': 'serie', 'serie': 'serie',
+    'Staat': 'staat', 'staat': 'staat',
+    'Taal': 'taal', 'taal': 'taal',
+    'Gesigneerd': 'gesigneerd', 'gesigneerd': 'gesigneerd',
+    'Gelezen': 'gelezen', 'gelezen': 'gelezen',
+    'Land': 'land', 'land': 'land',
+    'User ID': 'user_id', 'user_id': 'user_id'
+}
+
+# Kolommen van een geïmporteerd boek
+CSV_EXPECTED_COLUMNS = ['user_id', 'titel', 'auteur_voornaam', 'auteur_achternaam', 'genre', 'prijs',
+                        'paginas', 'bindwijze', 'edition', 'isbn', 'reeks_nr', 'uitgeverij', 'serie',
+                        'staat', 'taal', 'gesigneerd', 'gelezen', 'added_date', 'land']
+
+def parse_csv_records(data, user_id):
+    """Lees en normaliseer een CSV-bestand (bytes) tot boekrecords (dicts) voor user_id.
+
+    Geeft ValueError met een leesbare melding als het bestand niet te lezen is. Gebruikt geen database,
+    zodat ook een werkproces (zie models.batch_import) het kan doen.
+    """
+    # Try multiple encodings to handle various CSV formats
+    encodings = ['utf-8-sig', 'iso-8859-1', 'windows-1252']
+    df = None
+    for encoding in encodings:
+        try:
+            df = pd.read_csv(StringIO(data.decode(encoding)), sep=None, engine="python")
+            logger.info(f"CSV successfully read with encoding {encoding}")
+            logger.debug(f"CSV columns: {df.columns.tolist()}")
+            logger.debug(f"First few rows: {df.head().to_dict()}")
+            break
+        except UnicodeDecodeError:
+            logger.warning(f"Encoding {encoding} failed")
+            continue
+    if df is None:
+        logger.error("No suitable encoding found for CSV")
+        raise ValueError("Geen geschikte encoding gevonden voor het geüploade CSV-bestand")
+
+    # Clean column names
+    df.columns = [col.replace('\ufeff', '').strip() for col in df.columns]
+    df.columns = [CSV_COLUMN_MAPPING.get(col.strip(), col.lower()) for col in df.columns]
+    logger.debug(f"DataFrame columns after mapping: {df.columns.tolist()}")
+
+    # Check for required columns
+    required_columns = ['titel']
+    missing_required = [col for col in required_columns if col not in df.columns]
+    if missing_required:
+        logger.error(f"Missing required columns: {missing_required}")
+        raise ValueError(f"Fout: Verplichte kolommen ontbreken in het CSV-bestand: {missing_required}")
+
+    # Add missing columns with default values
+    for col in CSV_EXPECTED_COLUMNS:
+        if col not in df.columns:
+            df[col] = '' if col not in ['user_id', 'prijs', 'paginas', 'reeks_nr'] else 0
+    # Boeken zonder (leesbare) toevoegdatum krijgen het moment van importeren
+    import_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    df['added_date'] = df['added_date'].map(normalize_timestamp).fillna(import_time)
+    logger.debug(f"DataFrame columns after adding missing: {df.columns.tolist()}")
+
+    # Filter DataFrame to only include expected columns
+    df = df[CSV_EXPECTED_COLUMNS]
+    logger.debug(f"DataFrame columns after filtering: {df.columns.tolist()}")
+
+    # Type conversions and data cleaning
+    # Ontdubbelen op de ISBN-13 sleutel; zonder ISBN op titel
+    isbn_keys = df['isbn'].map(normalize_isbn)
+    dedup_keys = isbn_keys.where(isbn_keys != '', 'titel:' + df['titel'].astype(str))
+    df = df[~dedup_keys.duplicated(keep="first")]
+    logger.debug(f"After deduplication, DataFrame has {len(df)} rows")
+    if "prijs" in df.columns:
+        df['prijs'] = df['prijs'].replace({r'€': '', r'\,': '.'}, regex=True)
+        df['prijs'] = pd.to_numeric(df['prijs'], errors='coerce').fillna(0).astype(float)
+    if "paginas" in df.columns:
+        df['paginas'] = pd.to_numeric(df['paginas'], errors='coerce').fillna(0).astype(int)
+    if "reeks_nr" in df.columns:
+        df['reeks_nr'] = pd.to_numeric(df['reeks_nr'], errors='coerce').fillna(0).astype(int)
+
+    # Always set user_id to the logged-in user's ID, ignoring any user_id in the CSV
+    df['user_id'] = int(user_id)
+    logger.debug(f"DataFrame dtypes: {df.dtypes}")
+
+    # Lege cellen als NULL opslaan, net zoals voorheen via to_sql
+    return df.astype(object).where(pd.notnull(df), None).to_dict('records')
+
+def import_records(c, user_id, records, overwrite=False, flag_duplicates=False):
+    """Schrijf geparste records weg als schrijfopdracht; geeft (vervangen, aantal nieuw, melding) terug.
+
+    Zonder overwrite worden boeken die de gebruiker al heeft (zelfde ISBN, of zelfde titel zonder ISBN)
+    overgeslagen.
+    """
+    records = [Book(**record) for record in records]
+    c.execute('SELECT COUNT(*) FROM holdings WHERE user_id = ?', (user_id,))
+    existing_count = c.fetchone()[0]
+    logger.debug(f"Existing books for user {user_id}: {existing_count}")
+
+    if overwrite and existing_count > 0:
+        c.execute('SELECT DISTINCT edition_id FROM holdings WHERE user_id = ?', (user_id,))
+        old_editions = [row[0] for row in c.fetchall()]
+        c.execute('DELETE FROM holdings WHERE user_id = ?', (user_id,))
+        for edition_id in old_editions:
+            drop_edition_if_unused(c, edition_id)
+        invalidate_similar_books(c, user_id)
+        logger.info(f"Deleted {existing_count} existing books for user {user_id}")
+        existing_count = 0
+
+    if existing_count == 0:
+        new_ids = [add_holding(c, record) for record in records]
+    else:
+        new_ids = []
+        for record in records:
+            logger.debug(f"Processing row: {record}")
+            if normalize_isbn(record['isbn']):
+                exists = find_user_holding(c, user_id, record['isbn']) is not None
+            else:
+                c.execute('''SELECT COUNT(*) FROM books WHERE titel = ? AND user_id = ? AND (isbn IS NULL OR isbn = '')''', 
+                          (record['titel'], int(record['user_id'])))
+                exists = c.fetchone()[0] > 0
+            if not exists:
+                new_ids.append(add_holding(c, record))
+    # Exacte dubbels zijn hierboven al overgeslagen; bijna-dubbels (spaties, varianten) enkel melden
+    note = _duplicates_note(c, user_id, new_ids) if flag_duplicates else ""
+    mark_similar_books(c, user_id, new_ids)
+    bump_revision(c, user_id)
+    return existing_count == 0, len(new_ids), note
+
+def load_csv_to_db(csv_source, overwrite=False, user_id=None, flag_duplicates=False):
     logger.debug(f"Starting CSV import for user_id: {user_id}, overwrite: {overwrite}")
     try:
         if not hasattr(csv_source, 'read'):
@@ -66,155 +226,49 @@ def load_csv_to_db(csv_source, overwrite=False, user_id=None):
         if user_id is None:
             logger.error("No user_id provided")
             return False, "Gebruiker-ID is verplicht voor CSV-import."
-        
-        # Try multiple encodings to handle various CSV formats
-        encodings = ['utf-8-sig', 'iso-8859-1', 'windows-1252']
-        df = None
-        for encoding in encodings:
-            try:
-                csv_source.seek(0)
-                df = pd.read_csv(StringIO(csv_source.read().decode(encoding)), sep=None, engine="python")
-                logger.info(f"CSV successfully read with encoding {encoding}")
-                logger.debug(f"CSV columns: {df.columns.tolist()}")
-                logger.debug(f"First few rows: {df.head().to_dict()}")
-                break
-            except UnicodeDecodeError:
-                logger.warning(f"Encoding {encoding} failed")
-                continue
-        if df is None:
-            logger.error("No suitable encoding found for CSV")
-            return False, "Geen geschikte encoding gevonden voor het geüploade CSV-bestand"
-
-        # Clean column names
-        df.columns = [col.replace('\ufeff', '').strip() for col in df.columns]
-        column_mapping = {
-            'Titel': 'titel', 'titel': 'titel',
-            'Auteur voornaam': 'auteur_voornaam', 'Auteur_voornaam': 'auteur_voornaam', 'auteur voornaam': 'auteur_voornaam',
-            'Auteur achternaam': 'auteur_achternaam', 'Auteur_achternaam': 'auteur_achternaam', 'auteur achternaam': 'auteur_achternaam',
-            'Genre': 'genre', 'genre': 'genre',
-            'Prijs': 'prijs', 'prijs': 'prijs',
-            "Pagina's": 'paginas', "pagina's": 'paginas', 'paginas': 'paginas',
-            'Bindwijze': 'bindwijze', 'bindwijze': 'bindwijze',
-            'Edition': 'edition', 'edition': 'edition',
-            'ISBN': 'isbn', 'isbn': 'isbn',
-            'Reeks nr': 'reeks_nr', 'Reeks_nr': 'reeks_nr', 'reeks nr': 'reeks_nr', 'reeks_nr': 'reeks_nr',
-            'Uitgeverij': 'uitgeverij', 'uitgeverij': 'uitgeverij',
-            'Serie': 'serie', 'serie': 'serie',
-            'Staat': 'staat', 'staat': 'staat',
-            'Taal': 'taal', 'taal': 'taal',
-            'Gesigneerd': 'gesigneerd', 'gesigneerd': 'gesigneerd',
-            'Gelezen': 'gelezen', 'gelezen': 'gelezen',
-            'Land': 'land', 'land': 'land',
-            'User ID': 'user_id', 'user_id': 'user_id'
-        }
-        
-        df.columns = [column_mapping.get(col.strip(), col.lower()) for col in df.columns]
-        logger.debug(f"DataFrame columns after mapping: {df.columns.tolist()}")
-
-        # Check for required columns
-        required_columns = ['titel']
-        missing_required = [col for col in required_columns if col not in df.columns]
-        if missing_required:
-            logger.error(f"Missing required columns: {missing_required}")
-            return False, f"Fout: Verplichte kolommen ontbreken in het CSV-bestand: {missing_required}"
-        
-        # Define expected columns for the books table
-        expected_columns = ['user_id', 'titel', 'auteur_voornaam', 'auteur_achternaam', 'genre', 'prijs', 
-                            'paginas', 'bindwijze', 'edition', 'isbn', 'reeks_nr', 'uitgeverij', 'serie', 
-                            'staat', 'taal', 'gesigneerd', 'gelezen', 'added_date', 'land']
-        
-        # Add missing columns with default values
-        for col in expected_columns:
-            if col not in df.columns:
-                df[col] = '' if col not in ['user_id', 'prijs', 'paginas', 'reeks_nr'] else 0
-        logger.debug(f"DataFrame columns after adding missing: {df.columns.tolist()}")
-
-        # Filter DataFrame to only include expected columns
-        df = df[expected_columns]
-        logger.debug(f"DataFrame columns after filtering: {df.columns.tolist()}")
-
-        # Type conversions and data cleaning
-        df = df.drop_duplicates(subset=["titel", "isbn"], keep="first")
-        logger.debug(f"After deduplication, DataFrame has {len(df)} rows")
-        if "prijs" in df.columns:
-            df['prijs'] = df['prijs'].replace({r'€': '', r'\,': '.'}, regex=True)
-            df['prijs'] = pd.to_numeric(df['prijs'], errors='coerce').fillna(0).astype(float)
-        if "paginas" in df.columns:
-            df['paginas'] = pd.to_numeric(df['paginas'], errors='coerce').fillna(0).astype(int)
-        if "reeks_nr" in df.columns:
-            df['reeks_nr'] = pd.to_numeric(df['reeks_nr'], errors='coerce').fillna(0).astype(int)
-        if 'added_date' not in df.columns:
-            df['added_date'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Always set user_id to the logged-in user's ID, ignoring any user_id in the CSV
-        df['user_id'] = int(user_id)
-        logger.debug(f"DataFrame dtypes: {df.dtypes}")
-        logger.debug(f"Sample paginas values: {df['paginas'].head().tolist()}")
-        logger.debug(f"Sample user_id values: {df['user_id'].head().tolist()}")
-
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM books WHERE user_id = ?', (user_id,))
-        existing_count = c.fetchone()[0]
-        logger.debug(f"Existing books for user {user_id}: {existing_count}")
-        
-        if overwrite and existing_count > 0:
-            c.execute('DELETE FROM books WHERE user_id = ?', (user_id,))
-            logger.info(f"Deleted {existing_count} existing books for user {user_id}")
-            existing_count = 0
-        
-        if existing_count == 0 or overwrite:
-            df.to_sql('books', conn, if_exists='append', index=False)
-            conn.commit()
-            logger.info(f"Inserted {len(df)} books for user {user_id}")
-            conn.close()
-            return True, f"Succes: {len(df)} boeken geïmporteerd"
-        else:
-            inserted_count = 0
-            for _, row in df.iterrows():
-                logger.debug(f"Processing row: {row.to_dict()}")
-                c.execute('''SELECT COUNT(*) FROM books WHERE titel = ? AND isbn = ? AND user_id = ?''', 
-                          (row['titel'], row['isbn'], int(row['user_id'])))
-                if c.fetchone()[0] == 0:
-                    c.execute('''INSERT INTO books (user_id, titel, auteur_voornaam, auteur_achternaam, genre, prijs, paginas, bindwijze, edition, isbn, reeks_nr, uitgeverij, serie, staat, taal, gesigneerd, gelezen, added_date, land)
-                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', 
-                                 (int(row['user_id']), row['titel'], row['auteur_voornaam'], row['auteur_achternaam'], 
-                                  row['genre'], float(row['prijs']), int(row['paginas']), row['bindwijze'], 
-                                  row['edition'], row['isbn'], int(row['reeks_nr']) if pd.notnull(row['reeks_nr']) else 0, 
-                                  row['uitgeverij'], row['serie'], row['staat'], row['taal'], row['gesigneerd'], 
-                                  row['gelezen'], row['added_date'], row['land']))
-                    inserted_count += 1
-            conn.commit()
-            logger.info(f"Inserted {inserted_count} new books for user {user_id}")
-            conn.close()
-            return True, f"Succes: {inserted_count} nieuwe boeken toegevoegd uit CSV"
+
+        csv_source.seek(0)
+        try:
+            records = parse_csv_records(csv_source.read(), user_id)
+        except ValueError as e:
+            return False, str(e)
+
+        replaced, inserted_count, note = run_user_write(
+            user_id, lambda c: import_records(c, user_id, records, overwrite, flag_duplicates))
+        logger.info(f"Inserted {inserted_count} books for user {user_id}")
+        if replaced:
+            return True, f"Succes: {inserted_count} boeken geïmporteerd{note}"
+        return True, f"Succes: {inserted_count} nieuwe boeken toegevoegd uit CSV{note}"
     except Exception as e:
         logger.error(f"Error during CSV import: {str(e)}")
         return False, f"Fout bij importeren: {str(e)}"
 
-def search_books(filters, user_id=None):
-    logger.debug(f"Searching books for user_id: {user_id}, filters: {filters}")
-    if user_id is None:
-        logger.error("No user_id provided for search")
-        return []
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    query = 'SELECT * FROM books WHERE user_id = ?'
+def build_search_filter(filters, user_id):
+    """Bouw de WHERE-clausule en parameters voor een zoekopdracht over holdings h + editions e."""
+    query = 'h.user_id = ?'
     params = [user_id]
     
     # Text-based filters
     for col in ['titel', 'auteur_voornaam', 'auteur_achternaam', 'genre', 'uitgeverij', 'isbn', 
                 'serie', 'staat', 'taal', 'gesigneerd', 'gelezen', 'bindwijze', 'edition', 'land']:
         value = filters.get(col, '').strip()
-        if value:
-            query += f" AND {col} LIKE ?"
+        if col == 'isbn' and to_isbn13(value):
+            # Volledig ISBN: geïndexeerde gelijkheid op de ISBN-13 i.p.v. een LIKE-scan
+            query += " AND e.isbn13 = ?"
+            params.append(to_isbn13(value))
+        elif value and col in LOOKUP_FIELDS:
+            # LIKE op de kleine lookup-tabel, daarna een integer-vergelijking per rij
+            table = 'h' if col in HOLDING_FIELDS else 'e'
+            query += f" AND {table}.{storage_column(col)} IN (SELECT id FROM lookup_values WHERE field = ? AND value LIKE ?)"
+            params += [col, f'%{value}%']
+        elif value:
+            query += f" AND e.{col} LIKE ?"
             params.append(f'%{value}%')
     
     # Numeric filter for reeks_nr
     if 'reeks_nr' in filters and filters['reeks_nr'].strip():
         try:
-            query += " AND reeks_nr = ?"
+            query += " AND e.reeks_nr = ?"
             params.append(int(float(filters['reeks_nr'])))  # Handle float-like strings
         except ValueError:
             logger.warning(f"Invalid reeks_nr value: {filters['reeks_nr']}")
@@ -225,22 +279,72 @@ def search_books(filters, user_id=None):
         if range_col in filters and filters[range_col].strip():
             try:
                 operator = '>=' if 'min' in range_col else '<='
-                query += f" AND {col_name} {operator} ?"
+                query += f" AND {'h' if col_name == 'prijs' else 'e'}.{col_name} {operator} ?"
                 params.append(float(filters[range_col]) if col_name == 'prijs' else int(float(filters[range_col])))
             except ValueError:
                 logger.warning(f"Invalid {range_col} value: {filters[range_col]}")
                 pass
+    return query, params
+
+def search_books(filters, user_id=None, limit=None, offset=0):
+    logger.debug(f"Searching books for user_id: {user_id}, filters: {filters}, limit: {limit}, offset: {offset}")
+    if user_id is None:
+        logger.error("No user_id provided for search")
+        return []
+    
+    conn = user_connection(user_id)
+    c = conn.cursor()
+    # Cache per gebruiker, filters en collectierevisie: elke wijziging maakt oude resultaten ongeldig
+    cache_key = ('books', user_id, normalize_filters(filters), limit, offset, get_collection_revision(c, user_id))
+    books = search_cache.get(cache_key)
+    if books is not None:
+        conn.close()
+        return books
+
+    # Rechtstreeks over de gedeelde catalogus (holdings + editions)
+    where, params = build_search_filter(filters, user_id)
+    query = f'{BOOKS_SELECT} WHERE {where} ORDER BY genre ASC, auteur_achternaam ASC, reeks_nr ASC, id ASC'
+    if limit is not None:
+        query += ' LIMIT ? OFFSET ?'
+        params += [int(limit), int(offset)]
     
     try:
-        c.execute(query + ' ORDER BY genre ASC, auteur_achternaam ASC, reeks_nr ASC', params)
-        books = c.fetchall()
+        c.execute(query, params)
+        books = books_from_cursor(c)
         logger.debug(f"Retrieved {len(books)} books for user {user_id}")
+        search_cache.put(cache_key, books, estimate_rows_size(books))
     except Exception as e:
         logger.error(f"Database error during search: {str(e)}")
         books = []
     conn.close()
     return books
 
+def search_totals(filters, user_id=None):
+    """Aantal boeken, totaalprijs en totaal pagina's voor een zoekopdracht, berekend in SQL."""
+    totals = {'total': 0, 'total_price': 0.0, 'total_pages': 0}
+    if user_id is None:
+        return totals
+    
+    conn = user_connection(user_id)
+    c = conn.cursor()
+    cache_key = ('totals', user_id, normalize_filters(filters), get_collection_revision(c, user_id))
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        conn.close()
+        return cached
+
+    where, params = build_search_filter(filters, user_id)
+    try:
+        c.execute(f'''SELECT COUNT(*), COALESCE(SUM(h.prijs), 0), COALESCE(SUM(e.paginas), 0)
+                      FROM holdings h JOIN editions e ON e.id = h.edition_id WHERE {where}''', params)
+        count, price, pages = c.fetchone()
+        totals = {'total': count, 'total_price': round(float(price), 2), 'total_pages': int(pages)}
+        search_cache.put(cache_key, totals, 256)
+    except Exception as e:
+        logger.error(f"Database error during search totals: {str(e)}")
+    conn.close()
+    return totals
+
 def add_book(form):
     logger.debug(f"Adding book with form data: {form}")
     errors = validate_form(form)
@@ -258,41 +362,19 @@ def add_book(form):
         logger.error(f"Invalid user_id: {user_id}")
         return False, "Ongeldige Gebruiker-ID!"
     
-    data = {
-        'user_id': user_id,
-        'titel': form.get('titel', '').strip(),
-        'auteur_voornaam': form.get('auteur_voornaam', '').strip(),
-        'auteur_achternaam': form.get('auteur_achternaam', '').strip(),
-        'genre': form.get('genre', '').strip(),
-        'prijs': float(form.get('prijs', '0.0')) if form.get('prijs', '').strip() else 0.0,
-        'paginas': int(float(form.get('paginas', '0'))) if form.get('paginas', '').strip() else 0,
-        'bindwijze': form.get('bindwijze', '').strip(),
-        'edition': form.get('edition', '').strip(),
-        'isbn': form.get('isbn', '').strip(),
-        'reeks_nr': int(float(form.get('reeks_nr', '0'))) if form.get('reeks_nr', '').strip() else 0,
-        'uitgeverij': form.get('uitgeverij', '').strip(),
-        'serie': form.get('serie', '').strip(),
-        'staat': form.get('staat', '').strip(),
-        'taal': form.get('taal', '').strip(),
-        'gesigneerd': form.get('gesigneerd', '').strip(),
-        'gelezen': form.get('gelezen', '').strip(),
-        'added_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'land': form.get('land', '').strip()
-    }
+    data = Book.from_form(form, user_id=user_id)
+    
+    def write(c):
+        book_id = add_holding(c, data)
+        mark_similar_books(c, user_id, [book_id])
+        bump_revision(c, user_id)
     
-    conn = get_db_connection()
-    c = conn.cursor()
     try:
-        c.execute('''INSERT INTO books (user_id, titel, auteur_voornaam, auteur_achternaam, genre, prijs, paginas, bindwijze, edition, isbn, reeks_nr, uitgeverij, serie, staat, taal, gesigneerd, gelezen, added_date, land)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                  tuple(data.values()))
-        conn.commit()
-        logger.info(f"Book added successfully for user {user_id}: {data['titel']}")
-        conn.close()
+        run_user_write(user_id, write)
+        logger.info(f"Book added successfully for user {user_id}: {data.titel}")
         return True, "Boek succesvol toegevoegd!"
     except Exception as e:
         logger.error(f"Error adding book: {str(e)}")
-        conn.close()
         return False, f"Fout bij toevoegen boek: {str(e)}"
 
 def edit_book(book_id, form):
@@ -301,10 +383,6 @@ def edit_book(book_id, form):
         logger.error("No book_id provided")
         return False, "Geen boek-ID opgegeven!"
     
-    errors = validate_form(form)
-    if errors:
-        return False, " | ".join(errors)
-    
     user_id = form.get('user_id')
     if not user_id:
         logger.error("Missing user_id in form")
@@ -316,68 +394,135 @@ def edit_book(book_id, form):
         logger.error(f"Invalid user_id: {user_id}")
         return False, "Ongeldige Gebruiker-ID!"
     
-    data = {
-        'titel': form.get('titel', '').strip(),
-        'auteur_voornaam': form.get('auteur_voornaam', '').strip(),
-        'auteur_achternaam': form.get('auteur_achternaam', '').strip(),
-        'genre': form.get('genre', '').strip(),
-        'prijs': float(form.get('prijs', '0.0')) if form.get('prijs', '').strip() else 0.0,
-        'paginas': int(float(form.get('paginas', '0'))) if form.get('paginas', '').strip() else 0,
-        'bindwijze': form.get('bindwijze', '').strip(),
-        'edition': form.get('edition', '').strip(),
-        'isbn': form.get('isbn', '').strip(),
-        'reeks_nr': int(float(form.get('reeks_nr', '0'))) if form.get('reeks_nr', '').strip() else 0,
-        'uitgeverij': form.get('uitgeverij', '').strip(),
-        'serie': form.get('serie', '').strip(),
-        'staat': form.get('staat', '').strip(),
-        'taal': form.get('taal', '').strip(),
-        'gesigneerd': form.get('gesigneerd', '').strip(),
-        'gelezen': form.get('gelezen', '').strip(),
-        'added_date': form.get('added_date', '') or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'land': form.get('land', '').strip()
-    }
+    # Het opgeslagen ISBN: een oud ISBN met een fout controlecijfer blokkeert het bewerken niet
+    conn = user_connection(user_id)
+    current = conn.execute('''SELECT e.isbn FROM holdings h JOIN editions e ON e.id = h.edition_id
+                              WHERE h.id = ? AND h.user_id = ?''', (book_id, user_id)).fetchone()
+    conn.close()
+    current_isbn = current['isbn'] if current else None
+    errors = validate_form(form, current_isbn=current_isbn)
+    if errors:
+        return False, " | ".join(errors)
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    try:
-        c.execute('SELECT * FROM books WHERE id = ? AND user_id = ?', (book_id, user_id))
+    added_date = form.get('added_date', '').strip()
+    data = Book.from_form(form, user_id=user_id, added_date=added_date)
+    
+    def write(c):
+        c.execute('SELECT edition_id, added_date FROM holdings WHERE id = ? AND user_id = ?', (book_id, user_id))
         book = c.fetchone()
         if not book:
+            return False
+        if not added_date:
+            # Het formulier stuurt geen datum mee: de oorspronkelijke toevoegdatum blijft staan (ook als die onbekend is)
+            data.added_date = book['added_date']
+        update_holding(c, book_id, book['edition_id'], data)
+        mark_similar_books(c, user_id, [book_id])
+        bump_revision(c, user_id)
+        return True
+    
+    try:
+        if not run_user_write(user_id, write):
             logger.error(f"Book with ID {book_id} not found for user {user_id}")
-            conn.close()
             return False, f"Boek met ID {book_id} niet gevonden of geen rechten!"
-        c.execute('''UPDATE books SET titel = ?, auteur_voornaam = ?, auteur_achternaam = ?, genre = ?, prijs = ?, paginas = ?, bindwijze = ?, edition = ?, isbn = ?, reeks_nr = ?, uitgeverij = ?, serie = ?, staat = ?, taal = ?, gesigneerd = ?, gelezen = ?, added_date = ?, land = ?
-                     WHERE id = ?''', tuple(data.values()) + (book_id,))
-        conn.commit()
         logger.info(f"Book {book_id} updated successfully for user {user_id}")
-        conn.close()
+        if data.isbn and not to_isbn13(data.isbn):
+            return True, "Boek succesvol bijgewerkt! Let op: het ISBN heeft een ongeldig controlecijfer."
         return True, "Boek succesvol bijgewerkt!"
     except Exception as e:
         logger.error(f"Error updating book {book_id}: {str(e)}")
-        conn.close()
         return False, f"Fout bij bijwerken boek: {str(e)}"
 
 def delete_book(book_id):
     logger.debug(f"Deleting book {book_id}")
-    conn = get_db_connection()
-    c = conn.cursor()
-    try:
-        c.execute('SELECT * FROM books WHERE id = ?', (book_id,))
+    def write(c):
+        c.execute('SELECT edition_id, user_id FROM holdings WHERE id = ?', (book_id,))
         book = c.fetchone()
         if not book:
+            return False
+        c.execute('DELETE FROM holdings WHERE id = ?', (book_id,))
+        drop_edition_if_unused(c, book['edition_id'])
+        mark_similar_books(c, book['user_id'], [book_id])
+        bump_revision(c, book['user_id'])
+        return True
+    
+    try:
+        if not run_book_write(book_id, write):
             logger.error(f"Book with ID {book_id} not found")
-            conn.close()
             return False, f"Boek met ID {book_id} niet gevonden!"
-        c.execute('DELETE FROM books WHERE id = ?', (book_id,))
-        if c.rowcount == 0:
-            logger.error(f"No book deleted for ID {book_id}")
-            conn.close()
-            return False, f"Geen boek verwijderd voor ID {book_id}!"
-        conn.commit()
         logger.info(f"Book {book_id} deleted successfully")
-        conn.close()
         return True, "Boek succesvol verwijderd!"
     except Exception as e:
         logger.error(f"Database error during deletion: {str(e)}")
-        conn.close()
-        return False, f"Databasefout bij verwijderen: {str(e)}"
\ No newline at end of file
+        return False, f"Databasefout bij verwijderen: {str(e)}"
+
+def _bulk_selection(user_id, book_ids=None, filters=None):
+    """SQL-voorwaarde op holdings voor een lijst id's of een search_books-filter, altijd binnen de gebruiker."""
+    if book_ids is not None:
+        ids = [int(book_id) for book_id in book_ids]
+        return 'user_id = ? AND id IN (SELECT value FROM json_each(?))', [user_id, json.dumps(ids)]
+    where, params = build_search_filter(filters or {}, user_id)
+    return (f'''user_id = ? AND id IN (SELECT h.id FROM holdings h JOIN editions e ON e.id = h.edition_id
+                                     WHERE {where})''', [user_id] + params)
+
+def bulk_delete_books(user_id, book_ids=None, filters=None):
+    """Verwijder alle geselecteerde boeken van een gebruiker in één statement en één transactie."""
+    logger.debug(f"Bulk delete for user {user_id}: ids={book_ids}, filters={filters}")
+    if not user_id:
+        return False, "Gebruiker-ID is verplicht!", 0
+    if book_ids is None and filters is None:
+        return False, "Geef boek-ID's of een filter op!", 0
+    
+    def write(c):
+        selection, params = _bulk_selection(user_id, book_ids, filters)
+        c.execute(f'DELETE FROM holdings WHERE {selection}', params)
+        deleted = c.rowcount
+        purge_unused_editions(c)
+        if deleted:
+            invalidate_similar_books(c, user_id)
+            bump_revision(c, user_id)
+        return deleted
+    
+    try:
+        deleted = run_user_write(user_id, write)
+        logger.info(f"Bulk deleted {deleted} books for user {user_id}")
+        return True, f"{deleted} boeken verwijderd!", deleted
+    except Exception as e:
+        logger.error(f"Database error during bulk delete: {str(e)}")
+        return False, f"Databasefout bij verwijderen: {str(e)}", 0
+
+def bulk_update_books(user_id, updates, book_ids=None, filters=None):
+    """Zet dezelfde waarden voor alle geselecteerde boeken van een gebruiker in één UPDATE."""
+    logger.debug(f"Bulk update for user {user_id}: updates={updates}, ids={book_ids}, filters={filters}")
+    if not user_id:
+        return False, "Gebruiker-ID is verplicht!", 0
+    if book_ids is None and filters is None:
+        return False, "Geef boek-ID's of een filter op!", 0
+    
+    invalid = [field for field in updates if field not in BULK_EDITABLE_FIELDS]
+    if invalid or not updates:
+        return False, f"Alleen deze velden kunnen in bulk aangepast worden: {', '.join(BULK_EDITABLE_FIELDS)}", 0
+    values = {field: str(value).strip() for field, value in updates.items()}
+    if 'prijs' in values:
+        try:
+            values['prijs'] = float(values['prijs'].replace(',', '.')) if values['prijs'] else 0.0
+        except ValueError:
+            return False, "Prijs moet een geldig getal zijn (bijv. 12.50)!", 0
+    
+    def write(c):
+        selection, params = _bulk_selection(user_id, book_ids, filters)
+        columns = encode_values(c, values)
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        c.execute(f'UPDATE holdings SET {assignments} WHERE {selection}', list(columns.values()) + params)
+        updated = c.rowcount
+        if updated:
+            invalidate_similar_books(c, user_id)
+            bump_revision(c, user_id)
+        return updated
+    
+    try:
+        updated = run_user_write(user_id, write)
+        logger.info(f"Bulk updated {updated} books for user {user_id}: {values}")
+        return True, f"{updated} boeken bijgewerkt!", updated
+    except Exception as e:
+        logger.error(f"Database error during bulk update: {str(e)}")
+        return False, f"Fout bij bijwerken boeken: {str(e)}", 0
@@ -0,0 +1,121 @@
+from .catalog import BOOK_COLUMNS
+from datetime import datetime
+from operator import itemgetter
+import logging
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is optioneel: alleen sneller, dezelfde uitvoer
+    orjson = None
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Tekstvelden uit het boekformulier (leeg = lege string)
+FORM_TEXT_FIELDS = ['titel', 'auteur_voornaam', 'auteur_achternaam', 'genre', 'bindwijze', 'edition', 'isbn',
+                    'uitgeverij', 'serie', 'staat', 'taal', 'gesigneerd', 'gelezen', 'land']
+
+# Per kolomvolgorde van een query (cursor.description) één keer de leesfunctie opbouwen
+_readers = {}
+
+
+class Book:
+    """Eén boekenrij van de 'books' view met vaste velden; __slots__ houdt elk exemplaar klein.
+
+    Ondersteunt book.titel, book['titel'] en book[1] (zelfde volgorde als BOOK_COLUMNS), zodat templates
+    en oudere code die een sqlite3.Row verwachtten blijven werken.
+    """
+
+    __slots__ = tuple(BOOK_COLUMNS)
+    FIELDS = tuple(BOOK_COLUMNS)
+    # Velden in een CSV-export: alles behalve de interne id's
+    EXPORT_FIELDS = tuple(field for field in BOOK_COLUMNS if field not in ('id', 'user_id'))
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def from_values(cls, values):
+        """Maak een Book uit waarden in BOOK_COLUMNS-volgorde, zonder tussenliggende dict."""
+        book = cls.__new__(cls)
+        for field, value in zip(cls.FIELDS, values):
+            setattr(book, field, value)
+        return book
+
+    @classmethod
+    def from_form(cls, form, user_id=None, added_date=None):
+        """Lees en normaliseer een (gevalideerd) boekformulier; lege getallen worden 0."""
+        values = {field: form.get(field, '').strip() for field in FORM_TEXT_FIELDS}
+        values['prijs'] = float(form.get('prijs', '0.0')) if form.get('prijs', '').strip() else 0.0
+        values['paginas'] = int(float(form.get('paginas', '0'))) if form.get('paginas', '').strip() else 0
+        values['reeks_nr'] = int(float(form.get('reeks_nr', '0'))) if form.get('reeks_nr', '').strip() else 0
+        values['added_date'] = added_date or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        values['user_id'] = user_id
+        return cls(**values)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return getattr(self, self.FIELDS[key])
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+    def keys(self):
+        return self.FIELDS
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __repr__(self):
+        return f"Book(id={self.id!r}, titel={self.titel!r})"
+
+    def to_dict(self, **extra):
+        values = {field: getattr(self, field) for field in self.FIELDS}
+        values.update(extra)
+        return values
+
+
+def _reader(description):
+    """Functie die een rij met deze kolommen omzet naar de waarden in BOOK_COLUMNS-volgorde."""
+    names = tuple(column[0] for column in description)
+    reader = _readers.get(names)
+    if reader is None:
+        positions = [names.index(field) if field in names else None for field in Book.FIELDS]
+        if None not in positions:
+            reader = itemgetter(*positions)
+        else:
+            reader = lambda row: [row[position] if position is not None else None for position in positions]
+        _readers[names] = reader
+    return reader
+
+
+def books_from_cursor(c):
+    """Alle resterende rijen van een uitgevoerde query als Book-objecten."""
+    reader = _reader(c.description)
+    return [Book.from_values(reader(row)) for row in c.fetchall()]
+
+
+def book_from_cursor(c):
+    row = c.fetchone()
+    return Book.from_values(_reader(c.description)(row)) if row is not None else None
+
+
+def dumps(value):
+    """JSON als bytes; met orjson indien geïnstalleerd, anders compacte standaard-json."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def books_to_json(books, **extra):
+    """Serialiseer een lijst boeken (plus vaste extra velden per boek) naar JSON-bytes."""
+    return dumps([book.to_dict(**extra) for book in books])
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import threading
+import logging
+import os
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Alle caches van dit proces, voor de statistiekenpagina
+_registry = []
+
+
+class LRUCache:
+    """Thread-safe LRU-cache, begrensd op aantal entries én (geschat) aantal bytes."""
+
+    def __init__(self, name, max_entries, max_bytes):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _registry.append(self)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def discard_where(self, predicate):
+        """Verwijder alle entries waarvan de waarde aan predicate voldoet."""
+        with self._lock:
+            for key in [key for key, (value, _) in self._entries.items() if predicate(value)]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def all_cache_stats():
+    return [cache.stats() for cache in _registry]
+
+
+def estimate_rows_size(rows):
+    """Ruwe schatting van het geheugengebruik van een lijst boekenrijen."""
+    return 64 + sum(64 + sum(len(str(value)) for value in row) for row in rows)
+
+
+def normalize_filters(filters):
+    """Vaste, hashbare vorm van zoekfilters: lege waarden weg, gesorteerd op veldnaam."""
+    return tuple(sorted((key, str(value).strip()) for key, value in filters.items() if str(value).strip()))
+
+
+def get_collection_revision(c, user_id):
+    """Huidige revisie van de collectie van een gebruiker (primaire-sleutel lookup)."""
+    c.execute('SELECT rev FROM collection_revisions WHERE user_id = ?', (user_id,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+search_cache = LRUCache('search',
+                        max_entries=int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 512)),
+                        max_bytes=int(os.environ.get('SEARCH_CACHE_MAX_BYTES', 32 * 1024 * 1024)))
+
+stats_cache = LRUCache('statistics',
+                       max_entries=int(os.environ.get('STATS_CACHE_MAX_ENTRIES', 256)),
+                       max_bytes=int(os.environ.get('STATS_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
@@ -0,0 +1,580 @@
+import re
+import logging
+from datetime import datetime
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Bibliografische velden: één keer per editie opgeslagen en gedeeld door alle gebruikers
+EDITION_FIELDS = ['titel', 'auteur_voornaam', 'auteur_achternaam', 'paginas', 'bindwijze', 'edition',
+                  'isbn', 'reeks_nr', 'uitgeverij', 'serie', 'taal']
+
+# Persoonlijke velden: per exemplaar van een gebruiker
+HOLDING_FIELDS = ['genre', 'prijs', 'staat', 'gesigneerd', 'gelezen', 'added_date', 'land']
+
+# Kolomvolgorde van een boekenrij (de 'books' view)
+BOOK_COLUMNS = ['id', 'titel', 'auteur_voornaam', 'auteur_achternaam', 'genre', 'prijs', 'paginas', 'bindwijze',
+                'edition', 'isbn', 'reeks_nr', 'uitgeverij', 'serie', 'staat', 'taal', 'gesigneerd', 'gelezen',
+                'added_date', 'land', 'user_id']
+
+# Kolommen met weinig verschillende waarden: opgeslagen als integer-code naar lookup_values
+LOOKUP_FIELDS = ['genre', 'staat', 'gesigneerd', 'gelezen', 'land', 'bindwijze', 'edition', 'taal']
+
+# Ja/neen-velden: alle gangbare schrijfwijzen worden één waarde
+YES_NO_FIELDS = ['gesigneerd', 'gelezen']
+YES_NO_VALUES = {'ja': 'ja', 'j': 'ja', 'yes': 'ja', 'y': 'ja', 'true': 'ja', '1': 'ja',
+                 'neen': 'neen', 'nee': 'neen', 'n': 'neen', 'no': 'neen', 'false': 'neen', '0': 'neen'}
+
+
+def storage_column(field):
+    """Naam van de kolom waarin een veld in editions/holdings staat."""
+    return f'{field}_code' if field in LOOKUP_FIELDS else field
+
+
+HOLDING_COLUMNS = [storage_column(field) for field in HOLDING_FIELDS]
+EDITION_COLUMNS = [storage_column(field) for field in EDITION_FIELDS]
+
+
+# holdings + editions + één join per lookup-kolom; gedeeld door de view en de zoekqueries
+BOOKS_FROM = 'holdings h JOIN editions e ON e.id = h.edition_id ' + ' '.join(
+    f"LEFT JOIN lookup_values lv_{field} ON lv_{field}.id = {'h' if field in HOLDING_FIELDS else 'e'}.{field}_code"
+    for field in LOOKUP_FIELDS)
+
+# De 'books' view reconstrueert de oude platte boekenrij (zelfde kolomvolgorde als de oude tabel)
+BOOKS_SELECT = f'''SELECT h.id AS id, e.titel AS titel, e.auteur_voornaam AS auteur_voornaam,
+                         e.auteur_achternaam AS auteur_achternaam, lv_genre.value AS genre, h.prijs AS prijs,
+                         e.paginas AS paginas, lv_bindwijze.value AS bindwijze,
+                         lv_edition.value AS edition, e.isbn AS isbn,
+                         e.reeks_nr AS reeks_nr, e.uitgeverij AS uitgeverij, e.serie AS serie,
+                         lv_staat.value AS staat, lv_taal.value AS taal,
+                         lv_gesigneerd.value AS gesigneerd, lv_gelezen.value AS gelezen,
+                         h.added_date AS added_date, lv_land.value AS land, h.user_id AS user_id
+                  FROM {BOOKS_FROM}'''
+
+# added_date wordt altijd als ISO-8601 tekst opgeslagen: sorteerbaar en bruikbaar in SQLite's datumfuncties
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+TIMESTAMP_INPUT_FORMATS = [TIMESTAMP_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d %H:%M:%S.%f',
+                           '%Y-%m-%d', '%d-%m-%Y %H:%M:%S', '%d-%m-%Y', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y']
+# GLOB-patroon van een genormaliseerde timestamp, om oude waarden in SQL te herkennen
+TIMESTAMP_GLOB = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9]'
+
+
+def _strip_isbn(value):
+    if value is None:
+        return ''
+    value = str(value)
+    if value.lower() == 'nan':
+        return ''
+    return re.sub(r'[^0-9X]', '', value.upper())
+
+
+def _isbn13_check_digit(first12):
+    total = sum((1 if i % 2 == 0 else 3) * int(ch) for i, ch in enumerate(first12))
+    return str((10 - total % 10) % 10)
+
+
+def to_isbn13(value):
+    """Zet een ISBN-10 of ISBN-13 om naar een gevalideerde ISBN-13, of None bij een fout controlecijfer."""
+    digits = _strip_isbn(value)
+    if len(digits) == 10 and digits[:9].isdigit():
+        total = sum((10 - i) * (10 if ch == 'X' else int(ch)) for i, ch in enumerate(digits))
+        if total % 11 != 0:
+            return None
+        first12 = '978' + digits[:9]
+        return first12 + _isbn13_check_digit(first12)
+    if len(digits) == 13 and digits.isdigit() and digits[:3] in ('978', '979'):
+        return digits if _isbn13_check_digit(digits[:12]) == digits[12] else None
+    return None
+
+
+def normalize_isbn(value):
+    """Geef de sleutelvorm van een ISBN terug: de ISBN-13 als die geldig is, anders de kale cijfers."""
+    return to_isbn13(value) or _strip_isbn(value)
+
+
+def normalize_timestamp(value):
+    """Zet een datum in een van de gekende formaten om naar ISO-tekst, of None als ze leeg/onleesbaar is."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    value = str(value).strip()
+    if not value or value.lower() in ('nan', 'nat', 'none'):
+        return None
+    for fmt in TIMESTAMP_INPUT_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime(TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+    return None
+
+
+def normalize_lookup_value(field, value):
+    """Vaste schrijfwijze voor een lookup-waarde: witruimte opgekuist, ja/neen eenvormig, leeg wordt None."""
+    if value is None:
+        return None
+    value = ' '.join(str(value).split())
+    if not value or value.lower() == 'nan':
+        return None
+    if field in YES_NO_FIELDS:
+        return YES_NO_VALUES.get(value.lower(), value)
+    return value
+
+
+def lookup_code(c, field, value):
+    """Code van een waarde in lookup_values; nieuwe waarden worden toegevoegd (hoofdletterongevoelig)."""
+    value = normalize_lookup_value(field, value)
+    if value is None:
+        return None
+    c.execute('SELECT id FROM lookup_values WHERE field = ? AND value = ?', (field, value))
+    row = c.fetchone()
+    if row:
+        return row[0]
+    c.execute('INSERT INTO lookup_values (field, value) VALUES (?, ?)', (field, value))
+    return c.lastrowid
+
+
+def _stored_value(c, field, value):
+    if field in LOOKUP_FIELDS:
+        return lookup_code(c, field, value)
+    if field == 'added_date':
+        return normalize_timestamp(value)
+    return value
+
+
+def encode_values(c, values):
+    """Zet {veld: waarde} om naar {kolom: opgeslagen waarde} (lookup-codes, ISO-datums)."""
+    return {storage_column(field): _stored_value(c, field, value) for field, value in values.items()}
+
+
+def _holding_values(c, data):
+    return tuple(_stored_value(c, field, data.get(field)) for field in HOLDING_FIELDS)
+
+
+def _edition_values(c, data):
+    return tuple(_stored_value(c, field, data.get(field)) for field in EDITION_FIELDS)
+
+
+
+def _insert_edition(c, data, isbn_key):
+    c.execute(f'''INSERT INTO editions (isbn_key, isbn13, {', '.join(EDITION_COLUMNS)})
+                  VALUES (?, ?, {', '.join('?' for _ in EDITION_COLUMNS)})''',
+              (isbn_key or None, to_isbn13(data.get('isbn'))) + _edition_values(c, data))
+    return c.lastrowid
+
+
+def get_or_create_edition(c, data):
+    """Zoek de gedeelde editie voor dit ISBN op of maak ze aan.
+
+    Wijkt de metadata af van een gedeelde editie die al exemplaren heeft, dan krijgt het nieuwe exemplaar een
+    private kopie (zoals bij update_holding): de waarden van de gebruiker gaan niet verloren en de boeken van
+    anderen veranderen niet.
+    """
+    isbn_key = normalize_isbn(data.get('isbn'))
+    if isbn_key:
+        c.execute('SELECT id FROM editions WHERE isbn_key = ?', (isbn_key,))
+        row = c.fetchone()
+        if row:
+            if _edition_matches(c, row[0], data):
+                return row[0]
+            c.execute('SELECT 1 FROM holdings WHERE edition_id = ? LIMIT 1', (row[0],))
+            if c.fetchone():
+                return private_edition(c, data)
+            # Catalogusrij zonder exemplaren: niemand ziet ze, dus de gegevens van dit exemplaar overnemen
+            update_edition(c, row[0], data)
+            return row[0]
+
+    # Boeken zonder ISBN krijgen een eigen (niet-gedeelde) editie
+    return _insert_edition(c, data, isbn_key)
+
+
+def private_edition(c, data):
+    """Eigen kopie van een editie voor één exemplaar: zelfde ISBN-13, maar niet gedeeld (isbn_key NULL)."""
+    return _insert_edition(c, data, None)
+
+
+def update_edition(c, edition_id, data, shared=True):
+    """Overschrijf de metadata van een editie met de opgegeven waarden; een private kopie blijft privé."""
+    assignments = ', '.join(f'{column} = ?' for column in EDITION_COLUMNS)
+    c.execute(f'UPDATE editions SET isbn_key = ?, isbn13 = ?, {assignments} WHERE id = ?',
+              ((normalize_isbn(data.get('isbn')) or None) if shared else None, to_isbn13(data.get('isbn')))
+              + _edition_values(c, data) + (edition_id,))
+
+
+def _edition_matches(c, edition_id, data):
+    """Heeft de editie al precies deze metadata? Leeg en NULL gelden als gelijk, de schrijfwijze van het ISBN niet."""
+    compared = [(column, value) for column, value in zip(EDITION_COLUMNS, _edition_values(c, data)) if column != 'isbn']
+    conditions = ' AND '.join(f"({column} IS ? OR (COALESCE({column}, '') = '' AND COALESCE(?, '') = ''))"
+                              for column, _ in compared)
+    params = [value for _, value in compared for _ in range(2)]
+    c.execute(f'SELECT 1 FROM editions WHERE id = ? AND {conditions}', [edition_id] + params)
+    return c.fetchone() is not None
+
+
+def _shared_with_others(c, edition_id, user_id):
+    c.execute('SELECT 1 FROM holdings WHERE edition_id = ? AND user_id IS NOT ? LIMIT 1', (edition_id, user_id))
+    return c.fetchone() is not None
+
+
+def drop_edition_if_unused(c, edition_id):
+    """Verwijder een niet-gedeelde editie zonder exemplaren; ISBN-edities blijven in de catalogus."""
+    c.execute('''DELETE FROM editions WHERE id = ? AND isbn_key IS NULL
+                 AND NOT EXISTS (SELECT 1 FROM holdings WHERE edition_id = ?)''', (edition_id, edition_id))
+
+
+def bump_revision(c, user_id=None):
+    """Verhoog de collectierevisie van een gebruiker (of van iedereen) zodat caches ongeldig worden."""
+    if user_id is None:
+        c.execute('UPDATE collection_revisions SET rev = rev + 1')
+        c.execute('''INSERT OR IGNORE INTO collection_revisions (user_id, rev)
+                     SELECT DISTINCT user_id, 1 FROM holdings WHERE user_id IS NOT NULL''')
+        return
+    c.execute('''INSERT INTO collection_revisions (user_id, rev) VALUES (?, 1)
+                 ON CONFLICT(user_id) DO UPDATE SET rev = rev + 1''', (user_id,))
+
+
+def bump_edition_revisions(c, edition_id):
+    """Verhoog de collectierevisie van iedere gebruiker met een exemplaar van deze editie."""
+    c.execute('''INSERT INTO collection_revisions (user_id, rev)
+                 SELECT DISTINCT user_id, 1 FROM holdings WHERE edition_id = ? AND user_id IS NOT NULL
+                 ON CONFLICT(user_id) DO UPDATE SET rev = rev + 1''', (edition_id,))
+
+
+def purge_unused_editions(c):
+    """Verwijder alle niet-gedeelde edities zonder exemplaren (na bulkbewerkingen)."""
+    c.execute('''DELETE FROM editions WHERE isbn_key IS NULL
+                 AND NOT EXISTS (SELECT 1 FROM holdings WHERE edition_id = editions.id)''')
+    return c.rowcount
+
+
+def add_holding(c, data, holding_id=None, private=False):
+    """Voeg een exemplaar toe voor data['user_id'] en koppel het aan de gedeelde editie (of een private kopie)."""
+    edition_id = private_edition(c, data) if private else get_or_create_edition(c, data)
+    c.execute(f'''INSERT INTO holdings (id, user_id, edition_id, {', '.join(HOLDING_COLUMNS)})
+                  VALUES (?, ?, ?, {', '.join('?' for _ in HOLDING_COLUMNS)})''',
+              (holding_id, data.get('user_id'), edition_id) + _holding_values(c, data))
+    return c.lastrowid
+
+
+def update_holding(c, holding_id, edition_id, data):
+    """Werk een exemplaar bij zonder de boeken van andere gebruikers te veranderen.
+
+    Persoonlijke velden staan op het exemplaar. Bibliografische wijzigingen komen op de gedeelde editie zolang
+    niemand anders die editie heeft; anders krijgt dit exemplaar een private kopie (copy-on-write).
+    """
+    c.execute('SELECT user_id FROM holdings WHERE id = ?', (holding_id,))
+    user_id = c.fetchone()[0]
+    c.execute('SELECT isbn_key FROM editions WHERE id = ?', (edition_id,))
+    row = c.fetchone()
+    current_key = row[0] if row else None
+
+    shared_id = None
+    isbn_key = normalize_isbn(data.get('isbn'))
+    if isbn_key:
+        c.execute('SELECT id FROM editions WHERE isbn_key = ?', (isbn_key,))
+        row = c.fetchone()
+        shared_id = row[0] if row else None
+
+    if shared_id is not None and _edition_matches(c, shared_id, data):
+        # Zelfde gegevens als de gedeelde editie: (terug) daarnaar verwijzen
+        new_edition_id = shared_id
+    elif shared_id is not None and not _shared_with_others(c, shared_id, user_id):
+        update_edition(c, shared_id, data)
+        new_edition_id = shared_id
+    elif current_key is None and not _shared_with_others(c, edition_id, user_id):
+        # Eigen editie (zonder ISBN of al een private kopie): ter plaatse bijwerken
+        update_edition(c, edition_id, data, shared=shared_id is None)
+        new_edition_id = edition_id
+    elif isbn_key and shared_id is None:
+        new_edition_id = get_or_create_edition(c, data)
+    else:
+        new_edition_id = private_edition(c, data)
+
+    assignments = ', '.join(f'{column} = ?' for column in HOLDING_COLUMNS)
+    c.execute(f'UPDATE holdings SET edition_id = ?, {assignments} WHERE id = ?',
+              (new_edition_id,) + _holding_values(c, data) + (holding_id,))
+    if new_edition_id != edition_id:
+        drop_edition_if_unused(c, edition_id)
+
+
+def find_user_holding(c, user_id, isbn):
+    """Zoek via de ISBN-sleutel of een gebruiker dit boek al heeft (ook als private kopie van de editie)."""
+    isbn_key = normalize_isbn(isbn)
+    if not isbn_key:
+        return None
+    c.execute('''SELECT h.id FROM editions e JOIN holdings h ON h.edition_id = e.id
+                 WHERE (e.isbn_key = ? OR e.isbn13 = ?) AND h.user_id = ? LIMIT 1''',
+              (isbn_key, to_isbn13(isbn), user_id))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def get_cached_cover(c, isbn):
+    """Geef (cover_url, cover_land) uit de catalogus terug als die al eens is opgehaald."""
+    isbn_key = normalize_isbn(isbn)
+    if not isbn_key:
+        return None
+    c.execute('SELECT cover_url, cover_land FROM editions WHERE isbn_key = ? AND cover_url IS NOT NULL', (isbn_key,))
+    return c.fetchone()
+
+
+def enrich_edition(c, isbn, cover_url, cover_land, volume_info):
+    """Bewaar het Google Books resultaat in de catalogus en vul ontbrekende metadata aan."""
+    isbn_key = normalize_isbn(isbn)
+    if not isbn_key:
+        return
+    c.execute('SELECT id FROM editions WHERE isbn_key = ?', (isbn_key,))
+    row = c.fetchone()
+    if not row:
+        return
+    c.execute('''UPDATE editions SET cover_url = ?, cover_land = ?,
+                    uitgeverij = COALESCE(NULLIF(uitgeverij, ''), ?),
+                    paginas = COALESCE(NULLIF(paginas, 0), ?)
+                 WHERE id = ?''',
+              (cover_url, cover_land, volume_info.get('publisher'), volume_info.get('pageCount'), row[0]))
+    # De editie is gedeeld: de caches van alle gebruikers met een exemplaar zijn nu verouderd
+    bump_edition_revisions(c, row[0])
+
+
+def backfill_isbn13(c):
+    """Vul isbn13 voor bestaande edities en voeg edities samen die nu dezelfde ISBN-13 hebben."""
+    print("Backfilling 'isbn13' column in editions table...")
+    c.execute('SELECT id, isbn FROM editions WHERE isbn IS NOT NULL ORDER BY id')
+    editions = c.fetchall()
+    # Sleutels eerst vrijgeven zodat een ISBN-10 editie de ISBN-13 sleutel kan overnemen
+    c.execute('UPDATE editions SET isbn_key = NULL WHERE isbn IS NOT NULL')
+    keep = {}
+    merged = 0
+    for edition_id, isbn in editions:
+        isbn_key = normalize_isbn(isbn)
+        if not isbn_key:
+            continue
+        if isbn_key in keep:
+            # ISBN-10 en ISBN-13 van hetzelfde boek: exemplaren naar de oudste editie verhuizen
+            c.execute('UPDATE holdings SET edition_id = ? WHERE edition_id = ?', (keep[isbn_key], edition_id))
+            c.execute('DELETE FROM editions WHERE id = ?', (edition_id,))
+            merged += 1
+            continue
+        keep[isbn_key] = edition_id
+        c.execute('UPDATE editions SET isbn_key = ?, isbn13 = ? WHERE id = ?', (isbn_key, to_isbn13(isbn), edition_id))
+    logger.info(f"Backfilled isbn13 for {len(keep)} editions, merged {merged} duplicates")
+
+
+def create_isbn13_index(c):
+    """Index op isbn13. Niet uniek: een private kopie van een editie heeft dezelfde ISBN-13 als de gedeelde."""
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'idx_editions_isbn13'")
+    row = c.fetchone()
+    if row and row[0].upper().startswith('CREATE UNIQUE'):
+        c.execute('DROP INDEX idx_editions_isbn13')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_editions_isbn13 ON editions(isbn13) WHERE isbn13 IS NOT NULL')
+
+
+def _unreadable_added_date(value):
+    """De oorspronkelijke tekst van een niet-lege added_date die normalize_timestamp niet kan lezen, anders None."""
+    if value is None or normalize_timestamp(value):
+        return None
+    value = str(value).strip()
+    return None if value.lower() in ('', 'nan', 'nat', 'none') else value
+
+
+def keep_unreadable_added_dates(c, rows):
+    """Bewaar (holding_id, tekst) van onleesbare added_date waarden in added_date_unparsed voor ze NULL worden."""
+    if not rows:
+        return
+    c.execute('''CREATE TABLE IF NOT EXISTS added_date_unparsed
+                 (holding_id INTEGER PRIMARY KEY, added_date TEXT NOT NULL)''')
+    c.executemany('INSERT OR REPLACE INTO added_date_unparsed (holding_id, added_date) VALUES (?, ?)', rows)
+    examples = ', '.join(f'{holding_id}: {added_date!r}' for holding_id, added_date in rows[:10])
+    logger.warning(f"Kept {len(rows)} unreadable added_date values in added_date_unparsed ({examples})")
+
+
+def repair_added_dates(c):
+    """Zet added_date waarden in een gekend formaat om naar ISO-tekst.
+
+    Lege waarden worden NULL (onbekend); er wordt geen datum verzonnen. Onleesbare tekst gaat niet verloren: die
+    wordt eerst in added_date_unparsed bewaard en pas daarna in holdings op onbekend gezet.
+    """
+    c.execute(f"""SELECT id, added_date FROM holdings
+                  WHERE added_date IS NOT NULL AND added_date NOT GLOB '{TIMESTAMP_GLOB}'""")
+    rows = c.fetchall()
+    reformatted = [(normalize_timestamp(added_date), holding_id) for holding_id, added_date in rows
+                   if normalize_timestamp(added_date)]
+    unreadable = [(holding_id, _unreadable_added_date(added_date)) for holding_id, added_date in rows
+                  if _unreadable_added_date(added_date)]
+    keep_unreadable_added_dates(c, unreadable)
+    c.executemany('UPDATE holdings SET added_date = ? WHERE id = ?', reformatted)
+    repaired = {holding_id for _, holding_id in reformatted}
+    c.executemany('UPDATE holdings SET added_date = NULL WHERE id = ?',
+                  [(holding_id,) for holding_id, _ in rows if holding_id not in repaired])
+    c.execute("SELECT COUNT(*) FROM holdings WHERE added_date IS NULL")
+    logger.info(f"Repaired added_date: {len(reformatted)} reformatted, {len(rows) - len(reformatted) - len(unreadable)} "
+                f"empty and {len(unreadable)} unreadable set to unknown, {c.fetchone()[0]} unknown in total")
+
+
+def needs_added_date_repair(c):
+    c.execute(f"""SELECT 1 FROM holdings WHERE added_date = '' OR added_date NOT GLOB '{TIMESTAMP_GLOB}' LIMIT 1""")
+    return c.fetchone() is not None
+
+
+def encode_lookup_columns(c):
+    """Zet oude tekstkolommen in holdings/editions om naar lookup-codes en verwijder de tekstkolommen."""
+    converted = 0
+    for table, fields in (('holdings', HOLDING_FIELDS), ('editions', EDITION_FIELDS)):
+        c.execute(f'PRAGMA table_info({table})')
+        columns = [col[1] for col in c.fetchall()]
+        for field in fields:
+            if field not in LOOKUP_FIELDS or field not in columns:
+                continue
+            if not converted:
+                print("Moving low-cardinality columns into lookup_values...")
+            # De view verwijst naar de oude kolom en moet eerst weg
+            c.execute('DROP VIEW IF EXISTS books')
+            if storage_column(field) not in columns:
+                c.execute(f'ALTER TABLE {table} ADD COLUMN {storage_column(field)} INTEGER REFERENCES lookup_values(id)')
+            c.execute(f'SELECT DISTINCT {field} FROM {table} WHERE {field} IS NOT NULL')
+            codes = [(lookup_code(c, field, raw), raw) for (raw,) in c.fetchall()]
+            c.executemany(f'UPDATE {table} SET {storage_column(field)} = ? WHERE {field} = ?', codes)
+            c.execute(f'ALTER TABLE {table} DROP COLUMN {field}')
+            converted += 1
+    if converted:
+        c.execute(f'CREATE VIEW IF NOT EXISTS books AS {BOOKS_SELECT}')
+        logger.info(f"Dictionary-encoded {converted} columns into lookup_values")
+
+
+def migrate_books_table(c):
+    """Zet een oude platte 'books' tabel om naar editions + holdings en vervang ze door een view.
+
+    Geeft True terug als er een oude tabel is omgezet.
+    """
+    c.execute("SELECT type FROM sqlite_master WHERE name = 'books'")
+    row = c.fetchone()
+    if row and row[0] == 'table':
+        print("Migrating 'books' table to shared editions/holdings catalog...")
+        c.execute('SELECT * FROM books')
+        books = [dict(book) for book in c.fetchall()]
+        for book in books:
+            add_holding(c, book, holding_id=book['id'])
+        # add_holding maakt onleesbare datums onbekend; de oorspronkelijke tekst apart bewaren
+        keep_unreadable_added_dates(c, [(book['id'], _unreadable_added_date(book.get('added_date')))
+                                        for book in books if _unreadable_added_date(book.get('added_date'))])
+        c.execute('DROP TABLE books')
+        logger.info(f"Migrated {len(books)} books into the shared catalog")
+        migrated = True
+    else:
+        migrated = False
+
+    c.execute(f'CREATE VIEW IF NOT EXISTS books AS {BOOKS_SELECT}')
+    return migrated
+
+
+def _any_changed(columns):
+    return ' OR '.join(f'NEW.{column} IS NOT OLD.{column}' for column in columns)
+
+
+# Wijzigingsfeed: elke gewijzigde rij krijgt het volgende nummer uit één globale reeks (change_seq), ook bij
+# bulkbewerkingen en imports; verwijderde exemplaren laten een tombstone achter
+CHANGE_TRIGGERS = {
+    'holdings_change_insert': '''AFTER INSERT ON holdings BEGIN
+        UPDATE change_seq SET rev = rev + 1 WHERE id = 1;
+        UPDATE holdings SET row_rev = (SELECT rev FROM change_seq WHERE id = 1) WHERE id = NEW.id;
+        DELETE FROM book_tombstones WHERE book_id = NEW.id;
+    END''',
+    'holdings_change_update': f'''AFTER UPDATE ON holdings
+        WHEN NEW.row_rev IS OLD.row_rev AND ({_any_changed(['user_id', 'edition_id'] + HOLDING_COLUMNS)}) BEGIN
+        UPDATE change_seq SET rev = rev + 1 WHERE id = 1;
+        UPDATE holdings SET row_rev = (SELECT rev FROM change_seq WHERE id = 1) WHERE id = NEW.id;
+    END''',
+    'holdings_change_delete': '''AFTER DELETE ON holdings WHEN OLD.user_id IS NOT NULL BEGIN
+        UPDATE change_seq SET rev = rev + 1 WHERE id = 1;
+        INSERT OR REPLACE INTO book_tombstones (book_id, user_id, rev, deleted_at)
+        VALUES (OLD.id, OLD.user_id, (SELECT rev FROM change_seq WHERE id = 1), datetime('now', 'localtime'));
+    END''',
+    # Een gedeelde editie wijzigen verandert de boekenrij van iedereen die ze heeft
+    'editions_change_update': f'''AFTER UPDATE ON editions
+        WHEN NEW.row_rev IS OLD.row_rev AND ({_any_changed(EDITION_COLUMNS)}) BEGIN
+        UPDATE change_seq SET rev = rev + 1 WHERE id = 1;
+        UPDATE editions SET row_rev = (SELECT rev FROM change_seq WHERE id = 1) WHERE id = NEW.id;
+    END''',
+}
+
+
+def install_change_tracking(c):
+    """Revisiekolommen, tombstones en triggers voor de wijzigingsfeed; bestaande rijen krijgen de huidige revisie."""
+    c.execute('''CREATE TABLE IF NOT EXISTS change_seq (
+                 id INTEGER PRIMARY KEY CHECK (id = 1),
+                 rev INTEGER NOT NULL,
+                 horizon INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('INSERT OR IGNORE INTO change_seq (id, rev, horizon) VALUES (1, 1, 0)')
+    c.execute('''CREATE TABLE IF NOT EXISTS book_tombstones (
+                 book_id INTEGER PRIMARY KEY,
+                 user_id INTEGER NOT NULL,
+                 rev INTEGER NOT NULL,
+                 deleted_at TEXT)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tombstones_user_rev ON book_tombstones(user_id, rev)')
+
+    for table in ('holdings', 'editions'):
+        c.execute(f'PRAGMA table_info({table})')
+        if 'row_rev' not in [column[1] for column in c.fetchall()]:
+            print(f"Adding 'row_rev' column to {table} table...")
+            c.execute(f'ALTER TABLE {table} ADD COLUMN row_rev INTEGER')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_holdings_user_rev ON holdings(user_id, row_rev)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_editions_rev ON editions(row_rev)')
+
+    # Triggers opnieuw aanmaken: hun kolomlijsten volgen HOLDING_COLUMNS/EDITION_COLUMNS
+    for name, body in CHANGE_TRIGGERS.items():
+        c.execute(f'DROP TRIGGER IF EXISTS {name}')
+        c.execute(f'CREATE TRIGGER {name} {body}')
+
+    # Rijen van vóór de feed (of van een migratie) tellen als gewijzigd in de huidige revisie
+    c.execute('UPDATE holdings SET row_rev = (SELECT rev FROM change_seq WHERE id = 1) WHERE row_rev IS NULL')
+
+
+# Globale statistieken: elke schrijfactie op een exemplaar (of op zijn editie) logt het exemplaar-id, zodat
+# refresh_global_stats enkel die exemplaren herberekent
+STATS_LOG_TRIGGERS = {
+    'holdings_stats_insert': '''AFTER INSERT ON holdings BEGIN
+        INSERT INTO stats_log (holding_id) VALUES (NEW.id);
+    END''',
+    'holdings_stats_update': f'''AFTER UPDATE ON holdings
+        WHEN {_any_changed(['user_id', 'edition_id', storage_column('genre')])} BEGIN
+        INSERT INTO stats_log (holding_id) VALUES (NEW.id);
+    END''',
+    'holdings_stats_delete': '''AFTER DELETE ON holdings BEGIN
+        INSERT INTO stats_log (holding_id) VALUES (OLD.id);
+    END''',
+    'editions_stats_update': f'''AFTER UPDATE ON editions
+        WHEN {_any_changed(['titel', 'auteur_voornaam', 'auteur_achternaam', 'paginas', storage_column('taal')])} BEGIN
+        INSERT INTO stats_log (holding_id) SELECT id FROM holdings WHERE edition_id = NEW.id;
+    END''',
+}
+
+
+def install_global_stats(c):
+    """Wijzigingslog, bijdrage per exemplaar en geaggregeerde tellingen voor de globale statistieken."""
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_log'")
+    first_install = c.fetchone() is None
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_log (
+                 id INTEGER PRIMARY KEY,
+                 holding_id INTEGER NOT NULL)''')
+    # Wat elk exemplaar nu bijdraagt, om het bij een wijziging terug af te trekken
+    c.execute('''CREATE TABLE IF NOT EXISTS global_contrib (
+                 holding_id INTEGER PRIMARY KEY,
+                 contributions TEXT NOT NULL,
+                 paginas INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS global_aggregates (
+                 kind TEXT NOT NULL,
+                 key TEXT NOT NULL,
+                 label TEXT,
+                 books INTEGER NOT NULL DEFAULT 0,
+                 paginas INTEGER NOT NULL DEFAULT 0,
+                 PRIMARY KEY (kind, key))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_global_aggregates_rank ON global_aggregates(kind, books DESC)')
+
+    for name, body in STATS_LOG_TRIGGERS.items():
+        c.execute(f'DROP TRIGGER IF EXISTS {name}')
+        c.execute(f'CREATE TRIGGER {name} {body}')
+
+    # Bestaande boeken tellen bij de eerste installatie als gewijzigd: de eerste refresh bouwt alles op
+    if first_install:
+        c.execute('INSERT INTO stats_log (holding_id) SELECT id FROM holdings WHERE user_id IS NOT NULL')
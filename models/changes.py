@@ -0,0 +1,125 @@
+from .shards import SHARDS, user_connection
+from .writer import run_write
+from .book_record import books_from_cursor, dumps
+from datetime import datetime, timedelta
+import logging
+import json
+import os
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Standaard en maximaal aantal wijzigingen per pagina van de feed
+CHANGES_PAGE_SIZE = 500
+MAX_CHANGES_PAGE_SIZE = 5000
+# Boeken per query bij het streamen van een pagina
+CHANGES_CHUNK_SIZE = 200
+# Tombstones van verwijderde boeken blijven zo lang bewaard; wie langer niet synchroniseerde, moet volledig opnieuw
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', 90))
+
+# Eén rij per gewijzigd boek met zijn revisie: de hoogste van exemplaar en editie, of die van de tombstone
+CHANGES_QUERY = '''SELECT id, MAX(rev) AS rev, 'upsert' AS op FROM (
+                       SELECT h.id AS id, h.row_rev AS rev FROM holdings h
+                       WHERE h.user_id = :user_id AND h.row_rev > :since AND h.row_rev <= :until
+                       UNION ALL
+                       SELECT h.id, e.row_rev FROM editions e JOIN holdings h ON h.edition_id = e.id
+                       WHERE h.user_id = :user_id AND e.row_rev > :since AND e.row_rev <= :until)
+                   GROUP BY id
+                   UNION ALL
+                   SELECT book_id, rev, 'delete' FROM book_tombstones
+                   WHERE user_id = :user_id AND rev > :since AND rev <= :until AND :since > 0
+                   ORDER BY rev, id'''
+
+
+def get_change_horizon(user_id):
+    """Huidige revisie en horizon (oudste revisie met nog alle tombstones) in de shard van een gebruiker."""
+    conn = user_connection(user_id)
+    try:
+        row = conn.execute('SELECT rev, horizon FROM change_seq WHERE id = 1').fetchone()
+        return row['rev'], row['horizon']
+    finally:
+        conn.close()
+
+
+def check_since(user_id, since):
+    """Kan een client die tot revisie since gesynchroniseerd is nog incrementeel verder? Geeft (success, message)."""
+    current, horizon = get_change_horizon(user_id)
+    if since > current:
+        return False, f"Onbekende revisie {since} (huidige revisie is {current})."
+    if 0 < since < horizon:
+        return False, f"Revisie {since} is te oud; verwijderde boeken tot revisie {horizon} zijn niet meer bekend."
+    return True, None
+
+
+def _list_changes(c, user_id, since, limit):
+    """Wijzigingen na since, afgekapt op een volledige revisie; geeft (changes, has_more) terug."""
+    params = {'user_id': user_id, 'since': since, 'until': 2 ** 62}
+    c.execute(f'{CHANGES_QUERY} LIMIT :limit', dict(params, limit=limit + 1))
+    changes = c.fetchall()
+    if len(changes) <= limit:
+        return changes, False
+    # Een revisie (bv. een gedeelde editie) niet over twee pagina's splitsen
+    boundary = changes[limit]['rev']
+    changes = [change for change in changes[:limit] if change['rev'] < boundary]
+    if not changes:
+        # Eén revisie groter dan een pagina: dan komt ze er volledig in
+        c.execute(CHANGES_QUERY, dict(params, until=boundary))
+        changes = c.fetchall()
+    return changes, True
+
+
+def stream_changes(user_id, since, limit=CHANGES_PAGE_SIZE):
+    """Genereer één pagina van de wijzigingsfeed als JSON-bytes, uit één consistente leestransactie.
+
+    Vorm: {"since": .., "changes": [{"op": "upsert", "rev": .., "book": {..}} | {"op": "delete", "rev": .., "id": ..}],
+    "next": .., "has_more": .., "current": ..}. Met next als since haalt de client de volgende pagina op.
+    """
+    conn = user_connection(user_id)
+    c = conn.cursor()
+    try:
+        c.execute('BEGIN')
+        current = c.execute('SELECT rev FROM change_seq WHERE id = 1').fetchone()['rev']
+        changes, has_more = _list_changes(c, user_id, since, limit)
+        next_rev = changes[-1]['rev'] if has_more else max(current, since)
+        logger.debug(f"Change feed for user {user_id} since {since}: {len(changes)} changes, next {next_rev}")
+
+        yield b'{"since":' + dumps(since) + b',"changes":['
+        first = True
+        for start in range(0, len(changes), CHANGES_CHUNK_SIZE):
+            chunk = changes[start:start + CHANGES_CHUNK_SIZE]
+            upserts = [change['id'] for change in chunk if change['op'] == 'upsert']
+            books = {}
+            if upserts:
+                c.execute('SELECT * FROM books WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(upserts),))
+                books = {book.id: book for book in books_from_cursor(c)}
+            for change in chunk:
+                if change['op'] == 'upsert':
+                    item = {'op': 'upsert', 'rev': change['rev'], 'book': books[change['id']].to_dict()}
+                else:
+                    item = {'op': 'delete', 'rev': change['rev'], 'id': change['id']}
+                yield (b'' if first else b',') + dumps(item)
+                first = False
+        yield b'],"next":' + dumps(next_rev) + b',"has_more":' + dumps(has_more) + b',"current":' + dumps(current) + b'}'
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _prune_shard(c, cutoff):
+    c.execute('SELECT MAX(rev) FROM book_tombstones WHERE deleted_at < ?', (cutoff,))
+    newest = c.fetchone()[0]
+    if newest is None:
+        return 0
+    # Alle tombstones tot en met die revisie gaan weg, zodat de horizon één grens is voor iedereen in de shard
+    c.execute('DELETE FROM book_tombstones WHERE rev <= ?', (newest,))
+    removed = c.rowcount
+    c.execute('UPDATE change_seq SET horizon = MAX(horizon, ?) WHERE id = 1', (newest,))
+    logger.info(f"Pruned {removed} tombstones, change horizon now {newest}")
+    return removed
+
+
+def prune_tombstones(retention_days=TOMBSTONE_RETENTION_DAYS):
+    """Verwijder oude tombstones en schuif de horizon op (per shard); geeft het aantal verwijderde tombstones terug."""
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    return sum(run_write(lambda c: _prune_shard(c, cutoff), path=path) for path in SHARDS.values())
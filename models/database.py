@@ -1,40 +1,143 @@
 import sqlite3
+import os
 import bcrypt
 import datetime
+from .catalog import (migrate_books_table, backfill_isbn13, create_isbn13_index, needs_added_date_repair,
+                      repair_added_dates, encode_lookup_columns, install_change_tracking, install_global_stats,
+                      BOOKS_SELECT)
 
-def get_db_connection():
-    conn = sqlite3.connect('books.db')
+DATABASE_PATH = 'books.db'
+# Seconds a connection waits for another process's write lock before raising 'database is locked'
+BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 10))
+
+def get_db_connection(path=None):
+    """Connection to the main database, or to the shard database at path."""
+    conn = sqlite3.connect(path or DATABASE_PATH, timeout=BUSY_TIMEOUT)
     conn.row_factory = sqlite3.Row
+    # WAL is durable enough with NORMAL sync and avoids an fsync per commit
+    conn.execute('PRAGMA synchronous = NORMAL')
     return conn
 
-def init_db():
-    print("Initializing database...")
-    conn = get_db_connection()
-    c = conn.cursor()
+def create_catalog_tables(c):
+    """Tables holding book data; created in the main database and in every shard."""
+    # Dictionary for low-cardinality text columns (genre, taal, staat, ...); rows store the integer id
+    c.execute('''CREATE TABLE IF NOT EXISTS lookup_values
+                 (id INTEGER PRIMARY KEY,
+                  field TEXT NOT NULL,
+                  value TEXT NOT NULL COLLATE NOCASE,
+                  UNIQUE(field, value))''')
 
-    # Create books table with user_id
-    c.execute('''CREATE TABLE IF NOT EXISTS books
+    # Shared catalog: one row per edition, keyed by normalised ISBN and shared by all users
+    c.execute('''CREATE TABLE IF NOT EXISTS editions
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
+                  isbn_key TEXT UNIQUE,
+                  isbn13 TEXT,
                   titel TEXT,
                   auteur_voornaam TEXT,
                   auteur_achternaam TEXT,
-                  genre TEXT,
-                  prijs REAL,
                   paginas INTEGER,
-                  bindwijze TEXT,
-                  edition TEXT,
+                  bindwijze_code INTEGER REFERENCES lookup_values(id),
+                  edition_code INTEGER REFERENCES lookup_values(id),
                   isbn TEXT,
                   reeks_nr TEXT,
                   uitgeverij TEXT,
                   serie TEXT,
-                  staat TEXT,
-                  taal TEXT,
-                  gesigneerd TEXT,
-                  gelezen TEXT,
+                  taal_code INTEGER REFERENCES lookup_values(id),
+                  cover_url TEXT,
+                  cover_land TEXT)''')
+
+    # Per-user holdings: the personal part of a book (condition, price, read/signed, location)
+    c.execute('''CREATE TABLE IF NOT EXISTS holdings
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  edition_id INTEGER NOT NULL,
+                  genre_code INTEGER REFERENCES lookup_values(id),
+                  prijs REAL,
+                  staat_code INTEGER REFERENCES lookup_values(id),
+                  gesigneerd_code INTEGER REFERENCES lookup_values(id),
+                  gelezen_code INTEGER REFERENCES lookup_values(id),
                   added_date TEXT,
-                  land TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE)''')
+                  land_code INTEGER REFERENCES lookup_values(id),
+                  FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+                  FOREIGN KEY(edition_id) REFERENCES editions(id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_holdings_edition ON holdings(edition_id)')
+    # Per-user lookups (user_id alone or user_id + edition) use one composite index
+    c.execute('DROP INDEX IF EXISTS idx_holdings_user')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_holdings_user_edition ON holdings(user_id, edition_id)')
+
+    # Revision counter per user collection; bumped on every write so caches can key on it
+    c.execute('''CREATE TABLE IF NOT EXISTS collection_revisions (
+                 user_id INTEGER PRIMARY KEY,
+                 rev INTEGER NOT NULL DEFAULT 0
+             )''')
+
+    # Precomputed "similar books" per holding: top-k neighbours as JSON [[book_id, score], ...]
+    c.execute('''CREATE TABLE IF NOT EXISTS similar_books (
+                 book_id INTEGER PRIMARY KEY,
+                 user_id INTEGER NOT NULL,
+                 neighbors TEXT NOT NULL
+             )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_similar_books_user ON similar_books(user_id)')
+    # A user's index exists once built; 'changes' counts incremental updates since the last full build
+    c.execute('''CREATE TABLE IF NOT EXISTS similar_books_state (
+                 user_id INTEGER PRIMARY KEY,
+                 changes INTEGER NOT NULL DEFAULT 0
+             )''')
+    # Books changed since the index was last brought up to date; applied outside the write transaction
+    c.execute('''CREATE TABLE IF NOT EXISTS similar_books_pending (
+                 book_id INTEGER PRIMARY KEY,
+                 user_id INTEGER NOT NULL
+             )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_similar_books_pending_user ON similar_books_pending(user_id)')
+
+def init_db():
+    print("Initializing database...")
+    conn = get_db_connection()
+    c = conn.cursor()
+
+    # WAL lets many worker processes read while one writes (setting is stored in the file)
+    c.execute('PRAGMA journal_mode = WAL')
+    # Free pages can be returned to the OS in small steps (takes effect immediately on a new database)
+    c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    create_catalog_tables(c)
+
+    # Add canonical isbn13 column to editions if not exists (backfilled below)
+    c.execute("PRAGMA table_info(editions)")
+    columns = [col['name'] for col in c.fetchall()]
+    needs_isbn13_backfill = 'isbn13' not in columns
+    if needs_isbn13_backfill:
+        print("Adding 'isbn13' column to editions table...")
+        c.execute("ALTER TABLE editions ADD COLUMN isbn13 TEXT")
+
+    # Server-side sessions: the cookie only carries the session id
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                 sid TEXT PRIMARY KEY,
+                 user_id INTEGER,
+                 data TEXT NOT NULL,
+                 expires_at INTEGER NOT NULL
+             )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
+
+    # Last run of each maintenance task, shared by all worker processes
+    c.execute('''CREATE TABLE IF NOT EXISTS maintenance_runs (
+                 task TEXT PRIMARY KEY,
+                 last_run TEXT,
+                 duration REAL,
+                 detail TEXT
+             )''')
+
+    # Router: the shard holding each user's books (see models/shards.py); no row means the main database
+    c.execute('''CREATE TABLE IF NOT EXISTS user_shards (
+                 user_id INTEGER PRIMARY KEY,
+                 shard TEXT NOT NULL
+             )''')
+    # Book id range of each shard, fixed when the shard is first registered
+    c.execute('''CREATE TABLE IF NOT EXISTS shards (
+                 name TEXT PRIMARY KEY,
+                 first_id INTEGER NOT NULL UNIQUE
+             )''')
 
     # Create geocache table
     c.execute('''CREATE TABLE IF NOT EXISTS geocache (
@@ -58,21 +161,40 @@ def init_db():
              )''')
 
 
-    # Check and add user_id column to books if not exists
-    c.execute("PRAGMA table_info(books)")
-    columns = [col['name'] for col in c.fetchall()]
-    if 'user_id' not in columns:
-        print("Adding 'user_id' column to books table...")
-        c.execute("ALTER TABLE books ADD COLUMN user_id INTEGER")
-        # Optionally, set a default user_id for existing books (e.g., admin user or null)
-        c.execute("UPDATE books SET user_id = NULL WHERE user_id IS NULL")
-        # If you want to assign existing books to a default user, e.g., admin (id=1):
-        # c.execute("UPDATE books SET user_id = 1 WHERE user_id IS NULL")
-
-    # Add land column to books if not exists
-    if 'land' not in columns:
-        print("Adding 'land' column to books table...")
-        c.execute("ALTER TABLE books ADD COLUMN land TEXT DEFAULT ''")
+    # Bring an old flat books table up to date before it is migrated into the catalog
+    c.execute("SELECT type FROM sqlite_master WHERE name = 'books'")
+    books_type = c.fetchone()
+    if books_type and books_type['type'] == 'table':
+        c.execute("PRAGMA table_info(books)")
+        columns = [col['name'] for col in c.fetchall()]
+        if 'user_id' not in columns:
+            print("Adding 'user_id' column to books table...")
+            c.execute("ALTER TABLE books ADD COLUMN user_id INTEGER")
+
+        # Add land column to books if not exists
+        if 'land' not in columns:
+            print("Adding 'land' column to books table...")
+            c.execute("ALTER TABLE books ADD COLUMN land TEXT DEFAULT ''")
+
+    # Move text columns of an older catalog into lookup_values before the view is (re)created
+    encode_lookup_columns(c)
+
+    # Replace the flat books table by editions + holdings, exposed as a 'books' view
+    migrated_books = migrate_books_table(c)
+    if needs_isbn13_backfill:
+        backfill_isbn13(c)
+    create_isbn13_index(c)
+
+    # added_date is an ISO timestamp; repair empty and legacy-formatted values, then index it for time-series queries
+    if migrated_books or needs_added_date_repair(c):
+        print("Repairing 'added_date' values in holdings table...")
+        repair_added_dates(c)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_holdings_user_added ON holdings(user_id, added_date)')
+
+    # Per-row revisions and tombstones for the /books/changes delta feed (after the migration above)
+    install_change_tracking(c)
+    # Change log and materialised aggregates for the instance-wide statistics
+    install_global_stats(c)
 
     # Add color and dark_mode columns to users if not exists
     c.execute("PRAGMA table_info(users)")
@@ -132,5 +254,34 @@ def init_db():
                   ('admin', hashed_password, 'admin', '#2563eb', 1))
 
     conn.commit()
+
+    # An existing database only switches to incremental auto-vacuum after one full VACUUM
+    if c.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        print("Enabling incremental auto-vacuum (one-time VACUUM)...")
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        c.execute('VACUUM')
+
+    conn.close()
+    print("Database initialized successfully.")
+
+def init_shard_db(path, first_id):
+    """Create (or upgrade) a shard: only the book tables, with holding ids starting above first_id.
+
+    Every shard hands out ids from its own range, so a book id is unique across shards and tells which
+    shard holds the book.
+    """
+    conn = get_db_connection(path)
+    c = conn.cursor()
+    c.execute('PRAGMA journal_mode = WAL')
+    c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    create_catalog_tables(c)
+    create_isbn13_index(c)
+    c.execute(f'CREATE VIEW IF NOT EXISTS books AS {BOOKS_SELECT}')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_holdings_user_added ON holdings(user_id, added_date)')
+    install_change_tracking(c)
+    install_global_stats(c)
+    c.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'holdings', ? "
+              "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'holdings')", (first_id,))
+    c.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'holdings'", (first_id,))
+    conn.commit()
     conn.close()
-    print("Database initialized successfully.")
\ No newline at end of file
@@ -0,0 +1,245 @@
+from .shards import user_connection, run_user_write
+from .writer import run_write
+from .catalog import HOLDING_COLUMNS, BOOKS_SELECT, purge_unused_editions, bump_revision, normalize_isbn
+from .cache import stats_cache, get_collection_revision
+from .recommendations import mark_similar_books
+from .text import normalize_text, book_key
+from collections import defaultdict
+import numpy as np
+import logging
+import zlib
+import json
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Tekens per n-gram van titel + auteur
+NGRAM_SIZE = 3
+# MinHash-signatuur van NUM_PERM waarden, voor LSH opgedeeld in BANDS banden van elk NUM_PERM // BANDS rijen;
+# twee boeken worden kandidaat vanaf een Jaccard-gelijkenis van ongeveer (1 / BANDS) ** (BANDS / NUM_PERM) = 0.5
+NUM_PERM = 64
+BANDS = 16
+# Kandidaten zijn dubbel als hun n-grammen minstens zo sterk overlappen
+SIMILARITY_THRESHOLD = 0.7
+# Buckets met meer boeken dan dit (bv. heel korte titels) worden overgeslagen om kwadratisch werk te vermijden
+MAX_BUCKET_SIZE = 200
+
+# Vaste permutaties zodat signaturen tussen verzoeken en processen vergelijkbaar zijn
+_PRIME = np.uint64(4294967311)  # eerste priemgetal boven 2**32
+_rng = np.random.default_rng(20240601)
+_PERM_A = _rng.integers(1, 2 ** 31, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 2 ** 31, size=NUM_PERM, dtype=np.uint64)
+
+
+def shingles(text, size=NGRAM_SIZE):
+    """Verzameling teken-n-grammen, met een spatie als rand zodat ook korte woorden meetellen."""
+    padded = f' {text} '
+    if len(padded) <= size:
+        return {padded}
+    return {padded[i:i + size] for i in range(len(padded) - size + 1)}
+
+
+def minhash(shingle_set):
+    """MinHash-signatuur: per permutatie de kleinste hash over alle n-grammen."""
+    hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingle_set), dtype=np.uint64,
+                         count=len(shingle_set))
+    return ((np.outer(_PERM_A, hashes) + _PERM_B[:, None]) % _PRIME).min(axis=1)
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def _series_number(value):
+    try:
+        return int(float(value or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _conflicting(a, b):
+    """Verschillende ISBN's of verschillende delen van een reeks zijn bewust verschillende boeken."""
+    if a['isbn13'] and b['isbn13'] and a['isbn13'] != b['isbn13']:
+        return True
+    return bool(a['series_nr']) and bool(b['series_nr']) and a['series_nr'] != b['series_nr']
+
+
+def duplicate_clusters(books):
+    """Groepeer waarschijnlijk dubbele boeken in bijna-lineaire tijd (MinHash + LSH i.p.v. alle paren).
+
+    books is een lijst dicts met minstens id, titel, auteur_voornaam, auteur_achternaam, isbn en reeks_nr.
+    Geeft een lijst clusters terug; elk cluster is een lijst van de dicts met een extra 'similarity'.
+    """
+    entries = []
+    for book in books:
+        entry = dict(book)
+        entry['isbn13'] = normalize_isbn(book['isbn'])
+        entry['series_nr'] = _series_number(book['reeks_nr'])
+        entry['shingles'] = shingles(book_key(book))
+        entries.append(entry)
+
+    rows_per_band = NUM_PERM // BANDS
+    buckets = defaultdict(list)
+    for index, entry in enumerate(entries):
+        if entry['isbn13']:
+            buckets[('isbn', entry['isbn13'])].append(index)
+        signature = minhash(entry['shingles'])
+        for band in range(BANDS):
+            buckets[(band, signature[band * rows_per_band:(band + 1) * rows_per_band].tobytes())].append(index)
+
+    # Union-find over de bevestigde paren
+    parent = list(range(len(entries)))
+    best = [0.0] * len(entries)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    checked = set()
+    for key, members in buckets.items():
+        if len(members) < 2:
+            continue
+        if len(members) > MAX_BUCKET_SIZE:
+            logger.debug(f"Skipping oversized duplicate bucket {key[0]} with {len(members)} books")
+            continue
+        for pos, i in enumerate(members):
+            for j in members[pos + 1:]:
+                if (i, j) in checked:
+                    continue
+                checked.add((i, j))
+                a, b = entries[i], entries[j]
+                if a['isbn13'] and a['isbn13'] == b['isbn13']:
+                    similarity = 1.0
+                elif _conflicting(a, b):
+                    continue
+                else:
+                    similarity = jaccard(a['shingles'], b['shingles'])
+                    if similarity < SIMILARITY_THRESHOLD:
+                        continue
+                best[i] = max(best[i], similarity)
+                best[j] = max(best[j], similarity)
+                parent[find(i)] = find(j)
+
+    groups = defaultdict(list)
+    for index, entry in enumerate(entries):
+        groups[find(index)].append(index)
+    clusters = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        cluster = []
+        for index in sorted(members, key=lambda i: entries[i]['id']):
+            book = {key: value for key, value in entries[index].items()
+                    if key not in ('shingles', 'isbn13', 'series_nr')}
+            book['similarity'] = round(best[index], 2)
+            cluster.append(book)
+        clusters.append(cluster)
+    clusters.sort(key=lambda cluster: (-len(cluster), normalize_text(cluster[0]['titel'])))
+    logger.debug(f"Duplicate scan: {len(entries)} books, {len(checked)} candidate pairs, {len(clusters)} clusters")
+    return clusters
+
+
+def _user_books(c, user_id):
+    c.execute(f'''SELECT id, titel, auteur_voornaam, auteur_achternaam, isbn, reeks_nr, uitgeverij, added_date, prijs
+                  FROM ({BOOKS_SELECT}) WHERE user_id = ?''', (user_id,))
+    return [dict(row) for row in c.fetchall()]
+
+
+def find_duplicates(user_id):
+    """Waarschijnlijk dubbele boeken van een gebruiker, gecachet per collectierevisie."""
+    conn = user_connection(user_id)
+    c = conn.cursor()
+    try:
+        cache_key = ('duplicates', user_id, get_collection_revision(c, user_id))
+        clusters = stats_cache.get(cache_key)
+        if clusters is None:
+            clusters = duplicate_clusters(_user_books(c, user_id))
+            stats_cache.put(cache_key, clusters, len(json.dumps(clusters, default=str)))
+        return clusters
+    finally:
+        conn.close()
+
+
+def count_new_duplicates(c, user_id, new_ids):
+    """Aantal net toegevoegde boeken dat waarschijnlijk een dubbel is (binnen de lopende transactie)."""
+    new_ids = set(new_ids)
+    if not new_ids:
+        return 0
+    flagged = 0
+    for cluster in duplicate_clusters(_user_books(c, user_id)):
+        ids = [book['id'] for book in cluster]
+        # Een cluster van enkel nieuwe boeken telt één origineel niet mee
+        new_in_cluster = sum(1 for book_id in ids if book_id in new_ids)
+        flagged += new_in_cluster if new_in_cluster < len(ids) else new_in_cluster - 1
+    return flagged
+
+
+def _move_likes(c, keep_id, duplicate_ids):
+    """Zet likes van de dubbels over naar keep_id; False als deze database geen likes-tabel heeft."""
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'likes'")
+    if not c.fetchone():
+        return False
+    c.execute('''INSERT OR IGNORE INTO likes (user_id, book_id)
+                 SELECT user_id, ? FROM likes WHERE book_id IN (SELECT value FROM json_each(?))''',
+              (keep_id, json.dumps(duplicate_ids)))
+    c.execute('DELETE FROM likes WHERE book_id IN (SELECT value FROM json_each(?))', (json.dumps(duplicate_ids),))
+    return True
+
+
+def merge_duplicates(user_id, keep_id, duplicate_ids):
+    """Voeg dubbele exemplaren samen in keep_id: lege persoonlijke velden aanvullen, likes overzetten, rest verwijderen."""
+    try:
+        keep_id = int(keep_id)
+        duplicate_ids = [int(book_id) for book_id in duplicate_ids if int(book_id) != keep_id]
+    except (TypeError, ValueError):
+        return False, "Ongeldige boek-ID's!"
+    if not duplicate_ids:
+        return False, "Selecteer minstens één dubbel boek om samen te voegen."
+
+    ids = [keep_id] + duplicate_ids
+
+    def merge(c):
+        c.execute(f'''SELECT id, {', '.join(HOLDING_COLUMNS)} FROM holdings
+                      WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))''', (user_id, json.dumps(ids)))
+        rows = {row['id']: row for row in c.fetchall()}
+        if len(rows) != len(ids):
+            return None
+
+        # Lege velden van het bewaarde exemplaar aanvullen met de eerste ingevulde waarde van de dubbels
+        updates = {}
+        for column in HOLDING_COLUMNS:
+            if rows[keep_id][column] in (None, '', 0):
+                for book_id in duplicate_ids:
+                    if rows[book_id][column] not in (None, '', 0):
+                        updates[column] = rows[book_id][column]
+                        break
+        if updates:
+            assignments = ', '.join(f'{column} = ?' for column in updates)
+            c.execute(f'UPDATE holdings SET {assignments} WHERE id = ?', list(updates.values()) + [keep_id])
+
+        likes_moved = _move_likes(c, keep_id, duplicate_ids)
+
+        c.execute('DELETE FROM holdings WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))',
+                  (user_id, json.dumps(duplicate_ids)))
+        merged = c.rowcount
+        purge_unused_editions(c)
+        mark_similar_books(c, user_id, ids)
+        bump_revision(c, user_id)
+        return merged, likes_moved
+
+    try:
+        result = run_user_write(user_id, merge)
+        if result is None:
+            return False, "Niet alle boeken gevonden of geen rechten!"
+        merged, likes_moved = result
+        if not likes_moved:
+            # Boeken in een shard: de likes staan in de hoofddatabase
+            run_write(lambda w: _move_likes(w, keep_id, duplicate_ids))
+        logger.info(f"Merged {merged} duplicates into book {keep_id} for user {user_id}")
+        return True, f"{merged} dubbele boeken samengevoegd!"
+    except Exception as e:
+        logger.error(f"Error merging duplicates for user {user_id}: {str(e)}")
+        return False, f"Fout bij samenvoegen: {str(e)}"
@@ -0,0 +1,128 @@
+from .text import normalize_text
+from array import array
+from bisect import bisect_left
+from difflib import SequenceMatcher
+import threading
+import logging
+import os
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Meegeleverde lijst van landen en grotere steden met Nederlandse, Engelse en lokale namen
+GAZETTEER_PATH = os.environ.get('GAZETTEER_PATH', os.path.join(os.path.dirname(__file__), 'gazetteer.tsv'))
+# Langste reeks woorden die als plaatsnaam geprobeerd wordt ('Bergen op Zoom', 'Newcastle upon Tyne')
+MAX_NAME_WORDS = 4
+# Kortere stukken van een langere tekst ('de', 'uk') worden niet als plaatsnaam gelezen
+MIN_SPAN_LENGTH = 4
+# Minimale gelijkenis (0..1) voor een plaatsnaam met een tikfout, en de minimale lengte om dat te proberen
+FUZZY_THRESHOLD = 0.85
+FUZZY_MIN_LENGTH = 5
+
+
+class Gazetteer:
+    """Plaatsnamen in een compacte opzoekstructuur: gesorteerde genormaliseerde aliassen met bisect.
+
+    Per plaats worden naam, soort en coördinaten één keer bewaard (coördinaten in een array van doubles);
+    elke alias verwijst enkel met een index naar zijn plaats.
+    """
+
+    def __init__(self, places):
+        self.names = []
+        self.cities = array('b')
+        self.coords = array('d')
+        aliases = {}
+        for name, kind, lat, lon, names in places:
+            index = len(self.names)
+            self.names.append(name)
+            self.cities.append(kind == 'stad')
+            self.coords.extend((lat, lon))
+            for alias in [name] + names:
+                # Bij een dubbele alias wint de eerste regel van het bestand
+                aliases.setdefault(normalize_text(alias), index)
+        aliases.pop('', None)
+        self.keys = sorted(aliases)
+        self.places = array('H', (aliases[key] for key in self.keys))
+
+    @classmethod
+    def load(cls, path=GAZETTEER_PATH):
+        places = []
+        with open(path, encoding='utf-8') as handle:
+            for line in handle:
+                if line.startswith('#') or line.startswith('naam\t') or not line.strip():
+                    continue
+                name, kind, lat, lon, names = (line.rstrip('\n').split('\t') + [''])[:5]
+                places.append((name, kind, float(lat), float(lon), [alias for alias in names.split('|') if alias]))
+        gazetteer = cls(places)
+        logger.info(f"Loaded gazetteer with {len(places)} places and {len(gazetteer.keys)} aliases from {path}")
+        return gazetteer
+
+    def _place(self, index):
+        return self.names[index], self.coords[2 * index], self.coords[2 * index + 1]
+
+    def _exact(self, key):
+        position = bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            return self.places[position]
+        return None
+
+    def _fuzzy(self, key):
+        """Dichtstbijzijnde alias met dezelfde beginletter, als die genoeg lijkt (tikfouten)."""
+        start = bisect_left(self.keys, key[0])
+        end = bisect_left(self.keys, key[0] + '\uffff', start)
+        best, best_ratio = None, FUZZY_THRESHOLD
+        matcher = SequenceMatcher(b=key, autojunk=False)
+        for position in range(start, end):
+            candidate = self.keys[position]
+            if abs(len(candidate) - len(key)) > 2:
+                continue
+            matcher.set_seq1(candidate)
+            if matcher.quick_ratio() >= best_ratio and matcher.ratio() >= best_ratio:
+                best, best_ratio = self.places[position], matcher.ratio()
+        return best
+
+    def lookup(self, text):
+        """(naam, lat, lon) van de plaats in een vrije tekst, of None.
+
+        Eerst de hele tekst; dan elke reeks van hoogstens MAX_NAME_WORDS woorden ('Waterstones Amsterdam',
+        'Hogenakkerstraat 140 Sint-Niklaas'), langste eerst en een stad boven een land; tot slot dezelfde
+        reeksen met een tikfout.
+        """
+        key = normalize_text(text)
+        if not key:
+            return None
+        index = self._exact(key)
+        if index is not None:
+            return self._place(index)
+
+        words = key.split()
+        spans = [' '.join(words[start:start + size])
+                 for size in range(min(MAX_NAME_WORDS, len(words)), 0, -1)
+                 for start in range(len(words) - size + 1)]
+        for match, min_length in ((self._exact, MIN_SPAN_LENGTH), (self._fuzzy, FUZZY_MIN_LENGTH)):
+            found = [index for index in (match(span) for span in spans if len(span) >= min_length)
+                     if index is not None]
+            if found:
+                # Langste reeks eerst (volgorde van spans); bij een stad en een land ('Antwerpen, België') de stad
+                return self._place(next((index for index in found if self.cities[index]), found[0]))
+        return None
+
+
+_gazetteer = [None]
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    """De gazetteer van dit proces, bij het eerste gebruik ingelezen."""
+    if _gazetteer[0] is None:
+        with _gazetteer_lock:
+            if _gazetteer[0] is None:
+                _gazetteer[0] = Gazetteer.load()
+    return _gazetteer[0]
+
+
+def resolve_location(text):
+    """Coördinaten (lat, lon) van een plaats zonder netwerk, of None als de gazetteer ze niet kent."""
+    place = get_gazetteer().lookup(text)
+    return (place[1], place[2]) if place else None
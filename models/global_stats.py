@@ -0,0 +1,186 @@
+from .database import get_db_connection
+from .shards import SHARDS, fan_out
+from .writer import run_write
+from .text import normalize_text
+import logging
+import json
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Logregels per schrijftransactie bij het bijwerken (korte transacties, ook bij een grote achterstand)
+GLOBAL_STATS_BATCH_SIZE = 2000
+# Standaard aantal rijen per ranglijst
+GLOBAL_STATS_LIMIT = 10
+# Elke shard levert zoveel keer de gevraagde lengte aan kandidaten voor een ranglijst over alle shards
+SHARD_CANDIDATE_FACTOR = 5
+# Ranglijsten van de globale statistiekenpagina: soort -> titel
+GLOBAL_RANKINGS = {
+    'title': 'Meest voorkomende titels',
+    'author': 'Populairste auteurs',
+    'genre': 'Populairste genres',
+    'taal': 'Talen',
+}
+
+
+def _author(book):
+    return ' '.join(part.strip() for part in (book['auteur_voornaam'] or '', book['auteur_achternaam'] or '')
+                    if part.strip())
+
+
+def book_contributions(book):
+    """[(soort, sleutel, label)] waar één boek in meetelt; sleutels zijn genormaliseerd zodat spellingen samenvallen."""
+    author = _author(book)
+    contributions = [('total', '', None), ('user', str(book['user_id']), None)]
+    title_key = normalize_text(f"{book['titel'] or ''} {book['auteur_achternaam'] or ''}")
+    if title_key:
+        label = f"{book['titel']} — {author}" if author else book['titel']
+        contributions.append(('title', title_key, label))
+    if normalize_text(author):
+        contributions.append(('author', normalize_text(author), author))
+    for kind in ('genre', 'taal'):
+        if normalize_text(book[kind]):
+            contributions.append((kind, normalize_text(book[kind]), book[kind].strip()))
+    return contributions
+
+
+def _pages(book):
+    try:
+        return max(int(book['paginas'] or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _apply(c, holding_ids):
+    """Trek de oude bijdrage van deze exemplaren af en tel de huidige op."""
+    ids = json.dumps(holding_ids)
+    deltas = {}
+
+    def add(kind, key, label, books, pages):
+        delta = deltas.setdefault((kind, key), [label, 0, 0])
+        delta[0] = delta[0] or label
+        delta[1] += books
+        delta[2] += pages
+
+    c.execute('SELECT contributions, paginas FROM global_contrib WHERE holding_id IN (SELECT value FROM json_each(?))',
+              (ids,))
+    for row in c.fetchall():
+        for kind, key in json.loads(row['contributions']):
+            add(kind, key, None, -1, -row['paginas'])
+    c.execute('DELETE FROM global_contrib WHERE holding_id IN (SELECT value FROM json_each(?))', (ids,))
+
+    c.execute('''SELECT id, user_id, titel, auteur_voornaam, auteur_achternaam, genre, taal, paginas FROM books
+                 WHERE id IN (SELECT value FROM json_each(?)) AND user_id IS NOT NULL''', (ids,))
+    contribs = []
+    for book in c.fetchall():
+        contributions = book_contributions(book)
+        pages = _pages(book)
+        for kind, key, label in contributions:
+            add(kind, key, label, 1, pages)
+        contribs.append((book['id'], json.dumps([[kind, key] for kind, key, _ in contributions]), pages))
+    c.executemany('INSERT INTO global_contrib (holding_id, contributions, paginas) VALUES (?, ?, ?)', contribs)
+
+    c.executemany('''INSERT INTO global_aggregates (kind, key, label, books, paginas) VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT(kind, key) DO UPDATE SET books = books + excluded.books,
+                                                          paginas = paginas + excluded.paginas,
+                                                          label = COALESCE(label, excluded.label)''',
+                  [(kind, key, label, books, pages) for (kind, key), (label, books, pages) in deltas.items()
+                   if books or pages])
+    c.executemany('DELETE FROM global_aggregates WHERE kind = ? AND key = ? AND books <= 0',
+                  [key for key, delta in deltas.items() if delta[1] < 0])
+
+
+def _refresh_batch(c, batch_size):
+    c.execute('SELECT MAX(id) FROM (SELECT id FROM stats_log ORDER BY id LIMIT ?)', (batch_size,))
+    last = c.fetchone()[0]
+    if last is None:
+        return 0
+    c.execute('SELECT DISTINCT holding_id FROM stats_log WHERE id <= ?', (last,))
+    holding_ids = [row[0] for row in c.fetchall()]
+    _apply(c, holding_ids)
+    c.execute('DELETE FROM stats_log WHERE id <= ?', (last,))
+    return len(holding_ids)
+
+
+def _refresh_shard(path, batch_size):
+    # Leeg log (het gewone geval bij het lezen): geen schrijfopdracht nodig
+    conn = get_db_connection(path)
+    pending = conn.execute('SELECT 1 FROM stats_log LIMIT 1').fetchone()
+    conn.close()
+    if not pending:
+        return 0
+    refreshed = 0
+    while True:
+        count = run_write(lambda c: _refresh_batch(c, batch_size), path=path)
+        if not count:
+            return refreshed
+        refreshed += count
+
+
+def refresh_global_stats(batch_size=GLOBAL_STATS_BATCH_SIZE):
+    """Verwerk het wijzigingslog van elke shard in de aggregaten; geeft het aantal herberekende exemplaren terug.
+
+    Kost evenredig met het aantal wijzigingen sinds de vorige keer, niet met de grootte van de catalogus.
+    """
+    refreshed = sum(_refresh_shard(path, batch_size) for path in SHARDS.values())
+    if refreshed:
+        logger.info(f"Global statistics refreshed for {refreshed} books")
+    return refreshed
+
+
+def _rebuild_shard(c):
+    c.execute('DELETE FROM global_aggregates')
+    c.execute('DELETE FROM global_contrib')
+    c.execute('DELETE FROM stats_log')
+    c.execute('INSERT INTO stats_log (holding_id) SELECT id FROM holdings WHERE user_id IS NOT NULL')
+
+
+def rebuild_global_stats(batch_size=GLOBAL_STATS_BATCH_SIZE):
+    """Herstel: alle aggregaten leegmaken en opnieuw opbouwen uit de boeken zelf."""
+    for path in SHARDS.values():
+        run_write(_rebuild_shard, path=path)
+    return refresh_global_stats(batch_size)
+
+
+def _shard_rankings(conn, limit):
+    c = conn.cursor()
+    totals = c.execute("SELECT books, paginas FROM global_aggregates WHERE kind = 'total'").fetchone()
+    owners = c.execute("SELECT COUNT(*) FROM global_aggregates WHERE kind = 'user' AND books > 0").fetchone()[0]
+    rankings = {}
+    for kind in GLOBAL_RANKINGS:
+        c.execute('''SELECT key, label, books, paginas FROM global_aggregates
+                     WHERE kind = ? ORDER BY books DESC LIMIT ?''', (kind, limit * SHARD_CANDIDATE_FACTOR))
+        rankings[kind] = [tuple(row) for row in c.fetchall()]
+        rankings[kind + '_count'] = c.execute('SELECT COUNT(*) FROM global_aggregates WHERE kind = ?',
+                                              (kind,)).fetchone()[0]
+    return {'books': totals['books'] if totals else 0, 'paginas': totals['paginas'] if totals else 0,
+            'owners': owners, 'rankings': rankings}
+
+
+def global_statistics(limit=GLOBAL_STATS_LIMIT, refresh=True):
+    """Instantiebrede cijfers en ranglijsten uit de aggregaten van alle shards (een paar geïndexeerde reads).
+
+    Over meerdere shards zijn de ranglijsten samengevoegd uit de beste kandidaten van elke shard; de aantallen
+    per soort zijn dan een bovengrens (dezelfde titel kan in meer dan één shard voorkomen).
+    """
+    if refresh:
+        refresh_global_stats()
+    shards = fan_out(lambda conn: _shard_rankings(conn, limit)).values()
+    stats = {
+        'total_books': sum(shard['books'] for shard in shards),
+        'total_pages': sum(shard['paginas'] for shard in shards),
+        'owners': sum(shard['owners'] for shard in shards),
+        'rankings': {},
+    }
+    for kind, title in GLOBAL_RANKINGS.items():
+        merged = {}
+        for shard in shards:
+            for key, label, books, pages in shard['rankings'][kind]:
+                entry = merged.setdefault(key, {'label': label, 'books': 0, 'pages': 0})
+                entry['books'] += books
+                entry['pages'] += pages
+        top = sorted(merged.values(), key=lambda entry: (-entry['books'], entry['label'] or ''))[:limit]
+        stats['rankings'][kind] = {'title': title, 'distinct': sum(shard['rankings'][kind + '_count'] for shard in shards),
+                                   'items': top}
+    return stats
@@ -0,0 +1,376 @@
+from .database import get_db_connection, DATABASE_PATH
+from .catalog import purge_unused_editions
+from .changes import prune_tombstones
+from .global_stats import refresh_global_stats
+from .writer import run_write
+from .shards import SHARDS, SHARD_ID_SPAN, attach_accounts, is_sharded, shard_status, shard_first_id
+from datetime import datetime
+import sqlite3
+import threading
+import logging
+import time
+import os
+import re
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Rijen per batch: korte schrijftransacties zodat gewone verzoeken er tussendoor kunnen
+PURGE_BATCH_SIZE = 500
+# Vrije pagina's die per stap teruggegeven worden aan het bestandssysteem
+VACUUM_PAGES_PER_STEP = 1000
+# Een geplande vacuümrun doet hoogstens zoveel stappen
+VACUUM_STEPS_PER_RUN = 10
+
+# Geplande onderhoudstaken en hun interval in seconden
+MAINTENANCE_INTERVALS = {
+    'optimize': int(os.environ.get('OPTIMIZE_INTERVAL', 6 * 3600)),
+    'vacuum': int(os.environ.get('VACUUM_INTERVAL', 300)),
+    'backup': int(os.environ.get('BACKUP_INTERVAL', 24 * 3600)),
+    'tombstones': int(os.environ.get('TOMBSTONE_PRUNE_INTERVAL', 24 * 3600)),
+    'global_stats': int(os.environ.get('GLOBAL_STATS_INTERVAL', 300)),
+}
+# Vacuümen alleen als dit proces zo lang geen verzoek meer kreeg
+IDLE_SECONDS = int(os.environ.get('MAINTENANCE_IDLE_SECONDS', 30))
+# Hoe vaak de planner kijkt of er een taak aan de beurt is
+SCHEDULER_TICK = int(os.environ.get('MAINTENANCE_TICK', 30))
+# Rijen per index die PRAGMA optimize bemonstert (houdt ANALYZE kort op grote tabellen)
+ANALYSIS_LIMIT = 1000
+
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUPS_TO_KEEP = int(os.environ.get('BACKUPS_TO_KEEP', 7))
+# Eén backup is de hoofddatabase plus een bestand per shard met hetzelfde tijdstip
+BACKUP_FILE_PATTERN = re.compile(r'^books-(\d{8}-\d{6})(-[A-Za-z0-9_]+)?\.db$')
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+AUTO_VACUUM_MODES = {0: 'NONE', 1: 'FULL', 2: 'INCREMENTAL'}
+
+# Wezen: rijen die verwijzen naar een gebruiker of boek dat niet meer bestaat
+ORPHAN_QUERIES = {
+    'holdings': '''SELECT id FROM holdings
+                   WHERE user_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM users WHERE users.id = holdings.user_id)''',
+    # Een boek wordt enkel gecontroleerd in de shard wiens id-bereik het bevat
+    'likes': '''SELECT id FROM likes
+                WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.id = likes.user_id)
+                   OR (likes.book_id BETWEEN :first_id AND :first_id + :span - 1
+                       AND NOT EXISTS (SELECT 1 FROM holdings WHERE holdings.id = likes.book_id))''',
+    'sessions': '''SELECT sid FROM sessions
+                   WHERE user_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM users WHERE users.id = sessions.user_id)''',
+    'collection_revisions': '''SELECT user_id FROM collection_revisions
+                               WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.id = collection_revisions.user_id)''',
+    'similar_books': '''SELECT book_id FROM similar_books
+                        WHERE NOT EXISTS (SELECT 1 FROM holdings WHERE holdings.id = similar_books.book_id)''',
+    'book_tombstones': '''SELECT book_id FROM book_tombstones
+                          WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.id = book_tombstones.user_id)''',
+}
+ORPHAN_KEYS = {'holdings': 'id', 'likes': 'id', 'sessions': 'sid', 'collection_revisions': 'user_id',
+               'similar_books': 'book_id', 'book_tombstones': 'book_id'}
+
+_purge_lock = threading.Lock()
+
+
+def _table_exists(c, table, schema='main'):
+    c.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return c.fetchone() is not None
+
+
+def _purge_shard(name, path, batch_size, removed):
+    conn = get_db_connection(path)
+    c = conn.cursor()
+    # In een shard komen users en likes uit de hoofddatabase (niet-gekwalificeerde namen vallen daarop terug)
+    schemas = ('main',)
+    if path is not None:
+        attach_accounts(conn)
+        schemas = ('main', 'accounts')
+    params = {'limit': batch_size, 'first_id': shard_first_id(name), 'span': SHARD_ID_SPAN}
+    try:
+        for table, query in ORPHAN_QUERIES.items():
+            if not any(_table_exists(c, table, schema) for schema in schemas):
+                continue
+            key = ORPHAN_KEYS[table]
+            removed.setdefault(table, 0)
+            while True:
+                c.execute(f'DELETE FROM {table} WHERE {key} IN ({query} LIMIT :limit)', params)
+                deleted = c.rowcount
+                conn.commit()
+                removed[table] += deleted
+                if deleted < batch_size:
+                    break
+        removed['editions'] = removed.get('editions', 0) + purge_unused_editions(c)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def purge_orphans(batch_size=PURGE_BATCH_SIZE):
+    """Verwijder verweesde boeken, likes en sessies in kleine batches (in elke shard); geeft het aantal per tabel."""
+    removed = {}
+    for name, path in SHARDS.items():
+        _purge_shard(name, path, batch_size, removed)
+    logger.info(f"Purged orphans: {removed}")
+    return removed
+
+
+def incremental_vacuum(pages_per_step=VACUUM_PAGES_PER_STEP, max_steps=None, should_continue=None, path=None):
+    """Geef vrije pagina's stap voor stap terug (auto_vacuum = INCREMENTAL); geeft het aantal pagina's terug.
+
+    Elke stap is een korte schrijftransactie; should_continue wordt voor elke stap gevraagd.
+    """
+    conn = get_db_connection(path)
+    c = conn.cursor()
+    freed = 0
+    steps = 0
+    try:
+        while max_steps is None or steps < max_steps:
+            if should_continue is not None and not should_continue():
+                break
+            steps += 1
+            c.execute('PRAGMA freelist_count')
+            free_pages = c.fetchone()[0]
+            if not free_pages:
+                break
+            c.execute(f'PRAGMA incremental_vacuum({int(pages_per_step)})')
+            c.fetchall()
+            c.execute('PRAGMA freelist_count')
+            remaining = c.fetchone()[0]
+            if remaining >= free_pages:
+                break  # auto_vacuum staat niet op INCREMENTAL
+            freed += free_pages - remaining
+    finally:
+        conn.close()
+    if freed:
+        logger.info(f"Incremental vacuum freed {freed} pages")
+    return freed
+
+
+def run_orphan_cleanup():
+    """Wezen opruimen en de vrijgekomen ruimte teruggeven."""
+    with _purge_lock:
+        removed = purge_orphans()
+        removed['pages_freed'] = sum(incremental_vacuum(path=path) for path in SHARDS.values())
+        return removed
+
+
+def schedule_orphan_cleanup():
+    """Start de opruimtaak op de achtergrond, tenzij ze in dit proces al loopt."""
+    if _purge_lock.locked():
+        return False
+
+    def job():
+        try:
+            run_orphan_cleanup()
+        except Exception as e:
+            logger.error(f"Error during orphan cleanup: {str(e)}")
+
+    threading.Thread(target=job, name='orphan-cleanup', daemon=True).start()
+    return True
+
+
+def optimize_database(path=None):
+    """Werk de planner-statistieken bij: de eerste keer een volledige ANALYZE, daarna PRAGMA optimize."""
+    conn = get_db_connection(path)
+    c = conn.cursor()
+    try:
+        if not _table_exists(c, 'sqlite_stat1'):
+            c.execute('ANALYZE')
+            detail = 'ANALYZE'
+        else:
+            # optimize analyseert alleen tabellen waarvan de statistieken verouderd zijn
+            c.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+            c.execute('PRAGMA optimize')
+            detail = 'PRAGMA optimize'
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"Database {path or DATABASE_PATH} optimized ({detail})")
+    return detail
+
+
+def _optimize():
+    if not is_sharded():
+        return optimize_database()
+    return ', '.join(f"{name}: {optimize_database(path)}" for name, path in SHARDS.items())
+
+
+def list_backups(backup_dir=BACKUP_DIR):
+    """Bestaande backups, nieuwste eerst."""
+    if not os.path.isdir(backup_dir):
+        return []
+    backups = []
+    for name in os.listdir(backup_dir):
+        match = BACKUP_FILE_PATTERN.match(name)
+        if match:
+            stat = os.stat(os.path.join(backup_dir, name))
+            backups.append({'name': name, 'size': stat.st_size, 'stamp': match.group(1),
+                            'created': datetime.fromtimestamp(stat.st_mtime).strftime(TIME_FORMAT)})
+    return sorted(backups, key=lambda backup: backup['name'], reverse=True)
+
+
+def _backup_file(source_path, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    source = get_db_connection(source_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        # pages=-1: alles vanuit één leestransactie, dus geen herstart bij gelijktijdige writes
+        source.backup(target, pages=-1)
+    finally:
+        target.close()
+        source.close()
+    os.replace(tmp_path, path)
+
+
+def backup_database(backup_dir=BACKUP_DIR, keep=BACKUPS_TO_KEEP):
+    """Maak een consistente kopie van de database (en elke shard) met de online backup-API; geeft het pad terug.
+
+    In WAL-modus leest de backup één momentopname terwijl andere workers gewoon blijven schrijven.
+    Een kopie krijgt pas haar definitieve naam als ze volledig is. Shards krijgen hetzelfde tijdstip
+    in hun naam; elke shard is een eigen momentopname.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(backup_dir, f"books-{stamp}.db")
+    _backup_file(None, path)
+    for name, shard_path in SHARDS.items():
+        if shard_path is not None:
+            _backup_file(shard_path, os.path.join(backup_dir, f"books-{stamp}-{re.sub(r'[^A-Za-z0-9_]', '_', name)}.db"))
+
+    # Per tijdstip bewaren, zodat een backup nooit zonder zijn shards achterblijft
+    backups = list_backups(backup_dir)
+    stamps = sorted({backup['stamp'] for backup in backups}, reverse=True)[:keep]
+    for old in backups:
+        if old['stamp'] not in stamps:
+            os.remove(os.path.join(backup_dir, old['name']))
+    logger.info(f"Backup written to {path}")
+    return path
+
+
+# Tijdstip van het laatste verzoek in dit proces (bijgewerkt door de app)
+_last_request = [time.monotonic()]
+
+
+def note_request():
+    _last_request[0] = time.monotonic()
+
+
+def is_idle():
+    return time.monotonic() - _last_request[0] >= IDLE_SECONDS
+
+
+def _vacuum():
+    return f"{sum(incremental_vacuum(path=path) for path in SHARDS.values())} pagina's vrijgegeven"
+
+
+def _idle_vacuum():
+    # Gepland: kleine stappen, en stoppen zodra er weer verzoeken binnenkomen
+    freed = sum(incremental_vacuum(max_steps=VACUUM_STEPS_PER_RUN, should_continue=is_idle, path=path)
+                for path in SHARDS.values())
+    return f"{freed} pagina's vrijgegeven"
+
+
+def _prune_tombstones():
+    return f"{prune_tombstones()} tombstones verwijderd"
+
+
+def _refresh_global_stats():
+    return f"{refresh_global_stats()} boeken bijgewerkt in de globale statistieken"
+
+
+MAINTENANCE_TASKS = {
+    'optimize': _optimize,
+    'vacuum': _vacuum,
+    'backup': backup_database,
+    'tombstones': _prune_tombstones,
+    'global_stats': _refresh_global_stats,
+}
+# Varianten die de planner gebruikt in plaats van de handmatige taak
+SCHEDULED_TASKS = {'vacuum': _idle_vacuum}
+
+
+def _claim_task(task, interval):
+    """Claim een taak als ze aan de beurt is; de UPDATE is atomair, dus maar één worker wint."""
+    now = datetime.now()
+    due_before = datetime.fromtimestamp(now.timestamp() - interval).strftime(TIME_FORMAT)
+
+    def claim(c):
+        c.execute('INSERT OR IGNORE INTO maintenance_runs (task) VALUES (?)', (task,))
+        c.execute('UPDATE maintenance_runs SET last_run = ? WHERE task = ? AND (last_run IS NULL OR last_run < ?)',
+                  (now.strftime(TIME_FORMAT), task, due_before))
+        return c.rowcount == 1
+
+    return run_write(claim)
+
+
+def run_task(task, scheduled=False):
+    """Voer één onderhoudstaak uit en bewaar tijdstip, duur en resultaat; geeft (success, detail) terug."""
+    job = SCHEDULED_TASKS.get(task, MAINTENANCE_TASKS[task]) if scheduled else MAINTENANCE_TASKS[task]
+    started = time.monotonic()
+    try:
+        detail, success = str(job()), True
+    except Exception as e:
+        logger.error(f"Maintenance task {task} failed: {str(e)}")
+        detail, success = f"Fout: {str(e)}", False
+    duration = round(time.monotonic() - started, 3)
+
+    def record(c):
+        c.execute('INSERT OR IGNORE INTO maintenance_runs (task) VALUES (?)', (task,))
+        c.execute('UPDATE maintenance_runs SET last_run = ?, duration = ?, detail = ? WHERE task = ?',
+                  (datetime.now().strftime(TIME_FORMAT), duration, detail, task))
+
+    run_write(record)
+    return success, detail
+
+
+def database_status():
+    """Bestandsgrootte, vrije pagina's, laatste runs en backups voor de onderhoudspagina."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    page_size = c.execute('PRAGMA page_size').fetchone()[0]
+    page_count = c.execute('PRAGMA page_count').fetchone()[0]
+    free_pages = c.execute('PRAGMA freelist_count').fetchone()[0]
+    auto_vacuum = c.execute('PRAGMA auto_vacuum').fetchone()[0]
+    journal_mode = c.execute('PRAGMA journal_mode').fetchone()[0]
+    runs = {row['task']: dict(row) for row in c.execute('SELECT task, last_run, duration, detail FROM maintenance_runs')}
+    conn.close()
+    wal_path = DATABASE_PATH + '-wal'
+    return {
+        'file_size': page_size * page_count,
+        'wal_size': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        'page_count': page_count,
+        'free_pages': free_pages,
+        'free_ratio': round(free_pages / page_count, 4) if page_count else 0.0,
+        'auto_vacuum': AUTO_VACUUM_MODES.get(auto_vacuum, auto_vacuum),
+        'journal_mode': journal_mode,
+        'tasks': [dict(runs.get(task, {'last_run': None, 'duration': None, 'detail': None}),
+                       task=task, interval=interval) for task, interval in MAINTENANCE_INTERVALS.items()],
+        'backups': list_backups(),
+        'shards': shard_status() if is_sharded() else [],
+    }
+
+
+def _scheduler_loop():
+    while True:
+        time.sleep(SCHEDULER_TICK)
+        for task, interval in MAINTENANCE_INTERVALS.items():
+            if task == 'vacuum' and not is_idle():
+                continue
+            try:
+                if _claim_task(task, interval):
+                    run_task(task, scheduled=True)
+            except Exception as e:
+                logger.error(f"Maintenance scheduler error for {task}: {str(e)}")
+
+
+_scheduler_pid = [None]
+_scheduler_lock = threading.Lock()
+
+
+def start_scheduler():
+    """Start de planner één keer per proces; elke worker plant, maar elke taak draait maar in één."""
+    with _scheduler_lock:
+        if _scheduler_pid[0] == os.getpid():
+            return False
+        _scheduler_pid[0] = os.getpid()
+    threading.Thread(target=_scheduler_loop, name='db-maintenance', daemon=True).start()
+    logger.info(f"Maintenance scheduler started in process {os.getpid()}")
+    return True
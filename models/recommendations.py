@@ -0,0 +1,290 @@
+from .shards import user_connection, run_user_write
+from .catalog import BOOKS_SELECT
+from .cache import get_collection_revision
+from .text import normalize_text
+import numpy as np
+import threading
+import logging
+import json
+import os
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Aantal vergelijkbare boeken dat per boek bewaard wordt
+TOP_K = 8
+# Gewicht per kenmerk; zeldzame waarden tellen zwaarder mee (idf binnen de collectie)
+FEATURE_WEIGHTS = {'auteur': 3.0, 'serie': 3.0, 'genre': 1.5, 'uitgeverij': 1.0, 'taal': 0.5}
+# Maximale grootte (cellen) van één blok scores; begrenst het geheugen bij grote collecties
+BLOCK_CELLS = 4_000_000
+# Na zoveel incrementele wijzigingen (als fractie van de collectie) volgt een volledige herberekening,
+# zodat de idf-gewichten weer kloppen
+REBUILD_FRACTION = 0.2
+# Seconden na de laatste wijziging waarna de index op de achtergrond bijgewerkt wordt
+SIMILAR_REFRESH_DELAY = float(os.environ.get('SIMILAR_REFRESH_DELAY', 2))
+
+
+def _features(row):
+    """Kenmerken van één boek als (naam, waarde)-paren; lookup-velden gebruiken hun integer-code."""
+    features = []
+    author = normalize_text(f"{row['auteur_voornaam'] or ''} {row['auteur_achternaam'] or ''}")
+    if author:
+        features.append(('auteur', author))
+    serie = normalize_text(row['serie'])
+    if serie:
+        features.append(('serie', serie))
+    uitgeverij = normalize_text(row['uitgeverij'])
+    if uitgeverij:
+        features.append(('uitgeverij', uitgeverij))
+    for field in ('genre', 'taal'):
+        if row[f'{field}_code'] is not None:
+            features.append((field, row[f'{field}_code']))
+    return features
+
+
+class FeatureMatrix:
+    """Genormaliseerde tf-idf-kenmerkvectoren van een collectie, als CSR (per boek) en CSC (per kenmerk)."""
+
+    def __init__(self, book_ids, row_idx, col_idx, weights, n_features):
+        self.book_ids = np.asarray(book_ids, dtype=np.int64)
+        self.row_of = {int(book_id): i for i, book_id in enumerate(self.book_ids)}
+        n = len(self.book_ids)
+
+        doc_freq = np.bincount(col_idx, minlength=n_features)
+        values = weights * np.log1p(n / np.maximum(doc_freq, 1))[col_idx]
+        norms = np.sqrt(np.bincount(row_idx, weights=values ** 2, minlength=n))
+        values = values / np.where(norms > 0, norms, 1.0)[row_idx]
+
+        # Entries komen per boek binnen, dus ze staan al in CSR-volgorde
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(row_idx, minlength=n))))
+        self.indices = col_idx
+        self.data = values
+        order = np.argsort(col_idx, kind='stable')
+        self.colptr = np.concatenate(([0], np.cumsum(doc_freq)))
+        self.col_rows = row_idx[order]
+        self.col_data = values[order]
+
+    def __len__(self):
+        return len(self.book_ids)
+
+    def scores(self, rows):
+        """Cosinusgelijkenis van de gegeven rijen met alle boeken (dichte len(rows) x n matrix).
+
+        Sparse X[rows] @ X.T: elk kenmerk van een rij wordt vermenigvuldigd met de postinglijst van dat
+        kenmerk en met bincount opgeteld, zonder Python-lus per boek.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        n = len(self)
+        entry_pos, entry_counts = _ranges(self.indptr[rows], self.indptr[rows + 1] - self.indptr[rows])
+        entry_row = np.repeat(np.arange(len(rows)), entry_counts)
+        entry_col = self.indices[entry_pos]
+        post_pos, post_counts = _ranges(self.colptr[entry_col], self.colptr[entry_col + 1] - self.colptr[entry_col])
+        out_index = np.repeat(entry_row, post_counts) * n + self.col_rows[post_pos]
+        out_value = np.repeat(self.data[entry_pos], post_counts) * self.col_data[post_pos]
+        return np.bincount(out_index, weights=out_value, minlength=len(rows) * n).reshape(len(rows), n)
+
+
+def _ranges(starts, lengths):
+    """Posities starts[i] .. starts[i] + lengths[i] achter elkaar (gevectoriseerd)."""
+    total = int(lengths.sum())
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.arange(total) - offsets + np.repeat(starts, lengths), lengths
+
+
+def load_matrix(c, user_id):
+    c.execute('''SELECT h.id, h.genre_code, e.taal_code, e.auteur_voornaam, e.auteur_achternaam, e.serie, e.uitgeverij
+                 FROM holdings h JOIN editions e ON e.id = h.edition_id
+                 WHERE h.user_id = ? ORDER BY h.id''', (user_id,))
+    vocabulary = {}
+    book_ids, row_idx, col_idx, weights = [], [], [], []
+    for row in c.fetchall():
+        for feature in _features(row):
+            row_idx.append(len(book_ids))
+            col_idx.append(vocabulary.setdefault(feature, len(vocabulary)))
+            weights.append(FEATURE_WEIGHTS[feature[0]])
+        book_ids.append(row['id'])
+    return FeatureMatrix(book_ids, np.array(row_idx, dtype=np.int64), np.array(col_idx, dtype=np.int64),
+                         np.array(weights, dtype=np.float64), len(vocabulary))
+
+
+def _top_k(matrix, rows, k=TOP_K):
+    """Per rij de k meest gelijkende andere boeken als [[book_id, score], ...]."""
+    neighbours = {}
+    if len(matrix) < 2:
+        return {int(matrix.book_ids[row]): [] for row in rows}
+    block_size = max(1, BLOCK_CELLS // len(matrix))
+    k = min(k, len(matrix) - 1)
+    for start in range(0, len(rows), block_size):
+        block = np.asarray(rows[start:start + block_size], dtype=np.int64)
+        scores = matrix.scores(block)
+        scores[np.arange(len(block)), block] = -1.0  # niet zichzelf aanraden
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for i, row in enumerate(block):
+            ranked = best[i][np.argsort(-scores[i, best[i]], kind='stable')]
+            neighbours[int(matrix.book_ids[row])] = [[int(matrix.book_ids[j]), round(float(scores[i, j]), 4)]
+                                                     for j in ranked if scores[i, j] > 0]
+    return neighbours
+
+
+def _store(c, user_id, neighbours):
+    c.executemany('INSERT OR REPLACE INTO similar_books (book_id, user_id, neighbors) VALUES (?, ?, ?)',
+                  [(book_id, user_id, json.dumps(items)) for book_id, items in neighbours.items()])
+
+
+def invalidate_similar_books(c, user_id=None):
+    """Markeer de index van een gebruiker (of van iedereen) als verouderd; de volgende opvraging bouwt ze opnieuw."""
+    if user_id is None:
+        c.execute('DELETE FROM similar_books_state')
+        c.execute('DELETE FROM similar_books_pending')
+    else:
+        c.execute('DELETE FROM similar_books_state WHERE user_id = ?', (user_id,))
+        c.execute('DELETE FROM similar_books_pending WHERE user_id = ?', (user_id,))
+
+
+def mark_similar_books(c, user_id, book_ids):
+    """Noteer binnen de schrijftransactie welke boeken toegevoegd, gewijzigd of verwijderd zijn.
+
+    Kost enkel een paar inserts; het herberekenen gebeurt daarna buiten de schrijver (zie refresh_similar_books),
+    kort na de laatste wijziging of bij de volgende opvraging.
+    """
+    c.execute('SELECT 1 FROM similar_books_state WHERE user_id = ?', (user_id,))
+    if c.fetchone() is None:
+        return  # (nog) geen index: wordt bij de eerste opvraging volledig gebouwd
+    c.executemany('INSERT OR IGNORE INTO similar_books_pending (book_id, user_id) VALUES (?, ?)',
+                  [(int(book_id), user_id) for book_id in book_ids])
+    schedule_similar_refresh(user_id)
+
+
+def _incremental(c, user_id, matrix, changed):
+    """Nieuwe rijen voor de gewijzigde boeken, de boeken die er één in hun lijst hadden (hun score kan gedaald
+    zijn) en de boeken waarvan de top-k verandert door de nieuwe scores. Geeft (bij te werken, verdwenen)."""
+    c.execute('SELECT book_id, neighbors FROM similar_books WHERE user_id = ?', (user_id,))
+    current = {row['book_id']: json.loads(row['neighbors']) for row in c.fetchall()}
+    present = sorted(book_id for book_id in changed if book_id in matrix.row_of)
+    affected = set(present) | {book_id for book_id, items in current.items()
+                               if book_id not in changed and any(item[0] in changed for item in items)}
+    gone = [book_id for book_id in changed if book_id not in matrix.row_of]
+    updated = _top_k(matrix, [matrix.row_of[book_id] for book_id in affected if book_id in matrix.row_of])
+
+    if present and len(matrix) > 1:
+        # Gelijkenis is symmetrisch: de scores van de gewijzigde boeken zijn ook die van de anderen
+        scores = matrix.scores([matrix.row_of[book_id] for book_id in present])
+        for j in np.flatnonzero((scores > 0).any(axis=0)):
+            book_id = int(matrix.book_ids[j])
+            if book_id in affected or book_id not in current:
+                continue
+            items = current[book_id] + [[present[i], round(float(scores[i, j]), 4)]
+                                        for i in np.flatnonzero(scores[:, j] > 0) if present[i] != book_id]
+            items = sorted(items, key=lambda item: -item[1])[:TOP_K]
+            if items != current[book_id]:
+                updated[book_id] = items
+    return updated, gone
+
+
+def refresh_similar_books(user_id, attempts=3):
+    """Breng de index van een gebruiker bij: de wachtende wijzigingen verwerken, of alles opnieuw berekenen als
+    er nog geen index is of de wijzigingen REBUILD_FRACTION van de collectie bereiken (exacte idf-gewichten).
+
+    Het rekenwerk gebeurt op een eigen leesverbinding (één WAL-momentopname); de schrijver slaat enkel het
+    resultaat op, en alleen als de collectie intussen niet veranderd is (anders opnieuw). Geeft True terug
+    als de index daarna bij is.
+    """
+    for _ in range(attempts):
+        conn = user_connection(user_id)
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN')
+            rev = get_collection_revision(c, user_id)
+            c.execute('SELECT changes FROM similar_books_state WHERE user_id = ?', (user_id,))
+            state = c.fetchone()
+            c.execute('SELECT book_id FROM similar_books_pending WHERE user_id = ?', (user_id,))
+            changed = {row[0] for row in c.fetchall()}
+            if state is not None and not changed:
+                return True
+            matrix = load_matrix(c, user_id)
+            full = state is None or state['changes'] + len(changed) > max(TOP_K, REBUILD_FRACTION * len(matrix))
+            if full:
+                updated, gone = _top_k(matrix, np.arange(len(matrix))), []
+            else:
+                updated, gone = _incremental(c, user_id, matrix, changed)
+        finally:
+            conn.rollback()
+            conn.close()
+
+        def store(c):
+            if get_collection_revision(c, user_id) != rev:
+                return False
+            if full:
+                c.execute('DELETE FROM similar_books WHERE user_id = ?', (user_id,))
+                c.execute('INSERT OR REPLACE INTO similar_books_state (user_id, changes) VALUES (?, 0)', (user_id,))
+            else:
+                c.executemany('DELETE FROM similar_books WHERE book_id = ?', [(book_id,) for book_id in gone])
+                c.execute('UPDATE similar_books_state SET changes = changes + ? WHERE user_id = ?',
+                          (len(changed), user_id))
+            _store(c, user_id, updated)
+            c.execute('DELETE FROM similar_books_pending WHERE user_id = ?', (user_id,))
+            return True
+
+        if run_user_write(user_id, store):
+            if full:
+                logger.info(f"Built similar books for user {user_id} ({len(matrix)} books)")
+            else:
+                logger.debug(f"Refreshed {len(updated)} similar-book rows for user {user_id}")
+            return True
+    logger.debug(f"Similar books for user {user_id} kept changing; refresh postponed")
+    return False
+
+
+_scheduled = {}
+_scheduled_lock = threading.Lock()
+
+
+def schedule_similar_refresh(user_id, delay=SIMILAR_REFRESH_DELAY):
+    """Ververs de index van een gebruiker delay seconden na zijn laatste wijziging (debounce), buiten de schrijver."""
+    with _scheduled_lock:
+        timer = _scheduled.get(user_id)
+        if timer is not None:
+            timer.cancel()
+        timer = _scheduled[user_id] = threading.Timer(delay, _run_scheduled_refresh, (user_id,))
+        timer.daemon = True
+        timer.start()
+
+
+def _run_scheduled_refresh(user_id):
+    with _scheduled_lock:
+        if _scheduled.get(user_id) is not None and _scheduled[user_id] is threading.current_thread():
+            del _scheduled[user_id]
+    try:
+        refresh_similar_books(user_id)
+    except Exception as e:
+        logger.error(f"Error refreshing similar books for user {user_id}: {str(e)}")
+
+
+def get_similar_books(user_id, book_id):
+    """Vergelijkbare boeken voor één boek: een primaire-sleutel lookup in de voorberekende index.
+
+    Wachtende wijzigingen worden eerst verwerkt; zonder wijzigingen kost dat twee lookups.
+    """
+    try:
+        refresh_similar_books(user_id)
+    except Exception as e:
+        # Liever een iets verouderde lijst dan geen
+        logger.error(f"Error refreshing similar books for user {user_id}: {str(e)}")
+    conn = user_connection(user_id)
+    c = conn.cursor()
+    try:
+        c.execute('SELECT neighbors FROM similar_books WHERE book_id = ? AND user_id = ?', (book_id, user_id))
+        row = c.fetchone()
+        if row is None:
+            return None
+        scores = {neighbor_id: score for neighbor_id, score in json.loads(row['neighbors'])}
+        if not scores:
+            return []
+        c.execute(f'''SELECT id, titel, auteur_voornaam, auteur_achternaam, genre, serie, reeks_nr
+                      FROM ({BOOKS_SELECT}) WHERE id IN (SELECT value FROM json_each(?))''',
+                  (json.dumps(list(scores)),))
+        books = [dict(book, score=scores[book['id']]) for book in c.fetchall()]
+        return sorted(books, key=lambda book: -book['score'])
+    finally:
+        conn.close()
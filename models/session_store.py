@@ -0,0 +1,179 @@
+from .database import get_db_connection
+from .writer import run_write
+from .cache import LRUCache
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+import secrets
+import threading
+import time
+import logging
+import os
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Hoe lang een worker een sessie uit zijn eigen cache mag gebruiken voor hij de database opnieuw leest;
+# zo bereikt een intrekking in een andere worker elke sessie binnen deze tijd
+SESSION_CACHE_SECONDS = int(os.environ.get('SESSION_CACHE_SECONDS', 10))
+
+# Verlopen sessies worden per proces hoogstens zo vaak opgeruimd, telkens in batches
+SESSION_CLEANUP_INTERVAL = int(os.environ.get('SESSION_CLEANUP_INTERVAL', 300))
+SESSION_CLEANUP_BATCH = 1000
+
+session_cache = LRUCache('sessions',
+                         max_entries=int(os.environ.get('SESSION_CACHE_MAX_ENTRIES', 10000)),
+                         max_bytes=int(os.environ.get('SESSION_CACHE_MAX_BYTES', 8 * 1024 * 1024)))
+
+_serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Sessie waarvan alleen het id in de cookie staat; de inhoud staat in de sessions-tabel."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.rotated_from = None
+
+    def rotate(self):
+        """Nieuw sessie-id na inloggen (tegen session fixation); de oude rij wordt verwijderd."""
+        if not self.new:
+            self.rotated_from = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+
+class SqliteSessionInterface(SessionInterface):
+    """Sessies in SQLite, gedeeld door alle workers, met een korte per-proces cache voor drukke sessies."""
+
+    def __init__(self):
+        self._cleanup_lock = threading.Lock()
+        self._next_cleanup = 0
+
+    def open_session(self, app, request):
+        self._cleanup_expired()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid or len(sid) > 64:
+            return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+        now = time.time()
+        entry = session_cache.get(sid)
+        if entry is not None and now - entry['cached_at'] < SESSION_CACHE_SECONDS and entry['expires_at'] > now:
+            return ServerSideSession(_serializer.loads(entry['data']), sid=sid)
+
+        conn = get_db_connection()
+        row = conn.execute('SELECT data, user_id, expires_at FROM sessions WHERE sid = ? AND expires_at > ?',
+                           (sid, int(now))).fetchone()
+        conn.close()
+        if row is None:
+            session_cache.discard(sid)
+            return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+        self._cache(sid, row['data'], row['user_id'], row['expires_at'])
+        return ServerSideSession(_serializer.loads(row['data']), sid=sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self._delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = int(time.time())
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        entry = session_cache.get(session.sid)
+        # Niet-gewijzigde sessies alleen verlengen als de helft van hun levensduur voorbij is
+        needs_refresh = entry is None or entry['expires_at'] - now < lifetime / 2
+        if not (session.modified or session.new or needs_refresh):
+            return
+
+        data = _serializer.dumps(dict(session))
+        user_id = session.get('user_id')
+        expires_at = now + lifetime
+
+        def save(c):
+            if session.new:
+                if session.rotated_from:
+                    c.execute('DELETE FROM sessions WHERE sid = ?', (session.rotated_from,))
+                c.execute('INSERT INTO sessions (sid, user_id, data, expires_at) VALUES (?, ?, ?, ?)',
+                          (session.sid, user_id, data, expires_at))
+                return True
+            c.execute('UPDATE sessions SET user_id = ?, data = ?, expires_at = ? WHERE sid = ?',
+                      (user_id, data, expires_at, session.sid))
+            return c.rowcount > 0
+
+        if session.new and session.rotated_from:
+            session_cache.discard(session.rotated_from)
+        if not run_write(save):
+            # Ingetrokken (of verlopen en opgeruimd) tijdens dit verzoek: niet opnieuw aanmaken
+            session_cache.discard(session.sid)
+            response.delete_cookie(name, domain=domain, path=path)
+            return
+        self._cache(session.sid, data, user_id, expires_at)
+
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def _cache(self, sid, data, user_id, expires_at):
+        # De geserialiseerde vorm bewaren: elk verzoek krijgt zo een eigen kopie van de sessie
+        session_cache.put(sid, {'data': data, 'user_id': user_id, 'expires_at': expires_at,
+                                'cached_at': time.time()}, len(data) + 128)
+
+    def _delete(self, sid):
+        run_write(lambda c: c.execute('DELETE FROM sessions WHERE sid = ?', (sid,)))
+        session_cache.discard(sid)
+
+    def _cleanup_expired(self):
+        now = time.time()
+        if now < self._next_cleanup or not self._cleanup_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_cleanup = now + SESSION_CLEANUP_INTERVAL
+
+            def delete_batch(c):
+                c.execute('''DELETE FROM sessions WHERE sid IN
+                             (SELECT sid FROM sessions WHERE expires_at <= ? LIMIT ?)''',
+                          (int(now), SESSION_CLEANUP_BATCH))
+                return c.rowcount
+
+            # Kleine batches, zodat andere schrijfopdrachten ertussen kunnen
+            removed = 0
+            while True:
+                deleted = run_write(delete_batch)
+                removed += deleted
+                if deleted < SESSION_CLEANUP_BATCH:
+                    break
+            if removed:
+                logger.info(f"Removed {removed} expired sessions")
+        except Exception as e:
+            logger.error(f"Error during session cleanup: {str(e)}")
+        finally:
+            self._cleanup_lock.release()
+
+
+def revoke_user_sessions(user_id, c=None):
+    """Trek alle sessies van een gebruiker in (na verwijderen of rolwijziging).
+
+    Met een cursor gebeurt het binnen de transactie van de aanroeper.
+    """
+    user_id = int(user_id)
+    if c is None:
+        run_write(lambda w: w.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,)))
+    else:
+        c.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+    session_cache.discard_where(lambda entry: entry['user_id'] == user_id)
+    logger.info(f"Revoked sessions of user {user_id}")
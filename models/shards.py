@@ -0,0 +1,360 @@
+from .database import get_db_connection, init_shard_db, DATABASE_PATH
+from .writer import run_write, WRITE_TIMEOUT
+from .catalog import add_holding, purge_unused_editions
+from .book_record import books_from_cursor
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import json
+import os
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# De hoofddatabase (gebruikers, sessies, router) is zelf ook een shard
+MAIN_SHARD = 'main'
+# Elke shard deelt boek-id's uit zijn eigen bereik uit: het id van een boek zegt in welke shard het staat
+SHARD_ID_SPAN = 10 ** 12
+# Rebalancen stopt zodra elke shard binnen deze fractie van het gemiddelde aantal boeken zit
+REBALANCE_TOLERANCE = 0.1
+
+
+def _configured_shards():
+    """Shards uit BOOK_SHARDS ('naam=pad,naam=pad'); zonder configuratie is er enkel de hoofddatabase."""
+    shards = {MAIN_SHARD: None}
+    for item in os.environ.get('BOOK_SHARDS', '').split(','):
+        name, _, path = item.partition('=')
+        if name.strip() and path.strip():
+            shards[name.strip()] = path.strip()
+    return shards
+
+
+# Naam -> pad (None = hoofddatabase) en het eerste boek-id van elke shard
+SHARDS = _configured_shards()
+_first_ids = {MAIN_SHARD: 0}
+
+
+def init_shards():
+    """Registreer de geconfigureerde shards in de hoofddatabase en maak hun tabellen aan.
+
+    Het id-bereik van een shard wordt bij de eerste registratie vastgelegd en verandert daarna nooit,
+    ook niet als de volgorde in BOOK_SHARDS wijzigt.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('INSERT OR IGNORE INTO shards (name, first_id) VALUES (?, 0)', (MAIN_SHARD,))
+    for name in SHARDS:
+        c.execute('INSERT OR IGNORE INTO shards (name, first_id) SELECT ?, MAX(first_id) + ? FROM shards',
+                  (name, SHARD_ID_SPAN))
+    conn.commit()
+    _first_ids.update({row['name']: row['first_id'] for row in c.execute('SELECT name, first_id FROM shards')})
+    conn.close()
+    for name, path in SHARDS.items():
+        if path is not None:
+            init_shard_db(path, _first_ids[name])
+            logger.info(f"Shard {name} ready at {path} (ids from {_first_ids[name]})")
+
+
+def is_sharded():
+    return len(SHARDS) > 1
+
+
+def user_shard(user_id):
+    """Naam van de shard met de boeken van een gebruiker (primaire-sleutel lookup in de router)."""
+    if not is_sharded() or user_id is None:
+        return MAIN_SHARD
+    conn = get_db_connection()
+    row = conn.execute('SELECT shard FROM user_shards WHERE user_id = ?', (int(user_id),)).fetchone()
+    conn.close()
+    return row['shard'] if row and row['shard'] in SHARDS else MAIN_SHARD
+
+
+def book_shard(book_id):
+    """Naam van de shard met een boek, afgeleid uit het id-bereik (zonder query)."""
+    first_id = int(book_id) // SHARD_ID_SPAN * SHARD_ID_SPAN
+    for name, start in _first_ids.items():
+        if start == first_id and name in SHARDS:
+            return name
+    return MAIN_SHARD
+
+
+def user_connection(user_id):
+    """Verbinding met de shard van een gebruiker; voor alle boekqueries van die gebruiker."""
+    return get_db_connection(SHARDS[user_shard(user_id)])
+
+
+def shard_first_id(name):
+    return _first_ids.get(name, 0)
+
+
+def book_connection(book_id):
+    return get_db_connection(SHARDS[book_shard(book_id)])
+
+
+class _Moved(Exception):
+    """De gebruiker is verhuisd terwijl zijn schrijfopdracht in de wachtrij stond."""
+
+
+def run_user_write(user_id, job, timeout=WRITE_TIMEOUT):
+    """Voer job(c) uit via de schrijfthread van de shard van een gebruiker.
+
+    De route wordt binnen de schrijftransactie opnieuw gecontroleerd: een opdracht die wachtte terwijl
+    move_user de gebruiker verhuisde, wordt opnieuw naar de nieuwe shard gestuurd.
+    """
+    while True:
+        shard = user_shard(user_id)
+
+        def routed(c):
+            if is_sharded() and user_shard(user_id) != shard:
+                raise _Moved()
+            return job(c)
+
+        try:
+            return run_write(routed, timeout, path=SHARDS[shard])
+        except _Moved:
+            logger.debug(f"User {user_id} moved away from shard {shard}; retrying write")
+
+
+def run_book_write(book_id, job, timeout=WRITE_TIMEOUT):
+    return run_write(job, timeout, path=SHARDS[book_shard(book_id)])
+
+
+def assign_shard(user_id):
+    """Plaats een nieuwe gebruiker in de shard met de minste gebruikers; geeft de shardnaam terug."""
+    if not is_sharded():
+        return MAIN_SHARD
+
+    def assign(c):
+        # Tellen en toewijzen in één schrijfopdracht, zodat gelijktijdige registraties elkaars keuze zien
+        counts = {name: 0 for name in SHARDS}
+        for row in c.execute('SELECT shard, COUNT(*) AS users FROM user_shards GROUP BY shard'):
+            if row['shard'] in counts:
+                counts[row['shard']] = row['users']
+        counts[MAIN_SHARD] = c.execute('''SELECT COUNT(*) FROM users
+                                          WHERE id NOT IN (SELECT user_id FROM user_shards)''').fetchone()[0]
+        shard = min(counts, key=lambda name: (counts[name], name != MAIN_SHARD))
+        if shard != MAIN_SHARD:
+            c.execute('INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)', (int(user_id), shard))
+        return shard
+
+    return run_write(assign)
+
+
+def _on_shard(name, query):
+    conn = get_db_connection(SHARDS[name])
+    try:
+        return query(conn)
+    finally:
+        conn.close()
+
+
+def fan_out(query):
+    """Voer query(conn) parallel uit op elke shard; geeft {shardnaam: resultaat} terug."""
+    if not is_sharded():
+        return {MAIN_SHARD: _on_shard(MAIN_SHARD, query)}
+    with ThreadPoolExecutor(max_workers=len(SHARDS), thread_name_prefix='shard') as pool:
+        futures = {name: pool.submit(_on_shard, name, query) for name in SHARDS}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def attach_accounts(conn):
+    """Maak users (en de router) van de hoofddatabase zichtbaar in een shardverbinding, bv. voor wezen-queries."""
+    conn.execute('ATTACH DATABASE ? AS accounts', (DATABASE_PATH,))
+
+
+def shard_status():
+    """Per shard: pad, aantal gebruikers met boeken, aantal boeken en bestandsgrootte."""
+    counts = fan_out(lambda conn: conn.execute('''SELECT COUNT(DISTINCT user_id) AS users, COUNT(*) AS books
+                                                  FROM holdings WHERE user_id IS NOT NULL''').fetchone())
+    status = []
+    for name, path in SHARDS.items():
+        file_path = path or DATABASE_PATH
+        status.append({'name': name, 'path': file_path, 'first_id': _first_ids.get(name),
+                       'users': counts[name]['users'], 'books': counts[name]['books'],
+                       'size': os.path.getsize(file_path) if os.path.exists(file_path) else 0})
+    return status
+
+
+def _set_route(c, user_id, shard):
+    if shard == MAIN_SHARD:
+        c.execute('DELETE FROM user_shards WHERE user_id = ?', (user_id,))
+    else:
+        c.execute('INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)', (user_id, shard))
+
+
+def _remap_likes(c, id_map):
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'likes'")
+    if c.fetchone():
+        c.executemany('UPDATE likes SET book_id = ? WHERE book_id = ?',
+                      [(new_id, old_id) for old_id, new_id in id_map.items()])
+
+
+def _copy_user(c, target_path, user_id):
+    """Kopieer de boeken van een gebruiker naar een andere shard (één transactie); geeft {oud id: nieuw id}."""
+    c.execute('SELECT * FROM books WHERE user_id = ? ORDER BY id', (user_id,))
+    books = books_from_cursor(c)
+    c.execute('SELECT book_id FROM book_tombstones WHERE user_id = ?', (user_id,))
+    deleted_ids = [row['book_id'] for row in c.fetchall()]
+    c.execute('''SELECT DISTINCT e.isbn_key, e.cover_url, e.cover_land
+                 FROM holdings h JOIN editions e ON e.id = h.edition_id
+                 WHERE h.user_id = ? AND e.isbn_key IS NOT NULL AND e.cover_url IS NOT NULL''', (user_id,))
+    covers = [(row['cover_url'], row['cover_land'], row['isbn_key']) for row in c.fetchall()]
+    # Private kopieën van een editie (zie update_holding) blijven privé
+    c.execute('''SELECT h.id FROM holdings h JOIN editions e ON e.id = h.edition_id
+                 WHERE h.user_id = ? AND e.isbn_key IS NULL AND e.isbn13 IS NOT NULL''', (user_id,))
+    private_ids = {row['id'] for row in c.fetchall()}
+    c.execute('SELECT rev FROM collection_revisions WHERE user_id = ?', (user_id,))
+    row = c.fetchone()
+    collection_rev = row['rev'] if row else 0
+    change_rev = c.execute('SELECT rev FROM change_seq WHERE id = 1').fetchone()['rev']
+
+    target = get_db_connection(target_path)
+    tc = target.cursor()
+    try:
+        tc.execute('BEGIN IMMEDIATE')
+        # Resten van een eerder afgebroken verhuis eerst weg
+        tc.execute('DELETE FROM holdings WHERE user_id = ?', (user_id,))
+        tc.execute('DELETE FROM book_tombstones WHERE user_id = ?', (user_id,))
+        # Nieuwe revisies liggen boven alles wat de client al van de bronshard kent
+        tc.execute('UPDATE change_seq SET rev = MAX(rev, ?) WHERE id = 1', (change_rev,))
+        id_map = {book.id: add_holding(tc, book, private=book.id in private_ids) for book in books}
+        # Opgehaalde kaften horen bij de editie, niet bij de boekenrij
+        tc.executemany('''UPDATE editions SET cover_url = COALESCE(cover_url, ?), cover_land = COALESCE(cover_land, ?)
+                          WHERE isbn_key = ?''', covers)
+        # Voor de wijzigingsfeed zijn de oude id's verwijderd, net als wat al eerder verwijderd was
+        tc.execute('UPDATE change_seq SET rev = rev + 1 WHERE id = 1')
+        tc.executemany('''INSERT OR REPLACE INTO book_tombstones (book_id, user_id, rev, deleted_at)
+                          VALUES (?, ?, (SELECT rev FROM change_seq WHERE id = 1), datetime('now', 'localtime'))''',
+                       [(book_id, user_id) for book_id in list(id_map) + deleted_ids])
+        # Cachesleutels (gebruiker, revisie) mogen niet terugvallen naar een oudere revisie
+        tc.execute('INSERT OR REPLACE INTO collection_revisions (user_id, rev) VALUES (?, ?)',
+                   (user_id, collection_rev + 1))
+        tc.execute('DELETE FROM similar_books WHERE user_id = ?', (user_id,))
+        tc.execute('DELETE FROM similar_books_state WHERE user_id = ?', (user_id,))
+        tc.execute('DELETE FROM similar_books_pending WHERE user_id = ?', (user_id,))
+        target.commit()
+    except Exception:
+        target.rollback()
+        raise
+    finally:
+        target.close()
+    return id_map
+
+
+def _drop_user(c, user_id):
+    """Verwijder de boeken van een verhuisde gebruiker uit de bronshard (zonder tombstones)."""
+    c.execute('DELETE FROM holdings WHERE user_id = ?', (user_id,))
+    purge_unused_editions(c)
+    for table in ('book_tombstones', 'similar_books', 'similar_books_state', 'similar_books_pending',
+                  'collection_revisions'):
+        c.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+
+
+def move_user(user_id, target):
+    """Verhuis de boeken van een gebruiker online naar een andere shard; geeft (success, message) terug.
+
+    De verhuis loopt als opdracht op de schrijfthread van de bronshard en houdt dus diens schrijfvergrendeling:
+    schrijfopdrachten voor de gebruiker wachten en gaan daarna via run_user_write naar de nieuwe shard. Lezers
+    zien tot de router omgaat de bron, daarna het doel. Boeken krijgen een id uit het bereik van de doelshard.
+    """
+    user_id = int(user_id)
+    if target not in SHARDS:
+        return False, f"Onbekende shard: {target}"
+    source = user_shard(user_id)
+    if source == target:
+        return False, f"Gebruiker {user_id} staat al in shard {target}."
+
+    def move(c):
+        if user_shard(user_id) != source:
+            raise _Moved()
+        id_map = _copy_user(c, SHARDS[target], user_id)
+        if source == MAIN_SHARD:
+            # Router en likes staan in de bron zelf: zelfde transactie
+            _set_route(c, user_id, target)
+            _remap_likes(c, id_map)
+        else:
+            main = get_db_connection()
+            try:
+                _set_route(main, user_id, target)
+                _remap_likes(main.cursor(), id_map)
+                main.commit()
+            finally:
+                main.close()
+        _drop_user(c, user_id)
+        return len(id_map)
+
+    try:
+        moved = run_write(move, path=SHARDS[source])
+    except _Moved:
+        return False, f"Gebruiker {user_id} werd intussen al verhuisd."
+    except Exception as e:
+        logger.error(f"Error moving user {user_id} from {source} to {target}: {str(e)}")
+        return False, f"Fout bij verhuizen: {str(e)}"
+    logger.info(f"Moved user {user_id} ({moved} books) from shard {source} to {target}")
+    return True, f"Gebruiker {user_id} met {moved} boeken verhuisd van {source} naar {target}."
+
+
+def plan_rebalance(tolerance=REBALANCE_TOLERANCE):
+    """Verhuisplan [(user_id, van, naar, boeken)] dat het aantal boeken per shard gelijker maakt.
+
+    Gulzig: telkens van de zwaarste naar de lichtste shard de gebruiker wiens collectie het dichtst bij de
+    helft van het verschil ligt, zolang dat het verschil verkleint.
+    """
+    per_user = fan_out(lambda conn: {row['user_id']: row['books'] for row in conn.execute(
+        '''SELECT user_id, COUNT(*) AS books FROM holdings WHERE user_id IS NOT NULL GROUP BY user_id''')})
+    totals = {name: sum(users.values()) for name, users in per_user.items()}
+    average = sum(totals.values()) / len(totals)
+    moves = []
+    for _ in range(sum(len(users) for users in per_user.values())):
+        heaviest = max(totals, key=totals.get)
+        lightest = min(totals, key=totals.get)
+        gap = totals[heaviest] - totals[lightest]
+        if gap <= tolerance * average:
+            break
+        candidates = [(user_id, books) for user_id, books in per_user[heaviest].items() if 0 < books < gap]
+        if not candidates:
+            break
+        user_id, books = min(candidates, key=lambda item: abs(item[1] - gap / 2))
+        moves.append((user_id, heaviest, lightest, books))
+        del per_user[heaviest][user_id]
+        per_user[lightest][user_id] = books
+        totals[heaviest] -= books
+        totals[lightest] += books
+    return moves
+
+
+def rebalance(tolerance=REBALANCE_TOLERANCE, dry_run=False):
+    """Voer plan_rebalance uit (of toon het enkel); geeft een lijst (user_id, van, naar, boeken, success, message)."""
+    results = []
+    for user_id, source, target, books in plan_rebalance(tolerance):
+        success, message = (True, 'gepland') if dry_run else move_user(user_id, target)
+        results.append((user_id, source, target, books, success, message))
+    return results
+
+
+def user_ids_with_books():
+    """Alle gebruikers met minstens één boek, over alle shards."""
+    found = fan_out(lambda conn: [row[0] for row in conn.execute(
+        'SELECT DISTINCT user_id FROM holdings WHERE user_id IS NOT NULL')])
+    return sorted({user_id for user_ids in found.values() for user_id in user_ids})
+
+
+def book_counts(user_ids):
+    """Aantal boeken en geschatte opslag per gebruiker, uit de shards van die gebruikers."""
+    ids = json.dumps([int(user_id) for user_id in user_ids])
+    return {row['user_id']: row for rows in fan_out(lambda conn: conn.execute(
+        f'''SELECT h.user_id, COUNT(h.id) AS book_count, {STORAGE_BYTES_SQL} AS storage_bytes
+            FROM holdings h JOIN editions e ON e.id = h.edition_id
+            WHERE h.user_id IN (SELECT value FROM json_each(?))
+            GROUP BY h.user_id''', (ids,)).fetchall()).values() for row in rows}
+
+
+# Geschatte opslag per exemplaar (vaste kolommen) bovenop de tekstvelden
+HOLDING_ROW_BYTES = 48
+# Opslag: het exemplaar zelf plus de tekst van niet-gedeelde edities (die van niemand anders zijn)
+STORAGE_BYTES_SQL = f'''COALESCE(SUM({HOLDING_ROW_BYTES} + COALESCE(LENGTH(h.added_date), 0)
+                            + CASE WHEN e.isbn_key IS NULL
+                                   THEN COALESCE(LENGTH(e.titel), 0) + COALESCE(LENGTH(e.auteur_voornaam), 0)
+                                        + COALESCE(LENGTH(e.auteur_achternaam), 0)
+                                        + COALESCE(LENGTH(e.uitgeverij), 0) + COALESCE(LENGTH(e.serie), 0)
+                                   ELSE 0 END), 0)'''
@@ -0,0 +1,240 @@
+from .database import get_db_connection
+from .shards import SHARDS, user_shard, book_shard, run_user_write
+from .writer import run_write
+from .catalog import BOOKS_SELECT, add_holding, drop_edition_if_unused, bump_revision
+from .recommendations import invalidate_similar_books
+from datetime import datetime
+import io
+import logging
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Aantal rijen per row group (export) en per batch (import)
+SNAPSHOT_BATCH_SIZE = 5000
+
+# Kolommen van een snapshot, in vaste volgorde; de types staan in snapshot_schema()
+SNAPSHOT_COLUMNS = ['id', 'user_id', 'titel', 'auteur_voornaam', 'auteur_achternaam', 'genre', 'prijs',
+                    'paginas', 'bindwijze', 'edition', 'isbn', 'reeks_nr', 'uitgeverij', 'serie',
+                    'staat', 'taal', 'gesigneerd', 'gelezen', 'added_date', 'land']
+
+
+def _pyarrow():
+    """pyarrow is alleen nodig voor snapshots; geef een duidelijke fout als het ontbreekt."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow
+    except ImportError:
+        raise RuntimeError("Snapshots vereisen pyarrow (pip install pyarrow).")
+
+
+def snapshot_schema():
+    pa = _pyarrow()
+    # reeks_nr is vrije tekst ('2a', '1.5', 'III') en blijft dus een string
+    types = {'id': pa.int64(), 'user_id': pa.int64(), 'prijs': pa.float64(), 'paginas': pa.int32(),
+             'added_date': pa.timestamp('s')}
+    return pa.schema([(col, types.get(col, pa.string())) for col in SNAPSHOT_COLUMNS])
+
+
+def _to_int(value):
+    try:
+        return int(float(value)) if value not in (None, '') else None
+    except (ValueError, TypeError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value) if value not in (None, '') else None
+    except (ValueError, TypeError):
+        return None
+
+
+def _to_timestamp(value):
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(str(value), fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _typed_row(book):
+    row = dict(zip(SNAPSHOT_COLUMNS, book))
+    row['id'] = _to_int(row['id'])
+    row['user_id'] = _to_int(row['user_id'])
+    row['prijs'] = _to_float(row['prijs'])
+    row['paginas'] = _to_int(row['paginas'])
+    row['reeks_nr'] = None if row['reeks_nr'] in (None, '') else str(row['reeks_nr'])
+    row['added_date'] = _to_timestamp(row['added_date'])
+    return row
+
+
+class _ChunkSink(io.RawIOBase):
+    """Schrijfdoel dat de geschreven bytes bijhoudt tot ze doorgegeven worden (zie stream_snapshot)."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _write_row_groups(sink, user_id, batch_size):
+    """Schrijf de snapshot naar sink; geeft na elke row group het aantal boeken erin (0 na de afsluiting)."""
+    pa = _pyarrow()
+    schema = snapshot_schema()
+    query = f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM ({BOOKS_SELECT})"
+    params = ()
+    if user_id is not None:
+        query += ' WHERE user_id = ?'
+        params = (user_id,)
+    # Eén gebruiker staat in één shard; de hele database is elke shard na elkaar (oplopende id-bereiken)
+    paths = [SHARDS[user_shard(user_id)]] if user_id is not None else list(SHARDS.values())
+
+    with pa.parquet.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for path in paths:
+            conn = get_db_connection(path)
+            try:
+                c = conn.cursor()
+                c.execute(query + ' ORDER BY id', params)
+                while True:
+                    books = c.fetchmany(batch_size)
+                    if not books:
+                        break
+                    batch = pa.RecordBatch.from_pylist([_typed_row(book) for book in books], schema=schema)
+                    writer.write_table(pa.Table.from_batches([batch]), row_group_size=batch_size)
+                    yield len(books)
+            finally:
+                conn.close()
+    yield 0
+
+
+def export_snapshot(sink, user_id=None, batch_size=SNAPSHOT_BATCH_SIZE):
+    """Schrijf de boeken (van één gebruiker of de hele database) als Parquet naar sink, per row group."""
+    total = sum(_write_row_groups(sink, user_id, batch_size))
+    logger.info(f"Exported snapshot with {total} books (user_id={user_id})")
+    return total
+
+
+def stream_snapshot(user_id=None, batch_size=SNAPSHOT_BATCH_SIZE):
+    """Zelfde Parquet-bestand als export_snapshot, als generator van bytes: elke row group wordt doorgegeven
+    zodra ze geschreven is, zodat het geheugengebruik niet meegroeit met de collectie."""
+    sink = _ChunkSink()
+    total = 0
+    for count in _write_row_groups(sink, user_id, batch_size):
+        total += count
+        data = sink.take()
+        if data:
+            yield data
+    logger.info(f"Streamed snapshot with {total} books (user_id={user_id})")
+
+
+def _unknown_users(parquet_file, batch_size):
+    """Gebruikers-ID's uit de snapshot die in deze database niet bestaan (None voor boeken zonder gebruiker)."""
+    user_ids = set()
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=['user_id']):
+        user_ids.update(batch.column(0).to_pylist())
+    conn = get_db_connection()
+    try:
+        existing = {row[0] for row in conn.execute('SELECT id FROM users')}
+    finally:
+        conn.close()
+    return sorted(user_ids - existing, key=lambda uid: (uid is not None, uid or 0))
+
+
+def import_snapshot(source, user_id=None, overwrite=False, batch_size=SNAPSHOT_BATCH_SIZE):
+    """Lees een Parquet-snapshot in via de schrijfwachtrij, in één transactie per shard.
+
+    Met user_id komen alle boeken bij die gebruiker terecht (persoonlijke restore); zonder
+    user_id worden de gebruikers uit de snapshot behouden (volledige database-restore); die moeten dan
+    allemaal bestaan, anders wordt er niets geschreven.
+    """
+    pa = _pyarrow()
+    try:
+        parquet_file = pa.parquet.ParquetFile(source)
+    except Exception as e:
+        logger.error(f"Invalid snapshot file: {e}")
+        return False, f"Ongeldig snapshotbestand: {str(e)}"
+
+    missing = [col for col in ['titel'] if col not in parquet_file.schema_arrow.names]
+    if missing:
+        return False, f"Fout: Verplichte kolommen ontbreken in de snapshot: {missing}"
+    columns = [col for col in SNAPSHOT_COLUMNS if col in parquet_file.schema_arrow.names]
+
+    if user_id is None:
+        # Een volledige restore behoudt de gebruikers van de snapshot: die moeten hier bestaan, anders worden
+        # hun boeken wezen die de volgende opruimbeurt stilletjes verwijdert
+        if 'user_id' not in columns:
+            return False, "Fout: De snapshot heeft geen user_id kolom; herstel ze bij een gebruiker."
+        unknown = _unknown_users(parquet_file, batch_size)
+        if unknown:
+            logger.error(f"Snapshot refers to unknown users: {unknown}")
+            shown = ', '.join('zonder gebruiker' if uid is None else str(uid) for uid in unknown[:20])
+            return False, (f"Fout: De snapshot bevat boeken van {len(unknown)} onbekende gebruiker(s): {shown}. "
+                           f"Maak die accounts eerst aan of herstel de boeken per gebruiker.")
+
+    def restore(c, shard):
+        """Schrijfopdracht voor één shard: de boeken uit de snapshot die in deze shard horen."""
+        if overwrite:
+            where, params = ('WHERE user_id = ?', (user_id,)) if user_id is not None else ('', ())
+            c.execute(f'SELECT DISTINCT edition_id FROM holdings {where}', params)
+            old_editions = [row[0] for row in c.fetchall()]
+            c.execute(f'DELETE FROM holdings {where}', params)
+            for edition_id in old_editions:
+                drop_edition_if_unused(c, edition_id)
+
+        shard_of_user = {}
+        count = 0
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            for row in batch.to_pylist():
+                if user_id is not None:
+                    row['user_id'] = user_id
+                if row.get('user_id') not in shard_of_user:
+                    shard_of_user[row.get('user_id')] = user_shard(row.get('user_id'))
+                if shard_of_user[row.get('user_id')] != shard:
+                    continue
+                if row.get('added_date') is not None:
+                    row['added_date'] = row['added_date'].strftime('%Y-%m-%d %H:%M:%S')
+                # Bij een volledige restore over een lege database blijven de boek-id's behouden
+                # (zolang ze in het id-bereik van de shard van de gebruiker vallen)
+                holding_id = row.get('id') if overwrite and user_id is None else None
+                if holding_id is not None and book_shard(holding_id) != shard:
+                    holding_id = None
+                add_holding(c, row, holding_id=holding_id)
+                count += 1
+        invalidate_similar_books(c, user_id)
+        bump_revision(c, user_id)
+        return count
+
+    # Eén schrijfopdracht (transactie) per betrokken shard; een volledige restore verdeelt de boeken volgens de
+    # router. Geen time-out: een grote restore mag langer duren dan een gewone schrijfopdracht.
+    try:
+        if user_id is not None:
+            total = run_user_write(user_id, lambda c: restore(c, user_shard(user_id)), timeout=None)
+        else:
+            total = sum(run_write(lambda c, shard=name: restore(c, shard), timeout=None, path=path)
+                        for name, path in SHARDS.items())
+        logger.info(f"Imported snapshot with {total} books (user_id={user_id}, overwrite={overwrite})")
+        return True, f"Succes: {total} boeken hersteld uit snapshot"
+    except Exception as e:
+        logger.error(f"Error during snapshot import: {str(e)}")
+        return False, f"Fout bij herstellen snapshot: {str(e)}"
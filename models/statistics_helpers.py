@@ -1,9 +1,14 @@
 import pandas as pd
+import math
 import time
 from geopy.geocoders import Nominatim
 from geopy.distance import geodesic
 from geopy.exc import GeocoderTimedOut
 from .database import get_db_connection
+from .writer import run_write
+from .shards import user_connection
+from .gazetteer import resolve_location
+from .catalog import BOOK_COLUMNS, HOLDING_FIELDS, LOOKUP_FIELDS, storage_column
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -14,15 +19,31 @@ logger = logging.getLogger(__name__)
 # -----------------------------
 
 def get_user_books(user_id):
-    """Haal alle boeken van een gebruiker op en zet prijzen/pagina's om naar juiste types"""
-    conn = get_db_connection()
+    """Haal alle boeken van een gebruiker op en zet prijzen/pagina's om naar juiste types.
+
+    Lookup-kolommen (genre, taal, ...) komen als integer-codes uit de database en worden meteen
+    pandas Categoricals, zonder per rij een Python-string aan te maken.
+    """
+    conn = user_connection(user_id)
+    select_list = ', '.join(
+        f"{'h' if field in HOLDING_FIELDS or field in ('id', 'user_id') else 'e'}.{storage_column(field)} AS {field}"
+        for field in BOOK_COLUMNS)
     try:
-        df = pd.read_sql_query('SELECT * FROM books WHERE user_id = ?', conn, params=(user_id,))
+        df = pd.read_sql_query(f'''SELECT {select_list} FROM holdings h JOIN editions e ON e.id = h.edition_id
+                                   WHERE h.user_id = ?''', conn, params=(user_id,))
+        lookup = pd.read_sql_query('SELECT id, field, value FROM lookup_values ORDER BY id', conn)
         logger.debug(f"Retrieved {len(df)} books for user {user_id}")
     except Exception as e:
         logger.error(f"Database error in get_user_books: {e}")
         conn.close()
         return pd.DataFrame()
+    conn.close()
+
+    for field in LOOKUP_FIELDS:
+        values = lookup[lookup['field'] == field]
+        positions = pd.Series(range(len(values)), index=values['id'].values)
+        codes = df[field].map(positions).fillna(-1).astype(int)
+        df[field] = pd.Categorical.from_codes(codes, categories=values['value'].tolist()).remove_unused_categories()
 
     if not df.empty:
         df['prijs'] = pd.to_numeric(df.get('prijs', 0), errors='coerce').fillna(0).astype(float)
@@ -31,58 +52,148 @@ def get_user_books(user_id):
             df['auteur'] = df['auteur_voornaam'] + " " + df['auteur_achternaam']
     return df
 
+def _value_counts_chart(column):
+    def build(df):
+        if column not in df.columns:
+            return None
+        counts = df[column].value_counts()
+        return {'labels': counts.index.tolist(), 'data': counts.values.tolist()}
+    return build
+
+def _pages_chart(df):
+    if 'paginas' not in df.columns:
+        return None
+    pages = df['paginas'].dropna()
+    if pages.empty:
+        return None
+    hist = pd.cut(pages, bins=20, include_lowest=True)
+    counts = hist.value_counts().sort_index()
+    return {
+        'labels': [f"{int(interval.left)}-{int(interval.right)}" for interval in counts.index],
+        'data': counts.tolist()
+    }
+
+def _author_chart(df):
+    if 'auteur' not in df.columns:
+        return None
+    counts = df['auteur'].value_counts().head(10)
+    return {'labels': counts.index.tolist(), 'data': counts.values.tolist()}
+
+def _avg_price_chart(df):
+    if 'genre' not in df.columns or 'prijs' not in df.columns:
+        return None
+    avg_price = df.groupby('genre', observed=True)['prijs'].mean().round(2)
+    return {'labels': avg_price.index.tolist(), 'data': avg_price.values.tolist()}
+
+def _location_chart(df):
+    if 'land' not in df.columns:
+        return None
+    counts = df[df['land'].notnull() & (df['land'] != '')]['land'].value_counts()
+    return {'labels': counts.index.tolist(), 'data': counts.values.tolist()}
+
+# Eén bouwfunctie per grafiek, in weergavevolgorde
+CHART_BUILDERS = {
+    'genre': _value_counts_chart('genre'),
+    'gelezen': _value_counts_chart('gelezen'),
+    'taal': _value_counts_chart('taal'),
+    'paginas': _pages_chart,
+    'auteur': _author_chart,
+    'avg_price': _avg_price_chart,
+    'land': _location_chart,
+}
+
+# Grafieken die samen via één endpoint geladen worden
+CHART_GROUPS = {
+    'verdeling': ['genre', 'gelezen', 'taal', 'land'],
+    'paginas': ['paginas'],
+    'auteurs': ['auteur'],
+    'prijzen': ['avg_price'],
+}
+
+def generate_chart_group(df, group):
+    """Genereer de grafieken van één groep"""
+    charts = {}
+    if df.empty:
+        return charts
+    for name in CHART_GROUPS[group]:
+        chart = CHART_BUILDERS[name](df)
+        if chart is not None:
+            charts[name] = chart
+    return charts
+
 def generate_charts(df):
     """Genereer data voor grafieken"""
     charts = {}
     if df.empty:
         return charts
+    for name, build in CHART_BUILDERS.items():
+        chart = build(df)
+        if chart is not None:
+            charts[name] = chart
+    return charts
 
-    if 'genre' in df.columns:
-        counts = df['genre'].value_counts()
-        charts['genre'] = {'labels': counts.index.tolist(), 'data': counts.values.tolist()}
+# Periodes voor de groei-grafieken: strftime-formaat van een bucket op de ISO added_date
+TIMESERIES_PERIODS = {
+    'week': '%Y-W%W',
+    'maand': '%Y-%m',
+    'jaar': '%Y',
+}
 
-    if 'gelezen' in df.columns:
-        counts = df['gelezen'].value_counts()
-        charts['gelezen'] = {'labels': counts.index.tolist(), 'data': counts.values.tolist()}
+def collection_timeseries(user_id, period='maand'):
+    """Groei van de collectie per periode: toegevoegde boeken, pagina's en geld, cumulatief en leesvoortgang.
 
-    if 'taal' in df.columns:
-        counts = df['taal'].value_counts()
-        charts['taal'] = {'labels': counts.index.tolist(), 'data': counts.values.tolist()}
-
-    if 'paginas' in df.columns:
-        pages = df['paginas'].dropna()
-        if not pages.empty:
-            hist = pd.cut(pages, bins=20, include_lowest=True)
-            counts = hist.value_counts().sort_index()
-            charts['paginas'] = {
-                'labels': [f"{int(interval.left)}-{int(interval.right)}" for interval in counts.index],
-                'data': counts.tolist()
-            }
-
-    if 'auteur' in df.columns:
-        counts = df['auteur'].value_counts().head(10)
-        charts['auteur'] = {'labels': counts.index.tolist(), 'data': counts.values.tolist()}
-
-    if 'genre' in df.columns and 'prijs' in df.columns:
-        avg_price = df.groupby('genre')['prijs'].mean().round(2)
-        charts['avg_price'] = {'labels': avg_price.index.tolist(), 'data': avg_price.values.tolist()}
-
-    if 'land' in df.columns:
-        counts = df[df['land'].notnull() & (df['land'] != '')]['land'].value_counts()
-        charts['land'] = {'labels': counts.index.tolist(), 'data': counts.values.tolist()}
+    Alles wordt in SQLite berekend (GROUP BY op de geïndexeerde added_date, cumulatieven met een
+    window-functie), zodat de kosten niet meegroeien met het aantal boeken in Python.
+    """
+    bucket_format = TIMESERIES_PERIODS[period]
+    conn = user_connection(user_id)
+    c = conn.cursor()
+    c.execute('''WITH buckets AS (
+                     SELECT strftime(?, h.added_date) AS bucket,
+                            COUNT(*) AS books,
+                            SUM(COALESCE(CAST(e.paginas AS INTEGER), 0)) AS pages,
+                            SUM(COALESCE(h.prijs, 0)) AS money,
+                            COALESCE(SUM(h.gelezen_code = (SELECT id FROM lookup_values
+                                                           WHERE field = 'gelezen' AND value = 'ja')), 0) AS books_read
+                     FROM holdings h JOIN editions e ON e.id = h.edition_id
+                     WHERE h.user_id = ? AND h.added_date IS NOT NULL
+                     GROUP BY bucket
+                 )
+                 SELECT bucket, books, pages, ROUND(money, 2), books_read,
+                        SUM(books) OVER running, SUM(pages) OVER running,
+                        ROUND(SUM(money) OVER running, 2), SUM(books_read) OVER running
+                 FROM buckets
+                 WINDOW running AS (ORDER BY bucket ROWS UNBOUNDED PRECEDING)
+                 ORDER BY bucket''', (bucket_format, user_id))
+    rows = c.fetchall()
+    c.execute('SELECT COUNT(*) FROM holdings WHERE user_id = ? AND added_date IS NULL', (user_id,))
+    undated = c.fetchone()[0]
+    conn.close()
+    logger.debug(f"Timeseries for user {user_id} per {period}: {len(rows)} buckets, {undated} undated")
 
-    return charts
+    columns = ['labels', 'books', 'pages', 'money', 'read',
+               'total_books', 'total_pages', 'total_money', 'total_read']
+    series = {name: [row[i] for row in rows] for i, name in enumerate(columns)}
+    # Leesvoortgang: aandeel gelezen boeken van alles wat tot dan toe is toegevoegd
+    series['read_ratio'] = [round(read / total, 4) if total else 0.0
+                            for read, total in zip(series['total_read'], series['total_books'])]
+    series['period'] = period
+    series['undated'] = undated
+    return series
 
-def get_location_coords(df):
-    """Geocode unieke landen en sla op in geocache"""
-    location_coords = {}
-    conn = get_db_connection()
-    c = conn.cursor()
-    geolocator = Nominatim(user_agent="boeken_app")
+def get_location_coords(df, geocode_missing=True):
+    """Coördinaten van unieke plaatsen: geocache, dan de offline gazetteer, dan Nominatim (enkel met geocode_missing).
 
+    Nominatim-resultaten komen in de geocache; de gazetteer is lokaal en snel genoeg om niet te cachen.
+    """
+    location_coords = {}
     if 'land' not in df.columns:
         return location_coords
 
+    conn = get_db_connection()
+    c = conn.cursor()
+    geolocator = None
+
     locations = df[df['land'].notnull() & (df['land'] != '')]['land'].unique()
     for loc in locations:
         loc_clean = loc.strip()
@@ -94,15 +205,19 @@ def get_location_coords(df):
         result = c.fetchone()
         if result:
             location_coords[loc_clean] = (result[0], result[1])
-        else:
+            continue
+        local = resolve_location(loc_clean)
+        if local:
+            location_coords[loc_clean] = local
+        elif geocode_missing:
             try:
+                geolocator = geolocator or Nominatim(user_agent="boeken_app")
                 time.sleep(1)  # Rate limiting
                 geo = geolocator.geocode(loc_clean, country_codes='nl,be,gb,it,de,at,ch', timeout=5)
                 if geo:
                     location_coords[loc_clean] = (geo.latitude, geo.longitude)
-                    c.execute('INSERT INTO geocache (location, lat, lon) VALUES (?, ?, ?)',
-                              (loc_clean, geo.latitude, geo.longitude))
-                    conn.commit()
+                    run_write(lambda w: w.execute('INSERT INTO geocache (location, lat, lon) VALUES (?, ?, ?)',
+                                                  (loc_clean, geo.latitude, geo.longitude)))
                 else:
                     logger.debug(f"No coordinates for {loc_clean}")
             except (GeocoderTimedOut, Exception) as e:
@@ -110,6 +225,112 @@ def get_location_coords(df):
     conn.close()
     return location_coords
 
+# Kaart: plaatsen binnen dezelfde rastercel (in schermpixels op het gevraagde zoomniveau) worden één cluster
+MAP_TILE_SIZE = 256
+MAP_CELL_PIXELS = 60
+MAX_MAP_ZOOM = 18
+# Titels per punt of cluster in de popup
+MAX_MAP_TITLES = 10
+# Breedtegraden waarbuiten Web Mercator (en dus Leaflet) niet tekent
+MERCATOR_MAX_LAT = 85.05112878
+
+
+def location_points(df, location_coords):
+    """Eén punt per plaats met coördinaten: aantal boeken en de eerste titels (gesorteerd)."""
+    if df.empty or 'land' not in df.columns:
+        return []
+    places = df[['land', 'titel']].dropna(subset=['land'])
+    places = places.assign(land=places['land'].astype(str).str.strip())
+    points = []
+    for name, titles in places.groupby('land', sort=True)['titel']:
+        if name not in location_coords:
+            continue
+        lat, lon = location_coords[name]
+        points.append({'name': name, 'lat': lat, 'lon': lon, 'count': int(len(titles)),
+                       'titles': sorted(titles.dropna().astype(str))[:MAX_MAP_TITLES]})
+    return points
+
+
+def _map_pixels(lat, lon, zoom):
+    """Web Mercator-pixelcoördinaten van een punt op een zoomniveau (zelfde projectie als Leaflet)."""
+    scale = MAP_TILE_SIZE * 2 ** zoom
+    lat = max(min(lat, MERCATOR_MAX_LAT), -MERCATOR_MAX_LAT)
+    sin_lat = math.sin(math.radians(lat))
+    x = (lon + 180.0) / 360.0 * scale
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+
+def map_cell(lat, lon, zoom, cell_pixels=MAP_CELL_PIXELS):
+    x, y = _map_pixels(lat, lon, zoom)
+    return int(x // cell_pixels), int(y // cell_pixels)
+
+
+def bbox_cells(bbox, zoom, cell_pixels=MAP_CELL_PIXELS):
+    """Rastercellen die een bounding box (west, zuid, oost, noord) raken, als (x0, x1, y0, y1).
+
+    Een box over de datumgrens heeft x0 > x1; een box rond de hele wereld heeft x0 = x1 = None.
+    """
+    west, south, east, north = bbox
+    if east - west >= 360:
+        x0 = x1 = None
+    else:
+        west = (west + 180.0) % 360.0 - 180.0
+        east = (east + 180.0) % 360.0 - 180.0
+        x0, _ = map_cell(0, west, zoom, cell_pixels)
+        x1, _ = map_cell(0, east, zoom, cell_pixels)
+    _, y0 = map_cell(north, 0, zoom, cell_pixels)
+    _, y1 = map_cell(south, 0, zoom, cell_pixels)
+    return x0, x1, y0, y1
+
+
+def _in_cells(cell, cells):
+    if cells is None:
+        return True
+    x0, x1, y0, y1 = cells
+    if not y0 <= cell[1] <= y1:
+        return False
+    if x0 is None:
+        return True
+    return x0 <= cell[0] <= x1 if x0 <= x1 else (cell[0] >= x0 or cell[0] <= x1)
+
+
+def cluster_locations(points, zoom, cells=None, cell_pixels=MAP_CELL_PIXELS):
+    """Groepeer plaatsen per rastercel tot een GeoJSON FeatureCollection.
+
+    Een cluster ligt op het gewogen gemiddelde (naar aantal boeken) van zijn plaatsen. cells (uit bbox_cells)
+    beperkt het resultaat tot de zichtbare cellen; 'bbox' van de collectie omvat altijd alle punten.
+    """
+    groups = {}
+    for point in points:
+        cell = map_cell(point['lat'], point['lon'], zoom, cell_pixels)
+        if _in_cells(cell, cells):
+            groups.setdefault(cell, []).append(point)
+
+    features = []
+    for members in groups.values():
+        count = sum(point['count'] for point in members)
+        weight = count or len(members)
+        lat = sum(point['lat'] * (point['count'] or 1) for point in members) / weight
+        lon = sum(point['lon'] * (point['count'] or 1) for point in members) / weight
+        members.sort(key=lambda point: -point['count'])
+        titles = []
+        for point in members:
+            titles.extend(point['titles'][:MAX_MAP_TITLES - len(titles)])
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]},
+            'properties': {'count': count, 'cluster': len(members) > 1,
+                           'locations': [point['name'] for point in members], 'titles': titles},
+        })
+    features.sort(key=lambda feature: -feature['properties']['count'])
+
+    collection = {'type': 'FeatureCollection', 'zoom': zoom, 'features': features}
+    if points:
+        collection['bbox'] = [min(point['lon'] for point in points), min(point['lat'] for point in points),
+                              max(point['lon'] for point in points), max(point['lat'] for point in points)]
+    return collection
+
 def generate_fun_facts(df, location_coords):
     """Genereer leuke feitjes over de boeken"""
     fun_facts = []
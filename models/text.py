@@ -0,0 +1,16 @@
+import unicodedata
+import re
+
+
+def normalize_text(value):
+    """Kleine letters, zonder accenten, leestekens en dubbele spaties ('Lori ' en 'lori' worden gelijk)."""
+    if value is None:
+        return ''
+    text = unicodedata.normalize('NFKD', str(value))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', text).split())
+
+
+def book_key(book):
+    """Genormaliseerde tekst waarop boeken vergeleken worden: titel en auteur."""
+    return normalize_text(f"{book['titel']} {book['auteur_voornaam'] or ''} {book['auteur_achternaam'] or ''}")
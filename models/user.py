@@ -1,7 +1,12 @@
 from .database import get_db_connection
+from .catalog import purge_unused_editions
+from .session_store import revoke_user_sessions
+from .shards import assign_shard, book_counts, user_shard, run_user_write, MAIN_SHARD
+from .writer import run_write
 import bcrypt
 from flask import session
 import logging
+import json
 
 # Configureer logging
 logging.basicConfig(level=logging.DEBUG)
@@ -21,21 +26,22 @@ def register_user(form):
     if len(password) < 8:
         return False, 'Wachtwoord moet minimaal 8 tekens lang zijn!'
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT id FROM users WHERE username = ?', (username,))
-    if c.fetchone():
-        conn.close()
-        return False, 'Gebruikersnaam is al in gebruik!'
-    
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-    try:
+
+    def register(c):
+        c.execute('SELECT id FROM users WHERE username = ?', (username,))
+        if c.fetchone():
+            return None
         c.execute('INSERT INTO users (username, password, role) VALUES (?, ?, ?)', (username, hashed_password, 'super'))
-        conn.commit()
-        conn.close()
+        return c.lastrowid
+
+    try:
+        user_id = run_write(register)
+        if user_id is None:
+            return False, 'Gebruikersnaam is al in gebruik!'
+        assign_shard(user_id)
         return True, 'Gebruiker succesvol geregistreerd! Log nu in.'
     except Exception as e:
-        conn.close()
         return False, f'Fout bij registreren: {str(e)}'
 
 def login_user(form):
@@ -48,10 +54,81 @@ def login_user(form):
     conn.close()
     
     if user and bcrypt.checkpw(password.encode('utf-8'), user[2].encode('utf-8')):  # Index 2 voor password
+        session.rotate()  # nieuw sessie-id na inloggen
         session['user_id'] = user[0]  # Index 0 voor id
         session['username'] = user[1]  # Index 1 voor username
         session['role'] = user[3]     # Index 3 voor role
         logger.debug(f"Login successful - Session: {session}")
         return True, 'Succesvol ingelogd!'
     logger.debug(f"Login failed - User: {user}, Password check failed")
-    return False, 'Ongeldige gebruikersnaam of wachtwoord!'
\ No newline at end of file
+    return False, 'Ongeldige gebruikersnaam of wachtwoord!'
+
+def list_users(search='', page=1, per_page=25):
+    """Eén pagina gebruikers met hun aantal boeken en geschatte opslag (één gegroepeerde query per shard)."""
+    search = search.strip()
+    where, params = ('WHERE u.username LIKE ?', [f'%{search}%']) if search else ('', [])
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f'SELECT COUNT(*) FROM users u {where}', params)
+    total = c.fetchone()[0]
+    c.execute(f'''SELECT u.id, u.username, u.role FROM users u
+                  {where}
+                  ORDER BY u.username COLLATE NOCASE
+                  LIMIT ? OFFSET ?''', params + [per_page, (page - 1) * per_page])
+    users = [dict(row) for row in c.fetchall()]
+    conn.close()
+    # De boeken staan in de shards: enkel de gebruikers van deze pagina tellen
+    counts = book_counts([user['id'] for user in users])
+    for user in users:
+        count = counts.get(user['id'])
+        user['book_count'] = count['book_count'] if count else 0
+        user['storage_bytes'] = count['storage_bytes'] if count else 0
+    return users, total
+
+def delete_user_cascade(user_id):
+    """Verwijder een gebruiker met al zijn boeken, likes, sessies en instellingen.
+
+    Eén transactie als de boeken in de hoofddatabase staan; anders eerst de boeken in hun shard en daarna
+    het account (een afgebroken verwijdering laat dan hoogstens een gebruiker zonder boeken achter).
+    """
+    conn = get_db_connection()
+    user = conn.execute('SELECT username, profile_pic FROM users WHERE id = ?', (user_id,)).fetchone()
+    conn.close()
+    if not user:
+        return False, 'Gebruiker niet gevonden!', None
+
+    def delete_account(c, book_ids):
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'likes'")
+        if c.fetchone():
+            c.execute('''DELETE FROM likes WHERE user_id = ?
+                         OR book_id IN (SELECT value FROM json_each(?))''', (user_id, json.dumps(book_ids)))
+        revoke_user_sessions(user_id, c)
+        c.execute('DELETE FROM user_shards WHERE user_id = ?', (user_id,))
+        c.execute('DELETE FROM users WHERE id = ?', (user_id,))
+
+    def delete_books(c):
+        c.execute('SELECT id FROM holdings WHERE user_id = ?', (user_id,))
+        book_ids = [row[0] for row in c.fetchall()]
+        c.execute('DELETE FROM holdings WHERE user_id = ?', (user_id,))
+        # De verwijderde exemplaren lieten tombstones achter die niemand meer ophaalt
+        c.execute('DELETE FROM book_tombstones WHERE user_id = ?', (user_id,))
+        purge_unused_editions(c)
+        c.execute('DELETE FROM collection_revisions WHERE user_id = ?', (user_id,))
+        c.execute('DELETE FROM similar_books WHERE user_id = ?', (user_id,))
+        c.execute('DELETE FROM similar_books_state WHERE user_id = ?', (user_id,))
+        c.execute('DELETE FROM similar_books_pending WHERE user_id = ?', (user_id,))
+        # run_user_write garandeert dat dit de shard van de gebruiker is
+        in_main = user_shard(user_id) == MAIN_SHARD
+        if in_main:
+            delete_account(c, book_ids)
+        return book_ids, in_main
+
+    try:
+        book_ids, in_main = run_user_write(user_id, delete_books)
+        if not in_main:
+            run_write(lambda c: delete_account(c, book_ids))
+        logger.info(f"Deleted user {user_id} with {len(book_ids)} books")
+        return True, f"Gebruiker {user['username']} verwijderd (met {len(book_ids)} boeken).", user['profile_pic']
+    except Exception as e:
+        logger.error(f"Error deleting user {user_id}: {str(e)}")
+        return False, f'Fout bij verwijderen gebruiker: {str(e)}', None
@@ -0,0 +1,136 @@
+from .database import get_db_connection
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import threading
+import logging
+import queue
+import os
+
+# Configureer logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Maximaal aantal schrijfopdrachten per transactie (group commit)
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 64))
+# Hoe lang een verzoek hoogstens op zijn schrijfopdracht wacht (seconden)
+WRITE_TIMEOUT = float(os.environ.get('WRITE_TIMEOUT', 30))
+
+
+class WriteQueue:
+    """Eén schrijfthread per proces: alle schrijfopdrachten gaan via een wachtrij en één verbinding.
+
+    Een opdracht is een functie job(c) die met een cursor binnen de transactie van de schrijver werkt en zelf
+    niet commit. Wat tegelijk in de wachtrij staat, wordt in één transactie uitgevoerd (één commit voor de hele
+    batch); elke opdracht krijgt een savepoint, zodat een fout enkel die opdracht terugdraait. Lezen gaat
+    gewoon via eigen verbindingen (WAL) en wacht nooit op de schrijver.
+    """
+
+    def __init__(self, path=None, batch_size=WRITE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.stats = {'jobs': 0, 'batches': 0, 'failed': 0}
+
+    def submit(self, job):
+        """Zet een opdracht in de wachtrij; de Future krijgt het resultaat van job(c) pas na de commit."""
+        future = Future()
+        if self.thread is threading.current_thread():
+            # Opdracht vanuit een opdracht: meteen uitvoeren in de lopende transactie
+            future.set_result(job(self.cursor))
+            return future
+        self._ensure_started()
+        self.jobs.put((job, future))
+        return future
+
+    def run(self, job, timeout=WRITE_TIMEOUT):
+        """Voer een opdracht uit en wacht op het resultaat; een fout in job wordt hier opnieuw opgegooid.
+
+        Na timeout seconden wordt een opdracht die nog in de wachtrij staat geannuleerd (en dus nooit
+        uitgevoerd); een opdracht die al loopt wordt afgewacht, want die wordt toch gecommit.
+        """
+        future = self.submit(job)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise TimeoutError(f"Schrijfopdracht na {timeout} s in de wachtrij geannuleerd (database bezet)")
+            logger.warning(f"Write job exceeded {timeout} s while running; waiting for its commit")
+            return future.result()
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name=f"db-writer-{self.path or 'main'}", daemon=True)
+                self.thread.start()
+
+    def _next_batch(self):
+        batch = [self.jobs.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        conn = get_db_connection(self.path)
+        conn.isolation_level = None  # transacties zelf beheren
+        self.cursor = conn.cursor()
+        while True:
+            batch = self._next_batch()
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                logger.error(f"Write batch of {len(batch)} jobs failed: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run_batch(self, batch):
+        c = self.cursor
+        # IMMEDIATE: de schrijfvergrendeling meteen nemen (andere processen wachten via busy_timeout)
+        c.execute('BEGIN IMMEDIATE')
+        results = []
+        try:
+            for job, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                c.execute('SAVEPOINT job')
+                try:
+                    results.append((future, job(c)))
+                    c.execute('RELEASE job')
+                except Exception as e:
+                    c.execute('ROLLBACK TO job')
+                    c.execute('RELEASE job')
+                    self.stats['failed'] += 1
+                    future.set_exception(e)
+            c.execute('COMMIT')
+        except Exception:
+            if c.connection.in_transaction:
+                c.execute('ROLLBACK')
+            raise
+        self.stats['jobs'] += len(batch)
+        self.stats['batches'] += 1
+        for future, result in results:
+            future.set_result(result)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_write_queue(path=None):
+    """De schrijfwachtrij van dit proces voor een databasebestand (na een fork krijgt het kindproces een eigen)."""
+    key = (os.getpid(), path)
+    with _queues_lock:
+        write_queue = _queues.get(key)
+        if write_queue is None:
+            write_queue = _queues[key] = WriteQueue(path)
+        return write_queue
+
+
+def run_write(job, timeout=WRITE_TIMEOUT, path=None):
+    """Voer job(c) uit via de schrijfthread (van de hoofddatabase of van de shard op path)."""
+    return get_write_queue(path).run(job, timeout)
@@ -0,0 +1,153 @@
+"""Productieserver: meerdere waitress-workers die één gedeelde socket bedienen.
+
+Gebruik:
+    python serve.py --workers 4 --threads 8 --port 8000
+
+De app wordt één keer geladen en de caches worden opgewarmd vóór de workers geforkt
+worden. SIGHUP herlaadt de code zonder de socket te sluiten (verbindingen wachten in
+de backlog), SIGTERM/SIGINT stopt alle workers netjes na hun lopende verzoeken.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('serve')
+
+# Bij een herlaadbeurt geeft de master de luistersocket door aan zijn opvolger
+LISTEN_FD_ENV = 'BOEKEN_LISTEN_FD'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Start de boeken-app met meerdere worker-processen.')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1)))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WAITRESS_THREADS', 8)))
+    parser.add_argument('--graceful-timeout', type=float, default=float(os.environ.get('GRACEFUL_TIMEOUT', 30)),
+                        help='Maximaal aantal seconden om lopende verzoeken af te ronden bij stoppen/herladen.')
+    return parser.parse_args()
+
+
+def create_socket(host, port):
+    """Open de luistersocket, of neem ze over van de vorige master na een herlaadbeurt."""
+    inherited_fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if inherited_fd is not None:
+        sock = socket.socket(fileno=int(inherited_fd))
+        logger.info(f"Reusing listening socket {sock.getsockname()}")
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(1024)
+        logger.info(f"Listening on {host}:{port}")
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(app, sock, threads, graceful_timeout):
+    """Eén worker: waitress met een threadpool, die bij SIGTERM stopt met accepteren en uitloopt."""
+    from waitress import create_server, wasyncore
+    from waitress.channel import HTTPChannel
+    from waitress.server import BaseWSGIServer
+
+    server_map = {}
+    server = create_server(app, map=server_map, sockets=[sock], threads=threads)
+    listeners = [obj for obj in server_map.values() if isinstance(obj, BaseWSGIServer)]
+    stopping = []
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(time.monotonic()))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(time.monotonic()))
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    logger.info(f"Worker {os.getpid()} started with {threads} threads")
+
+    while True:
+        wasyncore.loop(timeout=1.0, map=server_map, use_poll=True, count=1)
+        if stopping:
+            # Geen nieuwe verbindingen meer aannemen, lopende verzoeken afmaken
+            for listener in listeners:
+                wasyncore.dispatcher.close(listener)
+            listeners = []
+            busy = any(isinstance(obj, HTTPChannel) for obj in list(server_map.values()))
+            if not busy or time.monotonic() - stopping[0] > graceful_timeout:
+                break
+
+    server.task_dispatcher.shutdown()
+    logger.info(f"Worker {os.getpid()} stopped")
+    os._exit(0)
+
+
+def main():
+    args = parse_args()
+    sock = create_socket(args.host, args.port)
+
+    # Preload: app importeren (init_db, WAL) en caches opwarmen vóór het forken
+    from app import app, warm_caches
+    warm_caches()
+
+    if not hasattr(os, 'fork'):
+        # Geen fork (Windows): één proces met de opgegeven threads
+        from waitress import serve
+        serve(app, sockets=[sock], threads=args.threads)
+        return
+
+    workers = set()
+    events = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: events.append('stop'))
+    signal.signal(signal.SIGINT, lambda signum, frame: events.append('stop'))
+    signal.signal(signal.SIGHUP, lambda signum, frame: events.append('reload'))
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(app, sock, args.threads, args.graceful_timeout)
+        workers.add(pid)
+
+    def stop_workers():
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(workers):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            workers.discard(pid)
+
+    for _ in range(max(args.workers, 1)):
+        spawn()
+    logger.info(f"Master {os.getpid()} running {len(workers)} workers")
+
+    while True:
+        if 'stop' in events:
+            logger.info("Shutting down workers...")
+            stop_workers()
+            sock.close()
+            return
+        if 'reload' in events:
+            logger.info("Reloading: draining workers and restarting with fresh code...")
+            stop_workers()
+            sock.set_inheritable(True)
+            os.environ[LISTEN_FD_ENV] = str(sock.fileno())
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+        # Onverwacht gestopte workers vervangen
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid and pid in workers:
+            workers.discard(pid)
+            logger.warning(f"Worker {pid} exited with status {status}, starting a new one")
+            spawn()
+        time.sleep(0.5)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Stresstest voor gelijktijdige schrijfopdrachten: eigen verbindingen tegenover de schrijfwachtrij.
+
+Gebruik:
+    python stress_writes.py --threads 16 --writes 200
+
+Elke thread voegt boeken toe aan een tijdelijke database zoals een verzoek dat doet (revisie lezen,
+exemplaar toevoegen, revisie verhogen). In de modus 'direct' heeft elke thread een eigen verbinding en
+commit ze zelf, zoals vóór de schrijfwachtrij; in de modus 'queue' gaat alles via één WriteQueue.
+Per modus worden doorvoer, vergrendelingsfouten en het aantal bewaarde boeken gerapporteerd. De exitcode
+is 1 als de wachtrij fouten gaf of schrijfopdrachten verloor.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from models.catalog import add_holding, bump_revision
+from models.database import get_db_connection, init_shard_db
+from models.writer import WriteQueue
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger('stress_writes')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Meet gelijktijdige schrijfopdrachten met en zonder schrijfwachtrij.')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=200, help='Schrijfopdrachten per thread.')
+    parser.add_argument('--users', type=int, default=4, help='Aantal gebruikers waarover de boeken verdeeld worden.')
+    parser.add_argument('--busy-timeout', type=float, default=1.0,
+                        help='busy_timeout (seconden) van de eigen verbindingen in de modus direct.')
+    parser.add_argument('--mode', choices=['direct', 'queue', 'both'], default='both')
+    return parser.parse_args()
+
+
+def write_book(c, user_id, thread, number):
+    """Eén schrijfopdracht zoals een verzoek: eerst lezen, dan schrijven in dezelfde transactie."""
+    c.execute('SELECT rev FROM collection_revisions WHERE user_id = ?', (user_id,))
+    c.fetchone()
+    add_holding(c, {'user_id': user_id, 'titel': f'Stresstest {thread}-{number}',
+                    'auteur_voornaam': 'Test', 'auteur_achternaam': f'Thread {thread}'})
+    bump_revision(c, user_id)
+
+
+def run_direct(path, args, thread, counts):
+    conn = sqlite3.connect(path, timeout=args.busy_timeout)
+    c = conn.cursor()
+    for number in range(args.writes):
+        try:
+            write_book(c, thread % args.users + 1, thread, number)
+            conn.commit()
+            counts['ok'] += 1
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            counts['errors'] += 1
+            logger.debug(f"Thread {thread}: {str(e)}")
+    conn.close()
+
+
+def run_queue(write_queue, args, thread, counts):
+    for number in range(args.writes):
+        try:
+            write_queue.run(lambda c: write_book(c, thread % args.users + 1, thread, number))
+            counts['ok'] += 1
+        except Exception as e:
+            counts['errors'] += 1
+            logger.debug(f"Thread {thread}: {str(e)}")
+
+
+def stress(mode, args):
+    """Voer één modus uit op een verse database; geeft een dict met de meetresultaten terug."""
+    directory = tempfile.mkdtemp(prefix='stress-writes-')
+    path = os.path.join(directory, 'stress.db')
+    init_shard_db(path, 0)
+    write_queue = WriteQueue(path) if mode == 'queue' else None
+    counts = [{'ok': 0, 'errors': 0} for _ in range(args.threads)]
+    if mode == 'queue':
+        threads = [threading.Thread(target=run_queue, args=(write_queue, args, i, counts[i]))
+                   for i in range(args.threads)]
+    else:
+        threads = [threading.Thread(target=run_direct, args=(path, args, i, counts[i]))
+                   for i in range(args.threads)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    conn = get_db_connection(path)
+    stored = conn.execute('SELECT COUNT(*) FROM holdings').fetchone()[0]
+    revisions = conn.execute('SELECT COALESCE(SUM(rev), 0) FROM collection_revisions').fetchone()[0]
+    conn.close()
+    shutil.rmtree(directory, ignore_errors=True)
+    ok = sum(count['ok'] for count in counts)
+    return {
+        'mode': mode,
+        'ok': ok,
+        'errors': sum(count['errors'] for count in counts),
+        'stored': stored,
+        'revisions': revisions,
+        'seconds': seconds,
+        'batches': write_queue.stats['batches'] if write_queue else ok,
+    }
+
+
+def main():
+    args = parse_args()
+    modes = ['direct', 'queue'] if args.mode == 'both' else [args.mode]
+    failed = False
+    print(f"{args.threads} threads x {args.writes} schrijfopdrachten")
+    for mode in modes:
+        result = stress(mode, args)
+        # Elke geslaagde opdracht moet precies één boek en één revisie opleveren
+        lost = result['stored'] != result['ok'] or result['revisions'] != result['ok']
+        print(f"{mode:>6}: {result['ok']} geslaagd, {result['errors']} fouten, {result['stored']} boeken bewaard, "
+              f"{result['batches']} commits, {result['ok'] / result['seconds']:.0f} schrijfopdrachten/s")
+        if mode == 'queue' and (result['errors'] or lost):
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())